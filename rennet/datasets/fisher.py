@@ -21,8 +21,6 @@ import warnings
 from os.path import abspath
 from csv import reader
 import numpy as np
-import h5py as h
-from six.moves import zip
 
 from ..utils import label_utils as lu
 from ..utils import np_utils as nu
@@ -409,10 +407,30 @@ chosen_val_callids = CHOSEN_VAL_CALLIDS  # pylint: disable=invalid-name
 
 
 class H5ChunkingsReader(hu.BaseH5ChunkingsReader):
-    def __init__(self, filepath, audios_root='audios', labels_root='labels', **kwargs):
+    """ Reads chunkings for the calls in an HDF5 file, one per storage chunk, or, with
+    `read_chunk_len`, one per group of consecutive storage chunks, or per piece of a
+    split one, of about that many rows (check `hu.H5ChunkIndex.read_units_for_all`).
+    The pieces overlap by twice the `data_context` (if any), so that no frames are
+    missed when adding context.
+
+    The chunks of all calls are read from an `hu.H5ChunkIndex`, which is saved next to
+    the file for faster reading later, unless `persist_chunk_index` is `False`.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            filepath,
+            audios_root='audios',
+            labels_root='labels',
+            persist_chunk_index=True,
+            read_chunk_len=None,
+            **kwargs):
 
         self.audios_root = audios_root
         self.labels_root = labels_root
+        self.persist_chunk_index = persist_chunk_index
+        self.read_chunk_len = read_chunk_len
+        self._data_context = 2 * kwargs.get('data_context', 0)
 
         self._grouped_callids = None
 
@@ -426,11 +444,11 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):
 
         # NOTE: Assuming labels and audios have the same group and dset structure
         # use audio root to visit all the groupids, and subsequent callids
-        with h.File(self.filepath, 'r') as f:
-            root = f[self.audios_root]
+        f = hu.H5_FILES_POOL.get(self.filepath)
+        root = f[self.audios_root]
 
-            for groupid in root.keys():  # groupids
-                grouped_callids[groupid] = set(root[groupid].keys())  # callids
+        for groupid in root.keys():  # groupids
+            grouped_callids[groupid] = set(root[groupid].keys())  # callids
 
         return grouped_callids
 
@@ -454,38 +472,26 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):
     def _read_chunkings(self):
         # NOTE: We use the chunking info from the audios
         # and use the same for labels.
-        chunkings = []
-        total_len = 0
-
-        with h.File(self.filepath, 'r') as f:
-            audiog = f[self.audios_root]
-            labelg = f[self.labels_root]
-
-            for groupid in sorted(self.grouped_callids.keys()):
-                for callid in sorted(self.grouped_callids[groupid]):
-                    audiod = audiog[groupid][callid]  # h5 Dataset
-                    labeld = labelg[groupid][callid]  # h5 Dataset
-
-                    totlen = audiod.shape[0]
-
-                    starts = np.arange(0, totlen, audiod.chunks[0])
-                    ends = np.empty_like(starts)
-                    ends[:-1] = starts[1:]
-                    ends[-1] = totlen
-
-                    total_len += totlen
-
-                    chunkings.extend(
-                        hu.Chunking(
-                            datapath=audiod.name,
-                            dataslice=np.s_[s:e, ...],
-                            labelpath=labeld.name,
-                            labelslice=np.s_[s:e, ...]
-                        ) for s, e in zip(starts, ends)
-                    )
-
-        self._totlen = total_len
-        self._chunkings = chunkings
+        index = hu.H5ChunkIndex.for_file(
+            self.filepath, self.audios_root, persist=self.persist_chunk_index
+        )
+        audiog = index.root
+        labelg = "/" + self.labels_root.strip("/")
+
+        names = [
+            "{}/{}".format(groupid, callid)
+            for groupid in sorted(self.grouped_callids.keys())
+            for callid in sorted(self.grouped_callids[groupid])
+        ]
+
+        self._totlen = sum(index.totlen_for(name) for name in names)
+        self._chunkings = hu.ChunkingTable.from_index_table(
+            datapaths=["{}/{}".format(audiog, name) for name in index.names],
+            labelpaths=["{}/{}".format(labelg, name) for name in index.names],
+            table=index.read_units_for_all(
+                names, read_chunk_len=self.read_chunk_len, context=self._data_context
+            ),
+        )
 
     @property
     def chunkings(self):
@@ -626,7 +632,11 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):
 
 class FramewiseNActiveSpeakersPrepper(hu.AsIsChunkPrepper):
     def prep_label(self, label, **kwargs):
-        return nu.to_categorical(np.clip(label.sum(axis=1), 0, 2), nclasses=3)
+        nactive = np.clip(label.sum(axis=1), 0, 2)
+        if self.label_indices:
+            return nactive.astype(np.uint8)
+
+        return nu.to_categorical(nactive, nclasses=3)
 
 
 class UnnormedFramewiseInputsProvider(  # pylint: disable=too-many-ancestors
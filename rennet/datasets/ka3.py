@@ -20,7 +20,6 @@ from __future__ import print_function, division, absolute_import
 import warnings
 from collections import namedtuple
 import numpy as np
-import h5py as h
 
 from ..utils import label_utils as lu
 from ..utils.py_utils import BaseSlotsOnlyClass
@@ -221,6 +220,19 @@ Chunking = namedtuple(
 
 
 class H5ChunkingsReader(hu.BaseH5ChunkingsReader):  # pylint: disable=too-many-instance-attributes
+    """ Reads chunkings for the conversations in an HDF5 file, one per storage chunk,
+    or, with `read_chunk_len`, one per group of consecutive storage chunks, or per piece
+    of a split one, of about that many rows (check `hu.H5ChunkIndex.read_units_for_all`).
+
+    The chunks of all conversations are read from an `hu.H5ChunkIndex`, which is saved
+    next to the file for faster reading later, unless `persist_chunk_index` is `False`.
+
+    With `duplicate_swap_channels`, every chunking is repeated with `swapchannels`, and
+    each chunk is hence read twice. With `random_swap_channels` instead, the chunkings
+    are not repeated, and the channels of the inputs are swapped randomly per sample
+    by the provider (check `ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider`).
+    """
+
     def __init__(  # pylint: disable=too-many-arguments
             self,
             filepath,
@@ -228,15 +240,21 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):  # pylint: disable=too-many-i
             labels_root='labels',
             duplicate_swap_channels=True,
             data_context=0,
+            persist_chunk_index=True,
+            read_chunk_len=None,
+            random_swap_channels=False,
             **kwargs
     ):  # yapf: disable
 
         self.audios_root = audios_root
         self.labels_root = labels_root
+        self.persist_chunk_index = persist_chunk_index
+        self.read_chunk_len = read_chunk_len
         self._data_context = 2 * data_context
 
         self._conversations = None
-        self._dupswap_channels = duplicate_swap_channels
+        self.random_swap_channels = random_swap_channels
+        self._dupswap_channels = duplicate_swap_channels and not random_swap_channels
 
         self._totlen = None
         self._chunkings = None
@@ -251,13 +269,13 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):  # pylint: disable=too-many-i
         # NOTE: Assuming labels and audios have the same group and dset names
         # use audio root to visit all the groups, and subsequent conversations
         # They group/
-        with h.File(self.filepath, 'r') as f:
-            root = f[self.audios_root]
-            conversations += tuple(
-                "{}/{}".format(group, conv)
-                for group in root.keys()
-                for conv in root[group].keys()
-            )
+        f = hu.H5_FILES_POOL.get(self.filepath)
+        root = f[self.audios_root]
+        conversations += tuple(
+            "{}/{}".format(group, conv)
+            for group in root.keys()
+            for conv in root[group].keys()
+        )
 
         return conversations
 
@@ -281,71 +299,64 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):  # pylint: disable=too-many-i
     def _read_all_chunkings(self):  # pylint: disable=too-many-locals
         # NOTE: We use the chunking info from the audios
         # and use the same for labels.
-        chunkings = []
-        total_len = 0
-
-        with h.File(self.filepath, 'r') as f:
-            audior = f[self.audios_root]
-            labelr = f[self.labels_root]
-
-            # NOTE: assuming the same chunk_overlap for labels
-            chunkoverlap = audior.attrs.get('chunk_overlap', 0)
-            skipoverlap = chunkoverlap - self._data_context
-            if skipoverlap < 0:
-                skipoverlap = 0
-                warnings.warn(
-                    "data_context is larger than chunk-overlap: {} > {} \n".format(
-                        self._data_context, chunkoverlap
-                    ) + "This may result in missed data-points when reading from:\n{}".
-                    format(self.filepath)
-                )
+        index = hu.H5ChunkIndex.for_file(
+            self.filepath, self.audios_root, persist=self.persist_chunk_index
+        )
+        audior = index.root
+        labelr = "/" + self.labels_root.strip("/")
+
+        # NOTE: assuming the same chunk_overlap for labels
+        chunkoverlap = int(index.attrs.get('chunk_overlap', 0))
+        if chunkoverlap < self._data_context:
+            warnings.warn(
+                "data_context is larger than chunk-overlap: {} > {} \n".format(
+                    self._data_context, chunkoverlap
+                ) + "This may result in missed data-points when reading from:\n{}".
+                format(self.filepath)
+            )
 
-            for conversation in sorted(self.conversations):
-                audiod = audior[conversation]  # h5 Dataset
-                labeld = labelr[conversation]  # h5 Dataset
-
-                totlen = audiod.shape[0]
-
-                chunksize = audiod.chunks[0] if audiod.chunks else totlen
-                starts = np.arange(0, totlen, chunksize)
-                ends = np.empty_like(starts)
-                ends[-1] = totlen
-                ends[:-1] = starts[1:]
-
-                starts[1:, ...] += skipoverlap
-
-                total_len += totlen
-                chunkings.extend(
-                    Chunking(
-                        datapath=audiod.name,
-                        dataslice=np.s_[s:e, ...],
-                        swapchannels=False,
-                        labelpath=labeld.name,
-                        labelslice=np.s_[s:e, ...]
-                    ) for s, e in zip(starts, ends)
-                )
+        conversations = sorted(self.conversations)
+        table = index.read_units_for_all(
+            conversations,
+            read_chunk_len=self.read_chunk_len,
+            overlap=chunkoverlap,
+            context=self._data_context,
+        )
+
+        total_len = sum(index.totlen_for(c) for c in conversations)
 
-                if self._dupswap_channels:
-                    if len(audiod.shape) < 3 or audiod.shape[-1] != 2:
-                        msg = "Audio data does not seem to have 2 channels. "
-                        msg += "Found chunk of shape: {}\n".format(audiod.shape)
-                        msg += "Channels are expected to be the last dimension. "
-                        msg += "Only stereo channels are supported."
-                        raise ValueError(msg)
-
-                    total_len += totlen
-                    chunkings.extend(
-                        Chunking(
-                            datapath=audiod.name,
-                            dataslice=np.s_[s:e, ...],
-                            swapchannels=True,
-                            labelpath=labeld.name,
-                            labelslice=np.s_[s:e, ...]
-                        ) for s, e in zip(starts, ends)
+        if self._dupswap_channels or self.random_swap_channels:
+            for conversation in conversations:
+                if index.nchannels[index.id_for(conversation)] != 2:
+                    msg = "Audio data does not seem to have 2 channels. "
+                    msg += "Found chunk of shape: {}\n".format(
+                        hu.H5_FILES_POOL.get(self.filepath)[
+                            "{}/{}".format(audior, conversation)
+                        ].shape
                     )
+                    msg += "Channels are expected to be the last dimension. "
+                    msg += "Only stereo channels are supported."
+                    raise ValueError(msg)
+
+        if self._dupswap_channels:
+            # chunks of each conversation, followed by the same with swapped channels
+            swapped = table.copy()
+            swapped['swap'] = True
+
+            position = np.cumsum(np.diff(table['dataset'], prepend=-1) != 0)
+            order = np.argsort(np.concatenate([position, position]), kind='mergesort')
+            table = np.concatenate([table, swapped])[order]
+            total_len *= 2
 
         self._totlen = total_len
-        self._chunkings = chunkings
+        self._chunkings = hu.ChunkingTable.from_index_table(
+            datapaths=["{}/{}".format(audior, name) for name in index.names],
+            labelpaths=["{}/{}".format(labelr, name) for name in index.names],
+            table=table,
+            chunking_cls=Chunking,
+            overlap=chunkoverlap,
+            storage_lens=index.chunk_lens,
+        )
 
     @property
     def chunkings(self):
@@ -393,8 +404,21 @@ class H5ChunkingsReader(hu.BaseH5ChunkingsReader):  # pylint: disable=too-many-i
 
 
 class CategoricalLabelsPrepper(hu.AsIsChunkPrepper):
-    def prep_label(self, label, **kwargs):
-        return label.astype(float)  # NOTE: Assuming stored labels are categorical
+    def prep_label(self, label, read_arena=None, **kwargs):  # pylint: disable=arguments-differ
+        # NOTE: Assuming stored labels are categorical
+        if self.label_indices:
+            label = label.argmax(axis=-1)
+            dtype = np.uint8
+        else:
+            dtype = float
+
+        if read_arena is None:
+            return label.astype(dtype)
+
+        prepped = read_arena.buffer('prepped_label', len(label), label.shape[1:], dtype)
+        prepped[...] = label
+        return prepped
+
 
 class FrameWithContextSubsamplingInputsProvider(  # pylint: disable=too-many-ancestors
         H5ChunkingsReader,
@@ -415,13 +439,29 @@ class ChunkMeanVarianceNormalizingChannelSwappingCategoricalPrepper(
         if chunking is not None and chunking.swapchannels:
             data = data[..., ::-1]  # NOTE: Assuming last dim is for channels
 
-        return self.normalize_data(data, **kwargs)
+        return self.normalize_data(data, chunking=chunking, in_place=True, **kwargs)
+
+    def stats_for_chunking(self, chunking):
+        sup = super(ChunkMeanVarianceNormalizingChannelSwappingCategoricalPrepper, self)
+        stats = sup.stats_for_chunking(chunking)
+
+        if stats is not None and chunking.swapchannels:
+            stats = tuple(s[..., ::-1] for s in stats)
+
+        return stats
 
 
 class ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider(  # pylint: disable=too-many-ancestors
         ChunkMeanVarianceNormalizingChannelSwappingCategoricalPrepper,
         FrameWithContextSubsamplingInputsProvider,
 ):  # yapf: disable
+    """ With `random_swap_channels`, each chunk is read only once, and the channels of
+    about half of its samples, picked randomly based on the chunk's shuffling seed, are
+    swapped in the inputs provided. Hence, every pass has the samples only once, in
+    either orientation, instead of both, as with `duplicate_swap_channels`.
+    NOTE: Nothing is swapped when not shuffling, since the inputs may be views then.
+    """
+
     def __init__(  # pylint: disable=too-many-arguments, too-many-locals
             self,
             filepath,
@@ -430,6 +470,7 @@ class ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider(  # pylint:
             audios_root='audios',
             data_context=0,
             duplicate_swap_channels=True,
+            random_swap_channels=False,  # instead of duplicate_swap_channels
             mean_it=False,
             std_it=False,
             add_channel_at_end=False,  # working with stereo
@@ -466,8 +507,37 @@ class ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider(  # pylint:
             npasses=npasses,
             add_channel_at_end=add_channel_at_end,
             duplicate_swap_channels=duplicate_swap_channels,
+            random_swap_channels=random_swap_channels,
             mean_it=mean_it,
             std_it=std_it,
             nclasses=nclasses,
             **kwargs
         )
+
+    def get_prepped_inputs(  # pylint: disable=arguments-differ
+            self, chunking, array_shuffle_seed=None, only_labels=False, **kwargs
+    ):  # yapf: disable
+        sup = super(ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider, self)
+        inputs = sup.get_prepped_inputs(
+            chunking,
+            array_shuffle_seed=array_shuffle_seed,
+            only_labels=only_labels,
+            **kwargs
+        )
+
+        if not self.random_swap_channels or only_labels or array_shuffle_seed is None:
+            return inputs
+
+        # NOTE: a seed different from the ones used for subsampling and shuffling
+        return self._randomly_swapped(inputs, self.split_seed(array_shuffle_seed, n=3)[-1])
+
+    def _randomly_swapped(self, inputs, seed):
+        # NOTE: Assuming channels are the last dim, before the one added, if any
+        axis = -2 if self.add_channel else -1
+        rng = self.rng(seed)
+        for step in inputs:
+            # the steps are copied out of the chunk when shuffling, and can be changed
+            data = step[0]
+            swaps = np.flatnonzero(rng.uniform(size=len(data)) < 0.5)
+            data[swaps] = np.flip(data[swaps], axis=axis)
+            yield step
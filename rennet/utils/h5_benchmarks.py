@@ -0,0 +1,518 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Benchmarks for reading and prepping inputs from HDF5 files with `h5_utils`
+"""
+from __future__ import print_function, division, absolute_import
+from collections import OrderedDict
+from timeit import default_timer as timer
+import json
+import os
+import tempfile
+import tracemalloc
+import numpy as np
+
+from .h5_utils import H5_FILES_POOL, ReadArena, rewrite_h5_file, steps_in
+
+try:
+    import resource
+except ImportError:  # not on unix
+    resource = None
+
+try:
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+MB = 1024**2
+PAGE_NBYTES = resource.getpagesize() if resource is not None else 0
+
+
+CODECS = OrderedDict([
+    ('none', dict()),
+    ('lzf', dict(compression='lzf')),
+    ('lzf-shuffle', dict(compression='lzf', shuffle=True)),
+    ('gzip1', dict(compression='gzip', compression_opts=1)),
+    ('gzip4', dict(compression='gzip', compression_opts=4)),
+    ('gzip9', dict(compression='gzip', compression_opts=9)),
+    ('gzip4-shuffle', dict(compression='gzip', compression_opts=4, shuffle=True)),
+])  # yapf: disable
+
+if hdf5plugin is not None:
+    CODECS['blosc-lz4'] = dict(hdf5plugin.Blosc(cname='lz4', clevel=5))
+    CODECS['blosc-zstd'] = dict(hdf5plugin.Blosc(cname='zstd', clevel=3))
+
+
+def _minor_page_faults():
+    if resource is None:
+        return 0
+
+    return resource.getrusage(resource.RUSAGE_SELF).ru_minflt
+
+
+def _reset_traced_peak():
+    # returns the traced memory the peak is reset to
+    if hasattr(tracemalloc, 'reset_peak'):  # python >= 3.9
+        tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    # forgetting what was traced so far
+    tracemalloc.stop()
+    tracemalloc.start()
+    return 0
+
+
+def _counting_reads(provider, counts):
+    read = provider.read_h5_data_label_chunk
+
+    def _read(*args, **kwargs):
+        arrays = read(*args, **kwargs)
+        counts[0] += 1
+        counts[1] += sum(a.nbytes for a in arrays if a.base is None)  # not in an arena
+        return arrays
+
+    return _read
+
+
+def flow_allocations(provider, trace=False, **flow_kwargs):
+    """ Time taken, and memory allocated, when flowing all the inputs of `provider`.
+
+    `read_nbytes` is the memory allocated for reading the chunks, either as new arrays
+    for each chunk, or for the buffers of the `read_arena` of the flow.
+    NOTE: reads in prefetching processes are not counted.
+
+    `fresh_nbytes` is the memory touched for the first time, per the minor page faults
+    of the process, which is mostly due to allocating large arrays, like chunks.
+
+    With `trace`, the allocations are also traced with `tracemalloc` (which slows the
+    flow down considerably). `transient_nbytes` is then the sum, over all the inputs, of
+    the memory allocated at peak while producing the input, over what was before.
+    NOTE: Before python 3.9, the tracing is restarted for each input instead.
+    """
+    traced = trace and not tracemalloc.is_tracing()
+    if traced:
+        tracemalloc.start()
+
+    try:
+        ninputs = 0
+        transient = 0
+        reads = [0, 0]
+        provider.read_h5_data_label_chunk = _counting_reads(provider, reads)
+
+        faults = _minor_page_faults()
+        t = timer()
+        flow = provider.flow(**flow_kwargs)
+        while True:
+            if trace:
+                before = _reset_traced_peak()
+
+            try:
+                inputs = next(flow)
+            except StopIteration:
+                break
+
+            if trace:
+                transient += tracemalloc.get_traced_memory()[1] - before
+
+            ninputs += 1
+            del inputs
+
+        t = timer() - t
+        faults = _minor_page_faults() - faults
+    finally:
+        del provider.read_h5_data_label_chunk
+        if traced:
+            tracemalloc.stop()
+
+    arena = getattr(provider, 'read_arena', None)
+    return dict(
+        seconds=t,
+        ninputs=ninputs,
+        nreads=reads[0],
+        read_nbytes=reads[1] + (0 if arena is None else arena.nbytes_allocated),
+        fresh_nbytes=faults * PAGE_NBYTES,
+        transient_nbytes=transient if trace else None,
+        arena_nallocs=0 if arena is None else arena.nallocs,
+    )
+
+
+def compare_read_buffers(make_provider, nflows=3, trace=False, **flow_kwargs):
+    """ `flow_allocations` for providers made by `make_provider(reuse_read_buffers=...)`
+    with and without reusing the read buffers, for `nflows` flows each.
+
+    The results are printed as a table, and returned.
+    """
+    results = []
+    for reuse in (False, True):
+        provider = make_provider(reuse_read_buffers=reuse)
+        for f in range(nflows):
+            r = flow_allocations(provider, trace=trace, **flow_kwargs)
+            results.append(((reuse, f), r))
+
+    print("{:>6} {:>4} {:>9} {:>7} {:>6} {:>8} {:>9} {:>13}".format(
+        'reuse', 'flow', 'seconds', 'inputs', 'reads', 'read MB', 'fresh MB',
+        'transient MB'
+    ))  # yapf: disable
+    for (reuse, f), r in results:
+        transient = r['transient_nbytes']
+        print("{:>6} {:>4} {:>9.3f} {:>7} {:>6} {:>8.1f} {:>9.1f} {:>13}".format(
+            str(reuse), f, r['seconds'], r['ninputs'], r['nreads'],
+            r['read_nbytes'] / MB, r['fresh_nbytes'] / MB,
+            '-' if transient is None else '{:.1f}'.format(transient / MB)
+        ))  # yapf: disable
+
+    return results
+
+
+def stored_nbytes(provider):
+    """ Bytes stored in the HDF5 file for the data of all the chunkings of `provider`,
+    i.e. as read from disk in a pass.
+    """
+    datapaths = set(c.datapath for c in provider.chunkings)
+    return sum(
+        H5_FILES_POOL.dataset(provider.filepath, datapath).id.get_storage_size()
+        for datapath in datapaths)
+
+
+def quantization_error(provider, quantized_provider, predict=None, **flow_kwargs):
+    """ Error in the inputs of `quantized_provider`, reading the data stored quantized
+    (check `h5_utils.quantize_h5_file`), w.r.t. the same inputs from `provider`.
+
+    The providers should be setup the same, e.g. with the same `shuffle_seed`, so that
+    they flow the same inputs in lockstep.
+
+    `predict` can be a function to get predictions for the inputs, e.g. the `predict`
+    of a trained keras model, and the agreement of the (argmax) predicted classes on
+    the two, and the max abs error in the predictions are then also reported.
+
+    The results are printed, and returned.
+    """
+    sq_err = sq_ref = 0.
+    max_err = 0.
+    n = npredicted = nagree = 0
+    max_pred_err = 0.
+    flows = zip(provider.flow(**flow_kwargs), quantized_provider.flow(**flow_kwargs))
+    for (ref, _), (got, _) in flows:
+        if ref.shape != got.shape:
+            raise ValueError("The providers don't flow the same inputs")
+
+        err = got.astype(np.float64) - ref
+        sq_err += np.square(err).sum()
+        sq_ref += np.square(ref, dtype=np.float64).sum()
+        max_err = max(max_err, np.abs(err).max())
+        n += ref.size
+
+        if predict is not None:
+            pref, pgot = predict(ref), predict(got)
+            agree = pref.argmax(axis=-1) == pgot.argmax(axis=-1)
+            nagree += agree.sum()
+            npredicted += agree.size
+            max_pred_err = max(max_pred_err, np.abs(pgot - pref).max())
+
+    results = dict(
+        max_abs_error=max_err,
+        rmse=np.sqrt(sq_err / max(n, 1)),
+        relative_rmse=np.sqrt(sq_err / sq_ref) if sq_ref > 0 else 0.,
+        stored_nbytes=stored_nbytes(provider),
+        quantized_stored_nbytes=stored_nbytes(quantized_provider),
+    )
+    if predict is not None:
+        results['prediction_agreement'] = nagree / max(npredicted, 1)
+        results['max_abs_prediction_error'] = max_pred_err
+
+    print("{:>12} {:>10} {:>12} {:>11} {:>11} {:>8}".format(
+        'max abs err', 'rmse', 'relative', 'stored MB', 'quant. MB', 'ratio'
+    ))  # yapf: disable
+    print("{:>12.4g} {:>10.4g} {:>12.4g} {:>11.1f} {:>11.1f} {:>8.2f}".format(
+        results['max_abs_error'], results['rmse'], results['relative_rmse'],
+        results['stored_nbytes'] / MB, results['quantized_stored_nbytes'] / MB,
+        results['stored_nbytes'] / max(results['quantized_stored_nbytes'], 1)
+    ))  # yapf: disable
+    if predict is not None:
+        print("predictions agree: {:.4f}, max abs error: {:.4g}".format(
+            results['prediction_agreement'], results['max_abs_prediction_error']))
+
+    return results
+
+
+def _drop_from_page_cache(filepath):
+    # best effort, so that reads come from the disk, and not from freshly written pages
+    if not hasattr(os, 'posix_fadvise'):
+        return
+
+    fd = os.open(filepath, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def rechunk_h5_file(srcpath, dstpath, chunk_len=None, root='audios', **codec):
+    """ Copy the HDF5 file at `srcpath` to `dstpath`, with the float datasets under
+    `root` stored in chunks of `chunk_len` rows (or the same as before, if `None`),
+    and compressed as per `codec`, i.e. kwargs for `create_dataset`, e.g. from `CODECS`.
+    """
+
+    def _rechunked(group, name, dataset):
+        chunks = dataset.chunks
+        if chunk_len is not None:
+            chunks = (min(chunk_len, max(len(dataset), 1)), ) + dataset.shape[1:]
+
+        return group.create_dataset(name, data=dataset[()], chunks=chunks, **codec)
+
+    rewrite_h5_file(srcpath, dstpath, _rechunked, root=root)
+
+
+def compare_storage(  # pylint: disable=too-many-arguments,too-many-locals
+        srcpath,
+        make_provider,
+        chunk_lens=(None, ),
+        codecs=None,
+        root='audios',
+        workdir=None,
+        **flow_kwargs
+):  # yapf: disable
+    """ Time a full `flow` of the provider made by `make_provider(filepath)` for the
+    HDF5 file at `srcpath` rewritten with each of `chunk_lens` and `codecs` (names in
+    `CODECS`, all by default) for the datasets under `root`.
+
+    The rewritten files are kept in `workdir` (a temporary directory, by default), and
+    dropped from the page cache of the OS before flowing, where possible.
+
+    NOTE: the chunk lengths also decide the chunks of the providers in `fisher` and
+    `ka3`, and hence the number and shape of the inputs flowed.
+
+    The `MB/s` are of the data read (as stored on disk, and as decompressed), for
+    `npasses` of the provider, and the results are printed as a table, and returned.
+    """
+    codecs = list(CODECS) if codecs is None else codecs
+    workdir = tempfile.mkdtemp(prefix='h5_storage_') if workdir is None else workdir
+
+    results = []
+    for chunk_len in chunk_lens:
+        for codec in codecs:
+            filepath = os.path.join(
+                workdir, '{}-{}.h5'.format(chunk_len or 'asis', codec)
+            )
+            rechunk_h5_file(srcpath, filepath, chunk_len, root=root, **CODECS[codec])
+            _drop_from_page_cache(filepath)
+
+            provider = make_provider(filepath)
+            datasets = [
+                H5_FILES_POOL.dataset(filepath, d)
+                for d in set(c.datapath for c in provider.chunkings)
+            ]
+            stored = sum(d.id.get_storage_size() for d in datasets)
+            nbytes = sum(d.size * d.dtype.itemsize for d in datasets)
+
+            r = flow_allocations(provider, **flow_kwargs)
+            H5_FILES_POOL.close(filepath)
+            r.update(
+                chunk_len=chunk_len,
+                codec=codec,
+                file_nbytes=os.path.getsize(filepath),
+                stored_nbytes=stored,
+                data_nbytes=nbytes,
+                npasses=provider.npasses,
+                nchunks=provider.nchunks,
+            )
+            results.append(r)
+
+    print("{:>9} {:>14} {:>8} {:>7} {:>8} {:>9} {:>12} {:>8}".format(
+        'chunk len', 'codec', 'file MB', 'ratio', 'seconds', 'chunks/s', 'stored MB/s',
+        'MB/s'
+    ))  # yapf: disable
+    for r in results:
+        print("{:>9} {:>14} {:>8.1f} {:>7.2f} {:>8.3f} {:>9.1f} {:>12.1f} {:>8.1f}".format(
+            r['chunk_len'] or 'as is', r['codec'], r['file_nbytes'] / MB,
+            r['data_nbytes'] / max(r['stored_nbytes'], 1), r['seconds'],
+            r['nchunks'] * r['npasses'] / r['seconds'],
+            r['stored_nbytes'] * r['npasses'] / MB / r['seconds'],
+            r['data_nbytes'] * r['npasses'] / MB / r['seconds']
+        ))  # yapf: disable
+
+    return results
+
+
+# (stage, methods of the provider, or its prepped_cache, timed for it), in flow order
+STAGES = (
+    ('read', ('read_h5_data_label_chunk', )),
+    ('dequantize', ('dequantize_data', )),
+    ('prep data', ('prep_data', )),
+    ('prep label', ('prep_label', )),
+    ('label subcontext', ('lctxfn', )),
+    ('cache', ('get', 'put')),
+    ('keeping decision', ('keeping_decision', )),
+    ('shuffling', ('maybe_shuffle_array', 'se_for_chunksteps_maybeshuffled')),
+    ('steps', ('get_prepped_inputs', )),
+)
+
+
+class StageProfile(object):
+    """ Wall time spent in each of the `STAGES` of prepping the inputs of a provider,
+    along with the bytes read and the rows provided, for each chunk.
+
+    The methods of the provider for each stage are timed (excluding the time spent in
+    the other timed methods they call) while it is `attached` to it.
+    The time of the 'steps' is what remains in `get_prepped_inputs`, which, mainly,
+    is of adding context (as views) and gathering the rows of the steps provided.
+
+    NOTE: The methods are only timed when called on the provider (or its cache), and
+    not via `super`. Hence, `get_prepped_data_label` is not timed by itself.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self._stack = []
+        self._originals = []
+
+    def _add(self, stage, seconds):
+        if self.chunks:
+            chunk = self.chunks[-1]
+            chunk[stage] = chunk.get(stage, 0.) + seconds
+
+    def _timed(self, stage, method):
+        def _method(*args, **kwargs):
+            self._stack.append(0.)
+            t = timer()
+            try:
+                result = method(*args, **kwargs)
+            finally:
+                t = timer() - t
+                self._add(stage, t - self._stack.pop())
+                if self._stack:
+                    self._stack[-1] += t
+
+            if stage == 'read':
+                self.chunks[-1]['read_nbytes'] += sum(a.nbytes for a in result)
+
+            return result
+
+        return _method
+
+    def _timed_steps(self, steps):
+        # the steps are prepped while being iterated through, and are timed alike
+        steps = iter(steps)
+        next_step = self._timed('steps', lambda: next(steps, None))
+        while True:
+            step = next_step()
+            if step is None:
+                return
+
+            self.chunks[-1]['rows'] += len(step[0])
+            yield step
+
+    def _get_prepped_inputs(self, method):
+        timed = self._timed('steps', method)
+
+        def _method(chunking, chunkidx=None, passidx=None, **kwargs):
+            self.chunks.append(OrderedDict([
+                ('pass', passidx),
+                ('chunk', None if chunkidx is None else int(chunkidx)),
+                ('rows', 0),
+                ('read_nbytes', 0),
+            ]))  # yapf: disable
+            inputs = timed(chunking, chunkidx=chunkidx, passidx=passidx, **kwargs)
+            return list(self._timed_steps(steps_in(inputs)))
+
+        return _method
+
+    def attach(self, provider):
+        for stage, names in STAGES:
+            obj = provider.prepped_cache if stage == 'cache' else provider
+            for name in names:
+                method = None if obj is None else getattr(obj, name, None)
+                if method is None:
+                    continue
+
+                self._originals.append((obj, name, obj.__dict__.get(name, None)))
+                if name == 'get_prepped_inputs':
+                    setattr(obj, name, self._get_prepped_inputs(method))
+                else:
+                    setattr(obj, name, self._timed(stage, method))
+
+    def detach(self):
+        for obj, name, original in reversed(self._originals):
+            if original is None:
+                delattr(obj, name)
+            else:
+                setattr(obj, name, original)
+
+        self._originals = []
+
+    def totals(self):
+        """ The total seconds for each stage, over all the chunks. """
+        return OrderedDict(
+            (stage, sum(c.get(stage, 0.) for c in self.chunks)) for stage, _ in STAGES
+        )
+
+    def to_json(self, filepath, **extra):
+        with open(filepath, 'w') as f:
+            json.dump(
+                dict(totals=self.totals(), chunks=self.chunks, **extra), f, indent=2
+            )
+
+
+def profile_provider(provider, npasses=1, json_path=None):
+    """ Profile the wall time spent in each stage of prepping the inputs (check
+    `StageProfile`) when flowing `npasses` passes of `provider`, without prefetching.
+
+    The totals for each stage are printed as a table, along with the bytes read, the
+    rows provided, and the share of the time spent reading, which tells whether the
+    flow is I/O- or CPU-bound. The results, also for each chunk, are saved as JSON to
+    `json_path`, if given, and returned.
+    """
+    kwargs = dict()
+    if provider.reuse_read_buffers:
+        kwargs['read_arena'] = ReadArena()
+
+    profile = StageProfile()
+    profile.attach(provider)
+    try:
+        t = timer()
+        for p in range(npasses):
+            for _ in provider.flow_for_pass(p % provider.npasses, **kwargs):
+                pass
+
+        t = timer() - t
+    finally:
+        profile.detach()
+
+    totals = profile.totals()
+    results = dict(
+        seconds=t,
+        npasses=npasses,
+        nchunks=len(profile.chunks),
+        rows=sum(c['rows'] for c in profile.chunks),
+        read_nbytes=sum(c['read_nbytes'] for c in profile.chunks),
+        stage_seconds=totals,
+        flow_seconds=t - sum(totals.values()),
+    )
+    if json_path is not None:
+        extra = {k: v for k, v in results.items() if k != 'stage_seconds'}
+        profile.to_json(json_path, **extra)
+
+    nchunks = max(results['nchunks'], 1)
+    print("{:>17} {:>9} {:>7} {:>9}".format('stage', 'seconds', '% time', 'ms/chunk'))
+    for stage, secs in list(totals.items()) + [('flow', results['flow_seconds'])]:
+        print("{:>17} {:>9.3f} {:>7.1f} {:>9.3f}".format(
+            stage, secs, 100 * secs / t, 1000 * secs / nchunks))  # yapf: disable
+
+    print("{} chunks, {} rows, {:.1f} MB read in {:.3f} s: ".format(
+        results['nchunks'], results['rows'], results['read_nbytes'] / MB, t
+    ) + "{:.1f} MB/s, {:.0f} rows/s, {:.0f}% of the time reading".format(
+        results['read_nbytes'] / MB / t, results['rows'] / t, 100 * totals['read'] / t
+    ))  # yapf: disable
+
+    return results
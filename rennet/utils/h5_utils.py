@@ -17,13 +17,30 @@
 Created: Mon, 10-Apr-2017
 """
 from __future__ import print_function, division, absolute_import
-from collections import namedtuple, Iterable
+from collections import namedtuple, Iterable, OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait
+from inspect import isgenerator
 from warnings import warn as warning
+from threading import RLock, local
+from itertools import count
+from timeit import default_timer as timer
+from os import getpid, stat, replace as replace_file
+from os.path import abspath
+from fnmatch import fnmatchcase
+from zipfile import BadZipFile
+import atexit
+import json
+from six import string_types
 from six.moves import zip, range
 import numpy as np
 import numpy.random as nr
 import h5py as h
 
+try:
+    from multiprocessing.shared_memory import SharedMemory
+except ImportError:  # python < 3.8
+    SharedMemory = None
+
 from . import np_utils as nu
 
 Chunking = namedtuple('Chunking', [
@@ -34,6 +51,116 @@ Chunking = namedtuple('Chunking', [
 ])
 
 
+# HDF5 FILES POOL ########################################### HDF5 FILES POOL #
+
+
+class H5FilesPool(object):
+    """ Per-process pool of HDF5 files (and datasets) kept open for reading.
+
+    Opening a (large) HDF5 file for every chunk means parsing its metadata again, and
+    starting each dataset with a cold chunk cache. Instead, files are opened read-only
+    once per process, and the most recently used datasets are kept open (upto
+    `max_open_datasets`), so that consecutive reads from a dataset hit its chunk cache.
+
+    `rdcc_nbytes` and `rdcc_nslots` configure the chunk cache of each open dataset
+    (check `h5py.File`), and are HDF5's defaults when `None`.
+
+    The pool notices when it is being used in a forked process, and then re-opens the
+    files, instead of using the handles inherited from the parent.
+
+    NOTE: A file can't be opened for writing while it is open in the pool.
+    Call `close` (for one or all files) before doing so.
+    """
+
+    def __init__(self, rdcc_nbytes=None, rdcc_nslots=None, max_open_datasets=64):
+        self.rdcc_nbytes = rdcc_nbytes
+        self.rdcc_nslots = rdcc_nslots
+        self.max_open_datasets = max_open_datasets
+
+        self._files = dict()
+        self._datasets = OrderedDict()  # in order of use, most recent last
+        self._pid = getpid()
+        self._lock = RLock()
+
+    def _forget_if_forked(self):
+        if self._pid != getpid():
+            # handles belong to the parent process, don't close them, just forget.
+            self._files = dict()
+            self._datasets = OrderedDict()
+            self._pid = getpid()
+
+    def configure(self, rdcc_nbytes=None, rdcc_nslots=None, max_open_datasets=None):
+        """ Change the settings, and close all files so that they apply on next open. """
+        with self._lock:
+            self.close()
+            self.rdcc_nbytes = rdcc_nbytes
+            self.rdcc_nslots = rdcc_nslots
+            if max_open_datasets is not None:
+                self.max_open_datasets = max_open_datasets
+
+    def get(self, filepath):
+        """ The pooled `h5py.File` at `filepath`, opened read-only. """
+        filepath = abspath(filepath)
+        with self._lock:
+            self._forget_if_forked()
+
+            f = self._files.get(filepath, None)
+            if f is None or not f.id.valid:
+                f = h.File(
+                    filepath,
+                    'r',
+                    rdcc_nbytes=self.rdcc_nbytes,
+                    rdcc_nslots=self.rdcc_nslots,
+                )
+                self._files[filepath] = f
+
+            return f
+
+    def dataset(self, filepath, datasetpath):
+        """ The pooled `h5py.Dataset` at `datasetpath` in the file at `filepath`. """
+        key = (abspath(filepath), datasetpath)
+        with self._lock:
+            self._forget_if_forked()
+
+            d = self._datasets.pop(key, None)
+            if d is None or not d.id.valid:
+                d = self.get(filepath)[datasetpath]
+
+            self._datasets[key] = d
+            while len(self._datasets) > self.max_open_datasets:
+                self._datasets.popitem(last=False)
+
+            return d
+
+    def close(self, filepath=None):
+        """ Close the file at `filepath` (and its datasets), or all if `None`. """
+        with self._lock:
+            self._forget_if_forked()
+
+            if filepath is None:
+                filepaths = list(self._files.keys())
+            else:
+                filepaths = [abspath(filepath)]
+
+            for fp in filepaths:
+                for key in [k for k in self._datasets.keys() if k[0] == fp]:
+                    del self._datasets[key]
+
+                f = self._files.pop(fp, None)
+                if f is not None and f.id.valid:
+                    f.close()
+
+    def __contains__(self, filepath):
+        with self._lock:
+            self._forget_if_forked()
+            return abspath(filepath) in self._files
+
+
+# The pool used by all readers and preppers
+H5_FILES_POOL = H5FilesPool()
+atexit.register(H5_FILES_POOL.close)
+
+
 # IDEA: Move all logic for reading from hdf5 to h5 chunking reader.
 # Then, any other chunking reader, for example one working with csv, can be implemented
 # and monkey-patched onto the inputs providers, without needing change to preppers.
@@ -68,8 +195,8 @@ class BaseH5ChunkingsReader(object):
     def chunkings(self):
         """ Chunking information for each dataset.
 
-        List of Chunking instances, with slices corresponding to the each chunk
-        of the datasets that will be read.
+        List of Chunking instances (or a `ChunkingTable`), with slices corresponding to
+        the each chunk of the datasets that will be read.
 
         It is a computed property, because these are read only when
         we have the final list of all the datasets to be read from the file.
@@ -86,29 +213,865 @@ class BaseH5ChunkingsReader(object):
         return len(self.chunkings)
 
 
+# CHUNK INDEX ################################################### CHUNK INDEX #
+
+CHUNK_INDEX_DTYPE = np.dtype([
+    ('dataset', np.int32),  # index into the accompanying names of the datasets
+    ('start', np.int64),
+    ('end', np.int64),
+    ('swap', np.bool_),
+])
+
+
+class H5ChunkIndex(object):
+    """ Storage chunks of all the datasets under the group `root` of an HDF5 file.
+
+    `names` are the paths of the datasets relative to `root`, sorted, and `table` is a
+    structured array (`CHUNK_INDEX_DTYPE`) with a row per chunk of each dataset, in order.
+    `nchannels` is the size of the last dimension of each dataset, if it has >= 3
+    dimensions, else 0. `attrs` are the attributes of `root`.
+
+    Walking all the datasets in a large file is slow, hence, `for_file` persists the
+    index in a sidecar file next to the HDF5 file, which is used as long as the HDF5
+    file has not been modified since (per its size and modification time).
+    """
+    VERSION = 1
+
+    def __init__(self, root, names, table, nchannels, attrs=None):
+        self.root = root
+        self.names = names
+        self.table = table
+        self.nchannels = nchannels
+        self.attrs = dict() if attrs is None else attrs
+
+        self._ids = None
+        self._bounds = None
+
+    @classmethod
+    def build(cls, filepath, root):
+        """ Read the index by walking all the datasets under `root` in the file. """
+        root = H5_FILES_POOL.get(filepath)[root]
+
+        names = []
+
+        def _visit(name, obj):
+            if isinstance(obj, h.Dataset):
+                names.append(name)
+
+        root.visititems(_visit)
+        names = sorted(names)
+
+        tables = []
+        nchannels = np.zeros(len(names), dtype=np.int64)
+        for i, name in enumerate(names):
+            d = root[name]
+            totlen = d.shape[0]
+            chunksize = d.chunks[0] if d.chunks else max(totlen, 1)
+            nchannels[i] = d.shape[-1] if len(d.shape) >= 3 else 0
+
+            t = np.zeros(-(-totlen // chunksize), dtype=CHUNK_INDEX_DTYPE)
+            t['dataset'] = i
+            t['start'] = np.arange(0, totlen, chunksize)
+            t['end'][:-1] = t['start'][1:]
+            t['end'][-1:] = totlen
+            tables.append(t)
+
+        table = np.concatenate(tables) if tables else np.zeros(0, CHUNK_INDEX_DTYPE)
+        attrs = {
+            k: v
+            for k, v in root.attrs.items()
+            if np.ndim(v) == 0 and np.issubdtype(np.asarray(v).dtype, np.number)
+        }  # only numeric scalars are kept
+        return cls(root.name, names, table, nchannels, attrs)
+
+    @staticmethod
+    def sidecar_path(filepath, root):
+        return "{}.{}.chunkindex.npz".format(filepath, root.strip('/').replace('/', '_'))
+
+    @classmethod
+    def _fingerprint(cls, filepath, root):
+        st = stat(filepath)
+        return "v{}|{}|{}|{}".format(cls.VERSION, root, st.st_size, st.st_mtime)
+
+    def save(self, path, fingerprint):
+        tmppath = "{}.{}.tmp".format(path, getpid())
+        with open(tmppath, 'wb') as f:
+            np.savez(
+                f,
+                fingerprint=np.array(fingerprint),
+                root=np.array(self.root),
+                names=np.array(self.names, dtype=np.unicode_),
+                table=self.table,
+                nchannels=self.nchannels,
+                attrkeys=np.array(list(self.attrs.keys()), dtype=np.unicode_),
+                attrvalues=np.array(list(self.attrs.values()), dtype=np.float64),
+            )
+
+        replace_file(tmppath, path)  # atomically, for other processes reading it
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """ The index saved at `path`, or `None` if missing or `fingerprint` doesn't match. """
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                if str(z['fingerprint']) != fingerprint:
+                    return None
+
+                return cls(
+                    str(z['root']),
+                    [str(n) for n in z['names']],
+                    z['table'],
+                    z['nchannels'],
+                    dict(zip((str(k) for k in z['attrkeys']), z['attrvalues'].tolist())),
+                )
+        except (OSError, EOFError, BadZipFile, KeyError, ValueError):  # e.g. truncated
+            return None
+
+    @classmethod
+    def for_file(cls, filepath, root, persist=True):
+        """ The index for `root` in the HDF5 file at `filepath`.
+
+        Loaded from the sidecar if it is still valid, else read from the file, and
+        saved to the sidecar (if `persist`) for next time.
+        """
+        fingerprint = cls._fingerprint(filepath, root)
+        path = cls.sidecar_path(filepath, root)
+
+        index = cls.load(path, fingerprint) if persist else None
+        if index is None:
+            index = cls.build(filepath, root)
+
+            if persist:
+                try:
+                    index.save(path, fingerprint)
+                except OSError as e:
+                    warning("Could not save the chunk index to {}: {}".format(path, e))
+
+        return index
+
+    def _setup_lookup(self):
+        self._ids = {n: i for i, n in enumerate(self.names)}
+        self._bounds = np.searchsorted(
+            self.table['dataset'], np.arange(len(self.names) + 1), side='left'
+        )
+
+    def id_for(self, name):
+        """ Index of the dataset at `name` (relative to `root`) in `names`. """
+        if self._ids is None:
+            self._setup_lookup()
+
+        return self._ids[name]
+
+    def chunks_for(self, name):
+        """ Rows of `table` for the chunks of the dataset at `name` (relative to `root`). """
+        i = self.id_for(name)
+        return self.table[self._bounds[i]:self._bounds[i + 1]]
+
+    def totlen_for(self, name):
+        chunks = self.chunks_for(name)
+        return int(chunks['end'][-1]) if len(chunks) > 0 else 0
+
+    def chunks_for_all(self, names):
+        """ Rows of `table` for the chunks of all datasets at `names`, in that order. """
+        if self._ids is None:
+            self._setup_lookup()
+
+        ids = np.array([self._ids[n] for n in names], dtype=np.int64)
+        firsts = self._bounds[ids]
+        counts = self._bounds[ids + 1] - firsts
+
+        # row indices of each dataset's chunks, one after the other
+        offsets = firsts - (counts.cumsum() - counts)
+        rows = np.arange(counts.sum()) + np.repeat(offsets, counts)
+        return self.table[rows]
+
+    @property
+    def chunk_lens(self):
+        """ Number of rows in the storage chunks of each dataset (per its first chunk). """
+        if self._bounds is None:
+            self._setup_lookup()
+
+        firsts = self._bounds[:-1]
+        nonempty = self._bounds[1:] > firsts
+        lens = np.ones(len(self.names), dtype=np.int64)
+        lens[nonempty] = (self.table['end'][firsts[nonempty]] -
+                          self.table['start'][firsts[nonempty]])
+        return np.maximum(lens, 1)
+
+    def read_units_for_all(self, names, read_chunk_len=None, overlap=0, context=0):
+        """ Like `chunks_for_all`, but with the storage chunks of each dataset grouped,
+        or split, into units of (at most) about `read_chunk_len` rows to be read at once.
+
+        Consecutive storage chunks are grouped as a whole, and split chunks are not
+        grouped again, so the units are always aligned to the storage chunks.
+
+        The first `overlap` rows of each storage chunk, but the first of a dataset,
+        should be the same as the last ones of the previous chunk (like those stored with
+        'chunk_overlap' for `ka3`). Of those, only `context` rows are kept at the start
+        of a unit, so that adding context to its rows doesn't miss any, and those within
+        grouped units are skipped by `ChunkingTable` (given `overlap` and `chunk_lens`).
+        Split units overlap each other by `context` rows for the same reason.
+        """
+        table = self.chunks_for_all(names)
+        if len(table) == 0:
+            return table
+
+        first = np.ones(len(table), dtype=np.bool_)
+        first[1:] = table['dataset'][1:] != table['dataset'][:-1]
+
+        if read_chunk_len is not None:
+            # group every k chunks of each dataset
+            k = np.maximum(read_chunk_len // self.chunk_lens[table['dataset']], 1)
+            i = np.arange(len(table))
+            pos = i - np.maximum.accumulate(np.where(first, i, 0))
+            unit = (pos % k) == 0
+            lasts = np.append(np.flatnonzero(unit)[1:], len(table)) - 1
+
+            ends = table['end'][lasts]
+            table, first = table[unit], first[unit]
+            table['end'] = ends
+
+        table['start'][~first] += max(overlap - context, 0)
+
+        lens = table['end'] - table['start']
+        if read_chunk_len is None or not (lens > read_chunk_len).any():
+            return table
+        elif read_chunk_len <= context:
+            raise ValueError(
+                "read_chunk_len should be more than the context, "
+                "{} v/s {}".format(read_chunk_len, context)
+            )
+
+        # split into n pieces each, with `context` rows common between consecutive ones
+        n = np.where(lens > read_chunk_len,
+                     -(-(lens - context) // (read_chunk_len - context)), 1)
+        step = np.repeat(-(-(lens - context) // n), n)
+        pieces = np.repeat(table, n)
+        pieces['start'] += (np.arange(len(pieces)) - np.repeat(n.cumsum() - n, n)) * step
+        pieces['end'] = np.minimum(pieces['start'] + step + context, pieces['end'])
+        return pieces
+
+
+class ChunkingTable(object):
+    """ Columnar table of chunkings, behaving like a (read-only) list of `Chunking`s.
+
+    Each row has the id of its dataset (`dataset`), with which its data and label paths
+    are looked up in `datapaths` and `labelpaths`, and the `start` and `end` of the chunk
+    along the first axis of both. `swap` is used as `swapchannels` if `chunking_cls` has
+    such a field.
+
+    Indexing with an integer gives a `chunking_cls` instance, and with a slice, mask or
+    array of indices gives another `ChunkingTable` sharing the paths.
+    Rows for datasets can be picked in a vectorized way with `for_datapaths`.
+
+    If the first `overlap` rows of the storage chunks of the datasets repeat the last
+    rows of the previous ones (check `H5ChunkIndex.read_units_for_all`), they are
+    skipped where a chunk spans the boundaries of the storage chunks (multiples of the
+    `storage_lens` of its dataset). The slices of such chunks are arrays of the rows.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            datapaths,
+            labelpaths,
+            dataset,
+            start,
+            end,
+            swap=None,
+            chunking_cls=Chunking,
+            overlap=0,
+            storage_lens=None):
+        self.datapaths = tuple(datapaths)
+        self.labelpaths = tuple(labelpaths)
+        self.dataset = np.asarray(dataset, dtype=np.int32)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.swap = (
+            np.zeros(len(self.dataset), dtype=np.bool_)
+            if swap is None else np.asarray(swap, dtype=np.bool_)
+        )
+        self.chunking_cls = chunking_cls
+        self._has_swap = 'swapchannels' in chunking_cls._fields
+
+        self.overlap = overlap
+        self.storage_lens = (
+            None if storage_lens is None else np.asarray(storage_lens, dtype=np.int64)
+        )
+
+    @classmethod
+    def from_index_table(  # pylint: disable=too-many-arguments
+            cls,
+            datapaths,
+            labelpaths,
+            table,
+            chunking_cls=Chunking,
+            overlap=0,
+            storage_lens=None):
+        """ From a structured array with `CHUNK_INDEX_DTYPE`, like `H5ChunkIndex.table`. """
+        return cls(
+            datapaths,
+            labelpaths,
+            table['dataset'],
+            table['start'],
+            table['end'],
+            table['swap'],
+            chunking_cls=chunking_cls,
+            overlap=overlap,
+            storage_lens=storage_lens,
+        )
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def nseams(self):
+        """ Number of storage chunk boundaries within each chunk, after which `overlap`
+        rows are skipped.
+        """
+        if self.overlap == 0 or self.storage_lens is None:
+            return np.zeros(len(self), dtype=np.int64)
+
+        lens = self.storage_lens[self.dataset]
+        return np.maximum((self.end - 1) // lens - self.start // lens, 0)
+
+    @property
+    def lengths(self):
+        """ Number of rows in each chunk. """
+        return self.end - self.start - self.overlap * self.nseams
+
+    def _rows(self, i):
+        s, e = int(self.start[i]), int(self.end[i])
+        if self.overlap > 0 and self.storage_lens is not None:
+            n = int(self.storage_lens[self.dataset[i]])
+            seams = np.arange((s // n + 1) * n, e, n)
+            if len(seams) > 0:
+                return _concatenated_ranges(
+                    np.append(s, seams + self.overlap), np.append(seams, e)
+                )
+
+        return np.s_[s:e, ...]
+
+    def _chunking(self, i):
+        d = self.dataset[i]
+        rows = self._rows(i)
+        kw = dict(
+            datapath=self.datapaths[d],
+            dataslice=rows,
+            labelpath=self.labelpaths[d],
+            labelslice=rows,
+        )
+        if self._has_swap:
+            kw['swapchannels'] = bool(self.swap[i])
+
+        return self.chunking_cls(**kw)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self._chunking(idx)
+
+        return self.__class__(
+            self.datapaths,
+            self.labelpaths,
+            self.dataset[idx],
+            self.start[idx],
+            self.end[idx],
+            self.swap[idx],
+            chunking_cls=self.chunking_cls,
+            overlap=self.overlap,
+            storage_lens=self.storage_lens,
+        )
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self._chunking(i)
+
+    def where(self, mask):
+        """ Rows where the boolean `mask` is `True`. """
+        return self[np.asarray(mask, dtype=np.bool_)]
+
+    def for_datapaths(self, pattern):
+        """ Rows of datasets whose data path matches `pattern`.
+
+        `pattern` can be a shell-style wildcard (check `fnmatch`) like '*/groupid/*'
+        or '*/callid', a collection of data paths, or a function returning `bool` for a
+        data path. It is only checked once per dataset, and the rows are then picked in
+        a vectorized way.
+        """
+        if callable(pattern):
+            keep = [pattern(p) for p in self.datapaths]
+        elif isinstance(pattern, string_types):
+            keep = [fnmatchcase(p, pattern) for p in self.datapaths]
+        else:
+            pattern = set(pattern)
+            keep = [p in pattern for p in self.datapaths]
+
+        return self.where(np.array(keep, dtype=np.bool_)[self.dataset])
+
+
+# IN-MEMORY CACHE ########################################### IN-MEMORY CACHE #
+
+
+class PreppedChunksCache(object):
+    """ Prepped data and labels of chunks, kept in memory in two contiguous buffers,
+    with the rows of the chunk at `chunkidx` starting at `offsets[chunkidx]`.
+
+    `chunk_lengths` are the (maximum) number of rows of each chunk, for which space is
+    kept in the buffers. The buffers are allocated when the first chunk is `put`, with
+    as many of the rows as fit in `max_nbytes`. Chunks that do not fit (or whose prepped
+    data and labels have more, or different numbers of, rows) are not cached, and have
+    to be read again.
+
+    The cached arrays are returned as read-only views.
+    """
+
+    def __init__(self, chunk_lengths, max_nbytes):
+        self.offsets = np.concatenate([[0], np.cumsum(chunk_lengths)]).astype(np.int64)
+        self.max_nbytes = max_nbytes
+
+        self.data = None
+        self.label = None
+        self.cached = np.zeros(len(chunk_lengths), dtype=np.bool_)
+        self.lengths = np.zeros(len(chunk_lengths), dtype=np.int64)
+
+        self.nhits = 0
+        self.nmisses = 0
+        self._lock = RLock()
+
+    @property
+    def nbytes(self):
+        if self.data is None:
+            return 0
+
+        return self.data.nbytes + self.label.nbytes
+
+    @property
+    def complete(self):
+        """ Whether all the chunks with rows are cached. """
+        return bool(np.all(self.cached | (np.diff(self.offsets) == 0)))
+
+    def _allocate(self, data, label):
+        row_nbytes = max((data.nbytes + label.nbytes) // len(data), 1)
+        nrows = int(min(self.offsets[-1], self.max_nbytes // row_nbytes))
+
+        self.data = np.empty((nrows, ) + data.shape[1:], dtype=data.dtype)
+        self.label = np.empty((nrows, ) + label.shape[1:], dtype=label.dtype)
+
+    def _fits(self, end, data, label):
+        return (end <= len(self.data) and data.shape[1:] == self.data.shape[1:]
+                and label.shape[1:] == self.label.shape[1:]
+                and data.dtype == self.data.dtype and label.dtype == self.label.dtype)
+
+    def put(self, chunkidx, data, label):
+        """ Cache the prepped `data` and `label` of the chunk at `chunkidx`, if it fits.
+        Returns whether it was cached.
+        """
+        start, n = self.offsets[chunkidx], len(data)
+        if self.cached[chunkidx]:
+            return True
+        elif n == 0 or n != len(label) or start + n > self.offsets[chunkidx + 1]:
+            return False
+
+        with self._lock:
+            if self.data is None:
+                self._allocate(data, label)
+
+        if not self._fits(start + n, data, label):
+            return False
+
+        self.data[start:start + n] = data
+        self.label[start:start + n] = label
+        self.lengths[chunkidx] = n
+        self.cached[chunkidx] = True
+        return True
+
+    def get(self, chunkidx):
+        """ The cached (data, label) of the chunk at `chunkidx`, or `None`. """
+        if not self.cached[chunkidx]:
+            self.nmisses += 1
+            return None
+
+        self.nhits += 1
+        start = self.offsets[chunkidx]
+        end = start + self.lengths[chunkidx]
+        data, label = self.data[start:end], self.label[start:end]
+        data.flags.writeable = False
+        label.flags.writeable = False
+        return data, label
+
+    def clear(self):
+        self.data = None
+        self.label = None
+        self.cached[:] = False
+        self.lengths[:] = 0
+
+    def __getstate__(self):
+        # e.g. for prefetching processes, which start with an empty cache of their own
+        state = self.__dict__.copy()
+        state.update(
+            data=None,
+            label=None,
+            cached=np.zeros_like(self.cached),
+            lengths=np.zeros_like(self.lengths),
+        )
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = RLock()
+
+
+# READ BUFFERS ################################################# READ BUFFERS #
+
+_READ_ARENA_IDS = count()
+_PROCESS_READ_ARENAS = OrderedDict()  # the arenas of other processes, used in this one
+MAX_PROCESS_READ_ARENAS = 4
+
+
+def _process_read_arena(uid):
+    arena = _PROCESS_READ_ARENAS.pop(uid, None)
+    if arena is None:
+        arena = ReadArena(uid)
+
+    _PROCESS_READ_ARENAS[uid] = arena
+    while len(_PROCESS_READ_ARENAS) > MAX_PROCESS_READ_ARENAS:
+        _PROCESS_READ_ARENAS.popitem(last=False)
+
+    return arena
+
+
+class ReadArena(object):
+    """ Reusable buffers to read chunks into (like with `Dataset.read_direct`), instead
+    of allocating new arrays for every chunk.
+
+    Each thread has its own buffers, one for each `role` (e.g. 'data' or 'label'), dtype
+    and shape of rows, and each grows to fit the largest chunk read into it. Hence,
+    what is read is valid only until the next chunk is read for the same role by the
+    same thread.
+
+    When pickled (e.g. for prefetching processes), it is replaced by the arena of the
+    same `uid` in the receiving process, and hence, is reused there as well.
+    """
+
+    def __init__(self, uid=None):
+        self.uid = uid if uid is not None else (getpid(), next(_READ_ARENA_IDS))
+        self._local = local()
+
+        self.nallocs = 0
+        self.nbytes_allocated = 0
+
+    def __reduce__(self):
+        return _process_read_arena, (self.uid, )
+
+    def buffer(self, role, nrows, rowshape, dtype):
+        """ A C-contiguous array of `nrows` rows of `rowshape` and `dtype`. """
+        buffers = getattr(self._local, 'buffers', None)
+        if buffers is None:
+            buffers = self._local.buffers = dict()
+
+        key = (role, np.dtype(dtype).str, tuple(rowshape))
+        buf = buffers.get(key, None)
+        if buf is None or len(buf) < nrows:
+            buf = np.empty((nrows, ) + tuple(rowshape), dtype=dtype)
+            buffers[key] = buf
+
+            self.nallocs += 1
+            self.nbytes_allocated += buf.nbytes
+
+        return buf[:nrows]
+
+    def read(self, dataset, slc, role):
+        """ Read `dataset[slc]` into the buffer for `role`, if `slc` is a plain range
+        of rows, or an increasing array of rows. Otherwise, it is read as usual.
+        """
+        runs = _row_runs(slc)
+        if runs is None:
+            return dataset[slc]
+
+        stops = np.minimum(runs[1], dataset.shape[0])
+        starts = np.minimum(runs[0], stops)
+        out = self.buffer(role, int((stops - starts).sum()), dataset.shape[1:],
+                          dataset.dtype)
+        if len(out) > 0:
+            # like Dataset.read_direct, without the overheads of a general selection
+            space = dataset.id.get_space()
+            op = h.h5s.SELECT_SET
+            for start, stop in zip(starts.tolist(), stops.tolist()):
+                if stop > start:
+                    space.select_hyperslab(
+                        (start, ) + (0, ) * (out.ndim - 1),
+                        (stop - start, ) + out.shape[1:],
+                        op=op,
+                    )
+                    op = h.h5s.SELECT_OR
+
+            dataset.id.read(h.h5s.create_simple(out.shape), space, out)
+
+        return out
+
+
+# QUANTIZATION ################################################# QUANTIZATION #
+
+QUANTIZATION_SCALE_ATTR = 'quantization_scale'
+QUANTIZATION_OFFSET_ATTR = 'quantization_offset'
+
+
+def _quantization_axes(ndim):
+    # all but the bins, i.e. the rows, and the channels (the last axis, if >= 3 dims)
+    return (0, ndim - 1) if ndim >= 3 else (0, )
+
+
+def quantize(data, dtype='int8'):
+    """ `(stored, scale, offset)` to store `data` as `dtype`, 'int8' or 'float16'.
+
+    For 'int8', each bin (each index in the dimensions other than the first, and the
+    last for data with channels in it, i.e. with >= 3 dimensions) is scaled linearly
+    from its range of values to [-127, 127], such that `data ~ stored * scale + offset`.
+    The `scale` and `offset` have the same shape as the data without the first axis,
+    with 1 for the channels.
+
+    For 'float16', the data is just cast, and `scale` and `offset` are `None`.
+    """
+    dtype = np.dtype(dtype)
+    if dtype == np.float16:
+        return data.astype(np.float16), None, None
+    elif dtype != np.int8:
+        raise ValueError("dtype should be 'int8' or 'float16', v/s {}".format(dtype))
+
+    axes = _quantization_axes(data.ndim)
+    lo = data.min(axis=axes, keepdims=True).astype(np.float64)
+    hi = data.max(axis=axes, keepdims=True).astype(np.float64)
+
+    offset = (hi + lo) / 2
+    scale = (hi - lo) / 254
+    scale[scale == 0] = 1
+
+    stored = np.clip(np.rint((data - offset) / scale), -127, 127).astype(np.int8)
+    return stored, scale[0].astype(np.float32), offset[0].astype(np.float32)
+
+
+def dequantize(stored, scale=None, offset=None, out=None):
+    """ The float32 data for `stored` data, quantized with `scale` and `offset`.
+
+    `out` can be a float32 array to dequantize into.
+    """
+    if out is None:
+        out = np.empty(stored.shape, dtype=np.float32)
+
+    out[...] = stored
+    if scale is not None:
+        out *= scale
+        out += offset
+
+    return out
+
+
+def quantization_of(dataset):
+    """ `(scale, offset)` of the data stored in `dataset` as per `quantize`, `(None,
+    None)` if stored as float16, or `None` if not quantized.
+    """
+    attrs = dataset.attrs
+    if QUANTIZATION_SCALE_ATTR in attrs:
+        return (np.asarray(attrs[QUANTIZATION_SCALE_ATTR], dtype=np.float32),
+                np.asarray(attrs[QUANTIZATION_OFFSET_ATTR], dtype=np.float32))
+    elif dataset.dtype == np.float16:
+        return None, None
+
+    return None
+
+
+def write_quantized(group, name, data, dtype='int8', **kwargs):
+    """ Create the dataset `name` in `group` with `data` stored as `dtype` (check
+    `quantize`), with the `scale` and `offset` as its attributes.
+
+    `kwargs` are passed to `create_dataset`, e.g. for `chunks` and `compression`.
+    """
+    stored, scale, offset = quantize(data, dtype)
+    dataset = group.create_dataset(name, data=stored, **kwargs)
+    if scale is not None:
+        dataset.attrs[QUANTIZATION_SCALE_ATTR] = scale
+        dataset.attrs[QUANTIZATION_OFFSET_ATTR] = offset
+
+    return dataset
+
+
+def storage_kwargs_of(dataset):
+    """ kwargs for `create_dataset` to store data like in `dataset`, i.e. with the same
+    chunks, compression and other filters.
+    """
+    return dict(
+        chunks=dataset.chunks,
+        compression=dataset.compression,
+        compression_opts=dataset.compression_opts,
+        shuffle=dataset.shuffle,
+        fletcher32=dataset.fletcher32,
+    )
+
+
+def rewrite_h5_file(srcpath, dstpath, rewrite, root='audios'):
+    """ Copy the HDF5 file at `srcpath` to `dstpath`, with the float datasets under the
+    group `root` written by `rewrite(group, name, dataset)` instead, which should create
+    the dataset `name` in `group` from the source `dataset`, and return it.
+
+    The attributes of the groups and the rewritten datasets are kept.
+    """
+    root = '/' + root.strip('/')
+    with h.File(srcpath, 'r') as src, h.File(dstpath, 'w') as dst:
+
+        def _copy(name, obj):
+            path = '/' + name
+            if isinstance(obj, h.Group):
+                group = dst.require_group(path)
+                group.attrs.update(obj.attrs)
+            elif (path + '/').startswith(root + '/') and obj.dtype.kind == 'f':
+                dataset = rewrite(dst, path, obj)
+                for k, v in obj.attrs.items():
+                    dataset.attrs[k] = v
+            else:
+                src.copy(obj, dst, name=path)
+
+        dst.attrs.update(src.attrs)
+        src.visititems(_copy)
+
+
+def quantize_h5_file(srcpath, dstpath, root='audios', dtype='int8'):
+    """ Copy the HDF5 file at `srcpath` to `dstpath`, with the float datasets under the
+    group `root` stored as `dtype` (check `write_quantized`), keeping their chunks,
+    compression and attributes.
+    """
+
+    def _quantized(group, name, dataset):
+        return write_quantized(
+            group, name, dataset[()], dtype=dtype, **storage_kwargs_of(dataset)
+        )
+
+    rewrite_h5_file(srcpath, dstpath, _quantized, root=root)
+
+
 # PREPPERS ######################################################### PREPPERS #
 
 
+def _concatenated_ranges(starts, ends):
+    """ `np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])`, vectorized. """
+    lens = np.maximum(np.asarray(ends) - starts, 0)
+    return np.repeat(starts - np.cumsum(lens) + lens, lens) + np.arange(lens.sum())
+
+
+def _plain_rows(slc):
+    """ `(start, stop)` if `slc` is a plain range of rows like `np.s_[s:e, ...]`,
+    else `None`.
+    """
+    if isinstance(slc, tuple):
+        if not slc or any(r is not Ellipsis for r in slc[1:]):
+            return None
+
+        slc = slc[0]
+
+    if (not isinstance(slc, slice) or slc.step not in (None, 1) or slc.start is None
+            or slc.stop is None or slc.start < 0):
+        return None
+
+    return slc.start, slc.stop
+
+
+def _row_runs(slc):
+    """ `(starts, stops)` of the runs of consecutive rows in `slc`, if it is a plain range
+    of rows, or an increasing array of rows, else `None`.
+    """
+    rows = _plain_rows(slc)
+    if rows is not None:
+        return np.array(rows[:1], dtype=np.int64), np.array(rows[1:], dtype=np.int64)
+
+    if not isinstance(slc, np.ndarray) or slc.ndim != 1 or slc.dtype.kind not in 'iu':
+        return None
+
+    if len(slc) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    steps = np.diff(slc)
+    if slc[0] < 0 or (steps <= 0).any():
+        return None
+
+    breaks = np.flatnonzero(steps != 1) + 1
+    return slc[np.append(0, breaks)], slc[np.append(breaks - 1, len(slc) - 1)] + 1
+
+
+def _label_row_groups(chunkings):
+    """ `(labelpath, starts, ends)` of the rows of each run of consecutive `chunkings`
+    with the same label path, or `None` if any label slice is not a plain range of rows.
+    """
+    if isinstance(chunkings, ChunkingTable) and chunkings.nseams.any():
+        return None
+    elif isinstance(chunkings, ChunkingTable):
+        bounds, datasets = nu.group_by_values(chunkings.dataset)
+        return [(chunkings.labelpaths[d], chunkings.start[s:e], chunkings.end[s:e])
+                for (s, e), d in zip(bounds, datasets)]
+
+    groups = []
+    for chunking in chunkings:
+        rows = _plain_rows(chunking.labelslice)
+        if rows is None:
+            return None
+
+        if not groups or groups[-1][0] != chunking.labelpath:
+            groups.append((chunking.labelpath, [], []))
+
+        groups[-1][1].append(rows[0])
+        groups[-1][2].append(rows[1])
+
+    return [(path, np.array(starts, dtype=np.int64), np.array(ends, dtype=np.int64))
+            for path, starts, ends in groups]
+
+
 class BaseH5ChunkPrepper(object):
     """ Base class for reading and prepping data and labels from an HDF5 file chunkwise.
     It also implements shuffling of the data when a valid seed is provided.
 
     The purpose of this class to setup an expected API by other derived classes,
     and to carry out some of the computations that are actually not specilized.
+
+    When `prepped_cache` is set (to a `PreppedChunksCache`), the prepped data and label
+    of chunks are served from it when the chunk's `chunkidx` is known.
+
+    Data stored quantized (check `quantize`) is dequantized to float32 after reading.
+    Preppers that can do it themselves, e.g. fused with normalization, should set
+    `FUSES_DEQUANTIZATION`, and are then passed the stored data, and `quantization`
+    (the `(scale, offset)`) in the kwargs of `prep_data`.
+
+    When `label_indices` is set, `prep_label` should provide the class index of each
+    label (as `np.uint8`), instead of its categorical (one-hot) form.
     """
+    prepped_cache = None
+    label_indices = False
+    FUSES_DEQUANTIZATION = False
 
     def __init__(self, filepath, **kwargs):  # pylint: disable=unused-argument
         self.filepath = filepath
 
-    def read_h5_data_label_chunk(self, chunking, only_labels=False, **kwargs):  # pylint: disable=unused-argument
-        """ Read the data and label chunks from the HDF5 file. """
+    def read_h5_data_label_chunk(  # pylint: disable=unused-argument
+            self, chunking, only_labels=False, read_arena=None, **kwargs
+    ):  # yapf: disable
+        """ Read the data and label chunks from the HDF5 file (kept open in a pool).
 
-        with h.File(self.filepath, 'r') as f:
-            label = f[chunking.labelpath][chunking.labelslice]
-            if not only_labels:
-                data = f[chunking.datapath][chunking.dataslice]
-            else:
-                data = np.empty_like(label)
+        They are read into the buffers of `read_arena` (a `ReadArena`), if provided.
+        """
+        pool = H5_FILES_POOL
+
+        labels = pool.dataset(self.filepath, chunking.labelpath)
+        if read_arena is None:
+            label = labels[chunking.labelslice]
+        else:
+            label = read_arena.read(labels, chunking.labelslice, 'label')
+
+        if only_labels and read_arena is None:
+            data = np.empty_like(label)
+        elif only_labels:
+            data = read_arena.buffer('data', len(label), label.shape[1:], label.dtype)
+        elif read_arena is None:
+            data = pool.dataset(self.filepath, chunking.datapath)[chunking.dataslice]
+        else:
+            datas = pool.dataset(self.filepath, chunking.datapath)
+            data = read_arena.read(datas, chunking.dataslice, 'data')
 
         return data, label
 
@@ -139,15 +1102,69 @@ class BaseH5ChunkPrepper(object):
         Override the prep_data and prep_label methods to play with the data
         before it is provided as inputs.
         """
+        cache = self.prepped_cache
+        chunkidx = kwargs.get('chunkidx', None)
+        if cache is not None and chunkidx is not None:
+            cached = cache.get(chunkidx)
+            if cached is not None:
+                return cached
+
         data, label = self.read_h5_data_label_chunk(
             chunking, only_labels=only_labels, **kwargs
         )
 
-        return self.prep_data(
-            data, only_labels=only_labels, chunking=chunking, **kwargs
-        ), self.prep_label(
-            label, chunking=chunking, **kwargs
-        )
+        quantization = None if only_labels else self.quantization_for(chunking.datapath)
+        if quantization is not None and self.FUSES_DEQUANTIZATION:
+            kwargs['quantization'] = quantization
+        elif quantization is not None:
+            data = self.dequantize_data(data, quantization, **kwargs)
+
+        data = self.prep_data(data, only_labels=only_labels, chunking=chunking, **kwargs)
+        label = self.prep_label(label, chunking=chunking, **kwargs)
+
+        if cache is not None and chunkidx is not None and not only_labels:
+            cache.put(chunkidx, data, label)
+
+        return data, label
+
+    def quantization_for(self, datapath):
+        """ `quantization_of` the dataset at `datapath`, looked up once per dataset. """
+        quantizations = self.__dict__.setdefault('_quantizations', dict())
+        if datapath not in quantizations:
+            dataset = H5_FILES_POOL.dataset(self.filepath, datapath)
+            quantizations[datapath] = quantization_of(dataset)
+
+        return quantizations[datapath]
+
+    @staticmethod
+    def dequantize_data(data, quantization, read_arena=None, **kwargs):  # pylint: disable=unused-argument
+        """ Dequantize `data` with `quantization`, into the `read_arena`, if any. """
+        out = None
+        if read_arena is not None:
+            out = read_arena.buffer('dequantized', len(data), data.shape[1:], np.float32)
+
+        return dequantize(data, *quantization, out=out)
+
+    def prep_labels_in_bulk(self, label, starts, ends, **kwargs):
+        """ Prep the labels of the chunks from `starts` to `ends` (rows) of `label`
+        in one go. Returns them concatenated, and the number of them for each chunk.
+
+        NOTE: Assumes that prep_label preps each label independently of the others in
+        the chunk, as is the case for all the preppers here. Override otherwise.
+        """
+        label = self.prep_label(label, **kwargs)
+        return label[_concatenated_ranges(starts, ends)], ends - starts
+
+    def get_prepped_labels_in_bulk(self, labelpath, starts, ends, **kwargs):
+        """ Same as `prep_labels_in_bulk`, but reading the rows needed of the label
+        dataset at `labelpath` all at once. The data is never read.
+        """
+        dataset = H5_FILES_POOL.dataset(self.filepath, labelpath)
+        ends = np.minimum(ends, dataset.shape[0])
+        starts = np.minimum(starts, ends)
+
+        lo, hi = (starts.min(), ends.max()) if len(starts) > 0 else (0, 0)
+        return self.prep_labels_in_bulk(dataset[lo:hi], starts - lo, ends - lo, **kwargs)
 
 
 class AsIsChunkPrepper(BaseH5ChunkPrepper):
@@ -158,28 +1175,92 @@ class AsIsChunkPrepper(BaseH5ChunkPrepper):
         return label
 
 
+def _sliding_frames(windows):
+    """ The frames of which `windows` (n, w, ...) are the consecutive windows, stepping
+    one frame at a time (like the strided views in `BaseWithContextPrepper`), else `None`.
+    """
+    if windows.ndim != 3 or len(windows) == 0 or windows.shape[1] < 2:
+        return None  # not worth it for single frames
+    elif windows.strides[0] != windows.strides[1]:
+        return None
+
+    return np.concatenate([windows[:, 0], windows[-1, 1:]])
+
+
+def _sliding_sums(frames, win):
+    """ Sums of each `win` consecutive `frames`, in O(1) each, with prefix sums. """
+    acc = np.int64 if frames.dtype.kind in 'biu' else np.float64
+    prefix = np.zeros((len(frames) + 1, ) + frames.shape[1:], dtype=acc)
+    np.cumsum(frames, axis=0, out=prefix[1:])
+    return prefix[win:] - prefix[:-win]
+
+
+def _are_class_indices(labels_in_subcontext):
+    # (n, w) class indices, v/s (n, w, nclasses) categorical labels
+    return labels_in_subcontext.ndim == 2 and labels_in_subcontext.dtype.kind in 'iu'
+
+
+def _class_index_counts(labels_in_subcontext):
+    # number of each class index in each subcontext, and the number of classes seen
+    nclasses = int(labels_in_subcontext.max()) + 1 if labels_in_subcontext.size else 1
+    frames = _sliding_frames(labels_in_subcontext)
+    if frames is None:
+        onehot = nu.to_categorical(labels_in_subcontext, nclasses, dtype=np.uint8)
+        return onehot.sum(axis=-2), nclasses
+
+    onehot = nu.to_categorical(frames, nclasses, dtype=np.uint8)
+    return _sliding_sums(onehot, labels_in_subcontext.shape[1]), nclasses
+
+
 def dominant_label_for_subcontext(labels_in_subcontext):
-    # nclasses = labels_in_subcontext.shape[-1]
-    # nperclass_subcontext = labels_in_subcontext.sum(axis=axis)
-    # dominant_subcontext = nperclass_subcontext.argmax(-1)  # last axis is that of class
-    # categorical = nu.to_categorical(dominant_subcontext, nclasses=nclasses)
-    # return categorical
-    return nu.to_categorical(
-        labels_in_subcontext.sum(axis=-2).argmax(axis=-1),
-        nclasses=labels_in_subcontext.shape[-1]
-    )
+    """ Categorical label of the class with the most labels in each subcontext, or its
+    class index, for labels that are class indices.
+
+    For the consecutive windows of frames, the labels in each are counted with prefix
+    sums, i.e. without reducing over every window.
+    """
+    if _are_class_indices(labels_in_subcontext):
+        if labels_in_subcontext.shape[1] == 1:
+            return labels_in_subcontext[:, 0].copy()
+
+        counts, _ = _class_index_counts(labels_in_subcontext)
+        return counts.argmax(axis=-1).astype(labels_in_subcontext.dtype)
+
+    nclasses = labels_in_subcontext.shape[-1]
+    frames = _sliding_frames(labels_in_subcontext)
+    if frames is None:
+        nperclass = labels_in_subcontext.sum(axis=-2)
+    else:
+        nperclass = _sliding_sums(frames, labels_in_subcontext.shape[1])
+
+    return nu.to_categorical(nperclass.argmax(axis=-1), nclasses=nclasses)
 
 
 def max_label_for_subcontext(labels_in_subcontext):
-    # nclasses = labels_in_subcontext.shape[-1]
-    # labels_subcontext_noncat = labels_in_subcontext.argmax(axis=-1)
-    # max_label_subcontext_noncat = labels_subcontext_noncat.max(axis=-1)
-    # categorical = nu.to_categorical(max_label_for_subcontext, nclasses=nclasses)
-    # return categorical
-    return nu.to_categorical(
-        labels_in_subcontext.argmax(axis=-1).max(axis=-1),
-        nclasses=labels_in_subcontext.shape[-1]
-    )
+    """ Categorical label of the largest class with a label in each subcontext, or its
+    class index, for labels that are class indices.
+
+    For the consecutive windows of frames, the classes present in each are found with
+    prefix sums, i.e. without reducing over every window.
+    """
+    if _are_class_indices(labels_in_subcontext):
+        if _sliding_frames(labels_in_subcontext) is None:
+            return labels_in_subcontext.max(axis=-1)
+
+        counts, nclasses = _class_index_counts(labels_in_subcontext)
+        maxlabel = nclasses - 1 - (counts[:, ::-1] > 0).argmax(axis=-1)
+        return maxlabel.astype(labels_in_subcontext.dtype)
+
+    nclasses = labels_in_subcontext.shape[-1]
+    frames = _sliding_frames(labels_in_subcontext)
+    if frames is None:
+        maxlabel = labels_in_subcontext.argmax(axis=-1).max(axis=-1)
+    else:
+        onehot = nu.to_categorical(frames.argmax(axis=-1), nclasses, dtype=np.uint8)
+        present = _sliding_sums(onehot, labels_in_subcontext.shape[1]) > 0
+        maxlabel = nclasses - 1 - present[:, ::-1].argmax(axis=-1)
+
+    return nu.to_categorical(maxlabel, nclasses=nclasses)
 
 
 class BaseWithContextPrepper(BaseH5ChunkPrepper):  # pylint: disable=abstract-method
@@ -219,8 +1300,9 @@ class BaseWithContextPrepper(BaseH5ChunkPrepper):  # pylint: disable=abstract-me
 
         if self.dctx > 0:
             # no context adding for either data or label
-            if not only_labels:
-                data = nu.strided_view(data, win_shape=self.win, step_shape=self.stp)
+            # NOTE: the dummy data, if only_labels, is also strided (as a view), so that
+            # it has as many rows as the labels, and they are stepped through alike.
+            data = nu.strided_view(data, win_shape=self.win, step_shape=self.stp)
 
             label = nu.strided_view(label, win_shape=self.win, step_shape=self.stp)
 
@@ -235,6 +1317,20 @@ class BaseWithContextPrepper(BaseH5ChunkPrepper):  # pylint: disable=abstract-me
 
         return (data[..., None], label) if self.add_channel else (data, label)
 
+    def prep_labels_in_bulk(self, label, starts, ends, **kwargs):
+        label = self.prep_label(label, **kwargs)
+
+        # the windows starting within each chunk, that also end within it
+        ends = np.maximum(ends - 2 * self.dctx, starts)
+        if self.dctx > 0:
+            label = nu.strided_view(label, win_shape=self.win, step_shape=self.stp)
+            label = label[:, self.dctx - self.lctx:self.dctx + self.lctx + 1, ...]
+        else:
+            label = label[:, np.newaxis, ...]
+
+        # reduced for all the windows first, to not copy each when picking them
+        return self.lctxfn(label)[_concatenated_ranges(starts, ends)], ends - starts
+
 
 # NORMALIZERS ################################################### NORMALIZERS #
 
@@ -246,31 +1342,779 @@ class BaseDataNormalizer(BaseH5ChunkPrepper):
         )
 
     def prep_data(self, data, only_labels=False, **kwargs):
-        # This is dummy data, if only_labels
-        return data if only_labels else self.normalize_data(data, **kwargs)
+        # This is dummy data, if only_labels. Else, it is just read, and can be changed.
+        return data if only_labels else self.normalize_data(data, in_place=True, **kwargs)
+
+
+class ChunkStats(object):
+    """ Mean and standard deviation (along the first axis) of the data of chunks in an
+    HDF5 file, with a row per chunk, keyed by its dataset (`datapaths[dataset]`), and the
+    `start` and `end` of its rows. `std` is that of the data after removing the mean.
+
+    Since the data doesn't change, `for_chunkings` persists them in a sidecar file next
+    to the HDF5 file (like `H5ChunkIndex`), and only computes those of chunks missing
+    from it.
+    """
+    VERSION = 1
+
+    def __init__(self, datapaths, dataset, start, end, mean, std):  # pylint: disable=too-many-arguments
+        self.datapaths = tuple(datapaths)
+        self.dataset = np.asarray(dataset, dtype=np.int32)
+        self.start = np.asarray(start, dtype=np.int64)
+        self.end = np.asarray(end, dtype=np.int64)
+        self.mean = mean
+        self.std = std
+
+        self._rows = None
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def keys(self):
+        return [(self.datapaths[d], s, e)
+                for d, s, e in zip(self.dataset, self.start.tolist(), self.end.tolist())]
+
+    def row_for(self, datapath, start, end):
+        """ The row for the chunk of rows `start:end` of `datapath`, or `None`. """
+        if self._rows is None:
+            self._rows = {k: i for i, k in enumerate(self.keys)}
+
+        return self._rows.get((datapath, start, end), None)
+
+    def stats_for(self, chunking):
+        """ `(mean, std)` for the data of `chunking`, or `None` if not available. """
+        rows = _plain_rows(chunking.dataslice)
+        i = None if rows is None else self.row_for(chunking.datapath, *rows)
+        if i is None:
+            return None
+
+        return self.mean[i], self.std[i]
+
+    @classmethod
+    def build(cls, filepath, keys):
+        """ Compute the stats of the chunks at `keys`, a list of (datapath, start, end).
+
+        Each dataset is read once. Empty chunks are skipped.
+        """
+        bydataset = OrderedDict()
+        for datapath, start, end in keys:
+            bydataset.setdefault(datapath, []).append((start, end))
+
+        datapaths, dataset, starts, ends, means, stds = [], [], [], [], [], []
+        for d, (datapath, rows) in enumerate(bydataset.items()):
+            datapaths.append(datapath)
+            lo = min(r[0] for r in rows)
+            h5data = H5_FILES_POOL.dataset(filepath, datapath)
+            data = h5data[lo:max(r[1] for r in rows)]
+
+            quantization = quantization_of(h5data)
+            if quantization is not None:
+                data = dequantize(data, *quantization)
+
+            for start, end in rows:
+                chunk = data[start - lo:end - lo]
+                if len(chunk) == 0:
+                    continue
+
+                # exactly as BaseChunkMeanVarianceNormalizer would for the chunk
+                mean = chunk.mean(axis=0)
+                dataset.append(d)
+                starts.append(start)
+                ends.append(end)
+                means.append(mean)
+                stds.append((chunk - mean).std(axis=0))
+
+        if not means:
+            return cls(datapaths, [], [], [], np.zeros((0, )), np.zeros((0, )))
+
+        return cls(datapaths, dataset, starts, ends, np.stack(means), np.stack(stds))
+
+    def merged(self, other):
+        """ Stats of the chunks in both, `self` and `other`, assumed to be disjoint. """
+        if len(self) == 0:
+            return other
+        elif len(other) == 0:
+            return self
+
+        datapaths = list(self.datapaths)
+        ids = {p: i for i, p in enumerate(datapaths)}
+        for p in other.datapaths:
+            if p not in ids:
+                ids[p] = len(datapaths)
+                datapaths.append(p)
+
+        remap = np.array([ids[p] for p in other.datapaths], dtype=np.int32)
+        return self.__class__(
+            datapaths,
+            np.concatenate([self.dataset, remap[other.dataset]]),
+            np.concatenate([self.start, other.start]),
+            np.concatenate([self.end, other.end]),
+            np.concatenate([self.mean, other.mean]),
+            np.concatenate([self.std, other.std]),
+        )
+
+    @staticmethod
+    def sidecar_path(filepath):
+        return "{}.chunkstats.npz".format(filepath)
+
+    @classmethod
+    def _fingerprint(cls, filepath):
+        st = stat(filepath)
+        return "v{}|{}|{}".format(cls.VERSION, st.st_size, st.st_mtime)
+
+    def save(self, path, fingerprint):
+        tmppath = "{}.{}.tmp".format(path, getpid())
+        with open(tmppath, 'wb') as f:
+            np.savez(
+                f,
+                fingerprint=np.array(fingerprint),
+                datapaths=np.array(self.datapaths, dtype=np.unicode_),
+                dataset=self.dataset,
+                start=self.start,
+                end=self.end,
+                mean=self.mean,
+                std=self.std,
+            )
+
+        replace_file(tmppath, path)  # atomically, for other processes reading it
+
+    @classmethod
+    def load(cls, path, fingerprint):
+        """ The stats saved at `path`, or `None` if missing or `fingerprint` differs. """
+        try:
+            with np.load(path, allow_pickle=False) as z:
+                if str(z['fingerprint']) != fingerprint:
+                    return None
+
+                return cls(
+                    [str(p) for p in z['datapaths']],
+                    z['dataset'],
+                    z['start'],
+                    z['end'],
+                    z['mean'],
+                    z['std'],
+                )
+        except (OSError, EOFError, BadZipFile, KeyError, ValueError):  # e.g. truncated
+            return None
+
+    @classmethod
+    def for_chunkings(cls, filepath, chunkings, sidecar=None, persist=True):
+        """ The stats for the data of `chunkings` (with plain ranges of rows) in the
+        HDF5 file at `filepath`.
+
+        Loaded from the `sidecar` (by default, at `sidecar_path`) if it is still valid,
+        and the missing ones are computed, and saved to it (if `persist`) for next time.
+        """
+        if isinstance(chunkings, ChunkingTable):
+            chunkings = chunkings.where(chunkings.nseams == 0)
+            keys = [(chunkings.datapaths[d], s, e) for d, s, e in zip(
+                chunkings.dataset, chunkings.start.tolist(), chunkings.end.tolist())]
+        else:
+            keys = [(c.datapath, ) + _plain_rows(c.dataslice)
+                    for c in chunkings if _plain_rows(c.dataslice) is not None]
+
+        fingerprint = cls._fingerprint(filepath)
+        path = cls.sidecar_path(filepath) if sidecar is None else sidecar
+
+        stats = cls.load(path, fingerprint) if persist else None
+        if stats is None:
+            stats = cls([], [], [], [], np.zeros((0, )), np.zeros((0, )))
+
+        missing = sorted(set(k for k in keys if stats.row_for(*k) is None))
+        if missing:
+            stats = stats.merged(cls.build(filepath, missing))
+
+            if persist:
+                try:
+                    stats.save(path, fingerprint)
+                except OSError as e:
+                    warning("Could not save the chunk stats to {}: {}".format(path, e))
+
+        return stats
 
 
 class BaseChunkMeanVarianceNormalizer(BaseDataNormalizer):  # pylint: disable=abstract-method
-    def __init__(self, filepath, mean_it=True, std_it=False, **k):
+    """ Normalizes the data of each chunk to zero mean (`mean_it`) and/or unit standard
+    deviation (`std_it`).
+
+    With `precomputed_stats`, the mean and std of each chunk are computed only once, and
+    kept in a sidecar file (check `ChunkStats`), instead of in every pass. Pass a path
+    to keep them somewhere other than next to the HDF5 file.
+    NOTE: the chunkings of the inputs provider are needed for this.
+
+    Quantized data (check `quantize`) is dequantized and normalized in one go.
+    """
+    FUSES_DEQUANTIZATION = True
+
+    def __init__(
+            self, filepath, mean_it=True, std_it=False, precomputed_stats=False, **k
+    ):  # yapf: disable
         self.mean_it = mean_it
         self.std_it = std_it
+        self.precomputed_stats = precomputed_stats
+        self._chunk_stats = None
         super(BaseChunkMeanVarianceNormalizer, self).__init__(filepath, **k)
 
-    def normalize_data(self, data, **kwargs):
+    def _chunkings_for_stats(self):
+        chunkings = getattr(self, 'chunkings', None)
+        if chunkings is None:
+            raise TypeError(
+                "precomputed_stats need the chunkings of a BaseH5ChunkingsReader, "
+                "which {} is not".format(self.__class__.__name__)
+            )
+
+        return chunkings
+
+    @property
+    def chunk_stats(self):
+        if self._chunk_stats is None:
+            sidecar = None if self.precomputed_stats is True else self.precomputed_stats
+            self._chunk_stats = ChunkStats.for_chunkings(
+                self.filepath, self._chunkings_for_stats(), sidecar=sidecar
+            )
+
+        return self._chunk_stats
+
+    def stats_for_chunking(self, chunking):
+        """ Precomputed `(mean, std)` for the data of `chunking`, or `None`. """
+        if not self.precomputed_stats or chunking is None:
+            return None
+
+        return self.chunk_stats.stats_for(chunking)
+
+    def normalize_data(  # pylint: disable=arguments-differ
+            self, data, chunking=None, in_place=False, quantization=None, **kwargs
+    ):  # yapf: disable
+        stats = self.stats_for_chunking(chunking) if self.mean_it or self.std_it else None
+        if quantization is not None:
+            return self._dequantize_normalize(data, quantization, stats, **kwargs)
+
+        # e.g. on the data just read, instead of allocating new arrays
+        in_place = in_place and data.flags.writeable and data.dtype.kind == 'f'
+        out = data if in_place else None
+
         if self.mean_it:
-            data = data - data.mean(axis=0)
+            mean = data.mean(axis=0) if stats is None else stats[0]
+            data = np.subtract(data, mean, out=out)
 
         if self.std_it:
-            data = data / data.std(axis=0)
+            std = data.std(axis=0) if stats is None else stats[1]
+            data = np.divide(data, std, out=out)
 
         return data
 
+    def _dequantize_normalize(self, stored, quantization, stats, **kwargs):
+        # (stored * scale + offset - mean) / std == stored * a + b
+        data = self.dequantize_data(stored, (None, None), **kwargs)  # only cast
+        scale, offset = quantization
+        if scale is None:  # float16
+            scale, offset = np.float32(1), np.float32(0)
+
+        mean, std = (None, None) if stats is None else stats
+        if self.mean_it and mean is None:
+            mean = data.mean(axis=0) * scale + offset
+
+        if self.std_it and std is None:
+            std = data.std(axis=0) * scale
+
+        denom = std if self.std_it else np.float32(1)
+        data *= scale / denom
+        data += (offset - mean if self.mean_it else offset) / denom
+        return data
+
+    def prepare_for_prefetching(self):
+        sup = super(BaseChunkMeanVarianceNormalizer, self)
+        if hasattr(sup, 'prepare_for_prefetching'):
+            sup.prepare_for_prefetching()
+
+        if self.precomputed_stats:
+            _ = self.chunk_stats
+
+
+# SEED SCHEDULES ############################################# SEED SCHEDULES #
+
+
+def rng_for_seed(seed, seeding='philox'):
+    """ An independent random number generator, seeded with `seed`.
+
+    With `seeding='legacy'`, a `numpy.random.RandomState` is returned, which produces
+    exactly the same numbers as seeding numpy's global RNG with `seed` would have.
+    Otherwise, a `numpy.random.Generator` backed by Philox is returned.
+
+    Neither touches the global RNG, and hence, can be used from multiple threads.
+    """
+    if seeding == 'legacy':
+        return nr.RandomState(seed)
+
+    return nr.Generator(nr.Philox(seed))
+
+
+def randseeds_from(rng, n):
+    """ `n` integer seeds from `rng` made by `rng_for_seed`. """
+    if isinstance(rng, nr.RandomState):
+        return rng.randint(ChunkSeedSchedule.MAX_SEED, size=n)
+
+    return rng.integers(ChunkSeedSchedule.MAX_SEED, size=n)
+
+
+class ChunkSeedSchedule(object):
+    """ Order of chunks, and the shuffling seed for each chunk, for every pass.
+
+    Everything is derived lazily from a counter-based RNG (Philox) keyed on
+    `shuffle_seed`, with the pass index (and what is being derived) in the counter.
+    Hence, any pass can be computed directly, without computing (or storing) the ones
+    before it, and the values only depend on `shuffle_seed`, `npasses` and `nchunks`.
+
+    Only the raw bits from Philox are used (and not, e.g., `Generator.permutation`),
+    so that the schedule is bit-reproducible across numpy versions.
+
+    Only the arrays for the most recently requested pass are kept in memory.
+    """
+    MAX_SEED = 41184535
+    _ORDER_STREAM = 0
+    _SEEDS_STREAM = 1
+
+    def __init__(self, shuffle_seed, npasses, nchunks):
+        self.shuffle_seed = shuffle_seed
+        self.npasses = npasses
+        self.nchunks = nchunks
+
+        self._cached = (None, None, None)  # (pass, order, seeds)
+
+    def _raw_for_pass(self, p, stream):
+        bitgen = nr.Philox(key=self.shuffle_seed, counter=[0, p, stream, 0])
+        return bitgen.random_raw(self.nchunks)
+
+    def _for_pass(self, p):
+        cached = self._cached
+        if cached[0] != p:
+            if not 0 <= p < self.npasses:
+                raise IndexError(
+                    "pass {} out of range for npasses {}".format(p, self.npasses)
+                )
+
+            order = np.argsort(self._raw_for_pass(p, self._ORDER_STREAM), kind='mergesort')
+            seeds = (self._raw_for_pass(p, self._SEEDS_STREAM) % self.MAX_SEED)
+            cached = (p, order, seeds.astype(np.int64))
+
+            # assigned at once, cuz there may be more than one thread
+            self._cached = cached
+
+        return cached
+
+    def chunk_order(self, p):
+        """ Order in which the chunks are to be read in pass `p`. """
+        return self._for_pass(p)[1]
+
+    def seed_for_chunk(self, p, chunkidx):
+        """ Shuffling seed for the chunk at index `chunkidx` (in `chunkings`) in pass `p`. """
+        return int(self._for_pass(p)[2][chunkidx])
+
+
+# PREFETCHING ################################################### PREFETCHING #
+
+
+class PrefetchStats(object):
+    """ How much the consumer of a prefetched flow had to wait, and how far ahead
+    the workers were, each time the next chunk was requested.
+    """
+
+    def __init__(self):
+        self.nchunks = 0
+        self.stall_secs = 0.
+        self.max_stall_secs = 0.
+        self.total_depth = 0  # sum of number of chunks ready when one was requested
+        self.max_depth = 0
+        self.nspilled = 0  # chunks too large for shared memory, and were pickled instead
+
+    def record(self, depth, stall_secs):
+        self.nchunks += 1
+        self.stall_secs += stall_secs
+        self.max_stall_secs = max(self.max_stall_secs, stall_secs)
+        self.total_depth += depth
+        self.max_depth = max(self.max_depth, depth)
+
+    @property
+    def mean_depth(self):
+        return self.total_depth / max(self.nchunks, 1)
+
+    @property
+    def mean_stall_secs(self):
+        return self.stall_secs / max(self.nchunks, 1)
+
+    def __str__(self):
+        s = (
+            "chunks: {} | stalled: {:.3f}s total, {:.3f}s mean, {:.3f}s max "
+            "| ready in queue: {:.2f} mean, {} max".format(
+                self.nchunks, self.stall_secs, self.mean_stall_secs,
+                self.max_stall_secs, self.mean_depth, self.max_depth
+            )
+        )  # yapf: disable
+        if self.nspilled > 0:
+            s += " | spilled: {}".format(self.nspilled)
+
+        return s
+
+
+_PREFETCH_PROVIDER = None  # set in each worker process of a ChunkPrefetcher
+
+
+def _init_prefetch_worker(provider):
+    global _PREFETCH_PROVIDER  # pylint: disable=global-statement
+    _PREFETCH_PROVIDER = provider
+
+
+def _prefetch_worker_prep(chunkidx, seed, **kwargs):
+    return _PREFETCH_PROVIDER.prepped_inputs_for_chunk(chunkidx, seed, **kwargs)
+
+
+_SHM_ALIGN = 64  # bytes, alignment of each array in shared memory
+
+
+def _aligned(nbytes):
+    return -(-nbytes // _SHM_ALIGN) * _SHM_ALIGN
+
+
+def _shm_packable(inputs):
+    return isinstance(inputs, np.ndarray) and not inputs.dtype.hasobject
+
+
+def _shm_nbytes(inputs):
+    if _shm_packable(inputs):
+        return _aligned(inputs.nbytes)
+    elif isinstance(inputs, (list, tuple)):
+        return sum(_shm_nbytes(i) for i in inputs)
+    else:
+        return 0
+
+
+def _shm_pack(buf, inputs, offset=0):
+    """ Copy the arrays in (nested lists or tuples of) `inputs` into `buf` at `offset`.
+
+    Returns a picklable spec to get the arrays back with `_shm_unpack`, and the
+    offset in `buf` after the packed arrays.
+    """
+    if _shm_packable(inputs):
+        arr = np.ndarray(inputs.shape, dtype=inputs.dtype, buffer=buf, offset=offset)
+        arr[...] = inputs
+        return ('array', inputs.dtype, inputs.shape, offset), offset + _aligned(arr.nbytes)
+    elif isinstance(inputs, (list, tuple)):
+        specs = []
+        for i in inputs:
+            spec, offset = _shm_pack(buf, i, offset)
+            specs.append(spec)
+
+        return ('tuple' if isinstance(inputs, tuple) else 'list', specs), offset
+    else:
+        return ('object', inputs), offset
+
+
+def _shm_unpack(buf, spec):
+    """ Views of arrays in `buf` (in the same nesting) from the `spec` by `_shm_pack`. """
+    kind = spec[0]
+    if kind == 'array':
+        _, dtype, shape, offset = spec
+        return np.ndarray(shape, dtype=dtype, buffer=buf, offset=offset)
+    elif kind == 'list':
+        return [_shm_unpack(buf, s) for s in spec[1]]
+    elif kind == 'tuple':
+        return tuple(_shm_unpack(buf, s) for s in spec[1])
+    else:
+        return spec[1]
+
+
+_PREFETCH_SLOTS = dict()  # slot -> SharedMemory, attached in each worker process
+
+
+def _prefetch_worker_prep_into_slot(slot, slotname, chunkidx, seed, **kwargs):
+    inputs = _PREFETCH_PROVIDER.prepped_inputs_for_chunk(chunkidx, seed, **kwargs)
+
+    shm = _PREFETCH_SLOTS.get(slot, None)
+    if shm is None or shm.name != slotname:
+        if shm is not None:
+            shm.close()  # the slot was replaced by a larger one
+
+        shm = SharedMemory(name=slotname)
+        _PREFETCH_SLOTS[slot] = shm
+
+    nbytes = _shm_nbytes(inputs)
+    if nbytes > shm.size:
+        return nbytes, False, inputs  # too large, has to be pickled
+
+    spec, _ = _shm_pack(shm.buf, inputs)
+    return nbytes, True, spec
+
+
+class ChunkPrefetcher(object):
+    """ Prepares the upcoming `nahead` chunks of an inputs provider in a pool of
+    `nworkers` threads (or processes if `use_processes`).
+
+    The prepped inputs are provided in exactly the same order as the chunks were asked
+    for, and since the shuffling of each chunk only depends on its own seed, the results
+    are the same as when the chunks are prepped one after the other.
+
+    NOTE: With processes, the provider is sent to each worker only once, but the
+    prepped inputs are pickled back to the parent process, unless `use_shared_memory`.
+
+    With `use_shared_memory` (and `use_processes`), the workers copy the prepped arrays
+    into a ring of `nslots` shared memory blocks, and the consumer gets views of them,
+    without any pickling. The block of a chunk is reused when the chunk `nslots - nahead`
+    places before the one being prepped has been consumed. Hence, the provided arrays
+    are valid only until that many more chunks have been asked for (only until the next
+    one by default). Copy them if they are needed longer.
+
+    The blocks start at `slot_nbytes` bytes each. A chunk that doesn't fit is pickled
+    instead (counted in `stats.nspilled`), and the blocks are enlarged for later chunks.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            provider,
+            nahead=2,
+            nworkers=1,
+            use_processes=False,
+            use_shared_memory=False,
+            nslots=None,
+            slot_nbytes=32 * 1024**2):
+        assert nahead >= 1, "nahead should be >= 1, v/s {}".format(nahead)
+        self.nahead = nahead
+
+        if use_shared_memory:
+            assert use_processes, "use_shared_memory is only for use_processes"
+            assert SharedMemory is not None, (
+                "multiprocessing.shared_memory (python >= 3.8) is required"
+            )
+
+            nslots = nahead + 1 if nslots is None else nslots
+            assert nslots > nahead, (
+                "nslots should be > nahead ({}), v/s {}".format(nahead, nslots)
+            )
+        else:
+            nslots = 0
+
+        self.use_shared_memory = use_shared_memory
+        self._slots = [None] * nslots
+        self._retired_slots = []
+        self._slot_nbytes = slot_nbytes
+        self._nsubmitted = 0
+
+        provider.prepare_for_prefetching()
+        if use_processes:
+            self._pool = ProcessPoolExecutor(
+                nworkers,
+                initializer=_init_prefetch_worker,
+                initargs=(provider, ),
+            )
+            self._prep = _prefetch_worker_prep
+        else:
+            self._pool = ThreadPoolExecutor(nworkers)
+            self._prep = provider.prepped_inputs_for_chunk
+
+        self._inflight = deque()
+        self.stats = PrefetchStats()
+        self.last_chunk = None  # the chunk that was last asked for
+
+    def imap(self, chunks, **kwargs):
+        """ Yield `(chunk, prepped_inputs)` for each `chunk` in `chunks` in order.
+
+        Each `chunk` is a tuple with its index in `chunkings`, and its shuffling seed
+        as the last two items.
+        """
+        chunks = iter(chunks)
+
+        def submit_next():
+            for chunk in chunks:
+                if self.use_shared_memory:
+                    slot = self._nsubmitted % len(self._slots)
+                    future = self._pool.submit(
+                        _prefetch_worker_prep_into_slot,
+                        slot,
+                        self._slot(slot).name,
+                        chunk[-2],
+                        chunk[-1],
+                        passidx=chunk[0],
+                        **kwargs
+                    )
+                else:
+                    slot = None
+                    future = self._pool.submit(
+                        self._prep, chunk[-2], chunk[-1], passidx=chunk[0], **kwargs
+                    )
+
+                self._nsubmitted += 1
+                self._inflight.append((chunk, future, slot))
+                return True
+
+            return False
+
+        while len(self._inflight) < self.nahead and submit_next():
+            pass
+
+        while self._inflight:
+            chunk, future, slot = self._inflight.popleft()
+            self.last_chunk = chunk
+            depth = int(future.done()) + sum(f.done() for _, f, _ in self._inflight)
+            submit_next()
+
+            start = timer()
+            inputs = future.result()
+            self.stats.record(depth, timer() - start)
+
+            if self.use_shared_memory:
+                nbytes, packed, inputs = inputs
+                if packed:
+                    inputs = _shm_unpack(self._slots[slot].buf, inputs)
+                else:
+                    self.stats.nspilled += 1
+                    self._slot_nbytes = max(self._slot_nbytes, int(nbytes * 1.25))
+
+            yield chunk, inputs
+
+    def _slot(self, slot):
+        # NOTE: the chunk previously in the slot has been consumed by now
+        shm = self._slots[slot]
+        if shm is None or shm.size < self._slot_nbytes:
+            if shm is not None:
+                shm.unlink()
+                self._retired_slots.append(shm)
+
+            shm = SharedMemory(create=True, size=self._slot_nbytes)
+            self._slots[slot] = shm
+
+        return shm
+
+    def close(self):
+        """ Cancel the chunks not yet being prepped, wait for the ones being prepped
+        (their results are dropped), and let go of the workers.
+        """
+        inflight = [future for _, future, _ in self._inflight]
+        self._inflight.clear()
+        for future in inflight:
+            future.cancel()
+
+        # NOTE: Shutting down a process pool without waiting breaks its management
+        # thread on python 3.8, and the workers are then never stopped, hanging the exit.
+        wait(inflight)
+        self._pool.shutdown(wait=True)
+
+        for shm in self._slots:
+            if shm is not None:
+                shm.unlink()
+
+        for shm in self._slots + self._retired_slots:
+            if shm is None:
+                continue
+
+            try:
+                shm.close()
+            except BufferError:
+                # the consumer still holds arrays from it, the memory will be freed
+                # when they are gone. Till then, keep it from being closed on delete.
+                _LINGERING_SLOTS.append(shm)
+
+        self._slots = [None] * len(self._slots)
+        self._retired_slots = []
+
+
+_LINGERING_SLOTS = []  # unlinked SharedMemory still being used by the consumer
+
 
 # INPUTS PROVIDERS ######################################### INPUTS PROVIDERS #
 
 
+class FlowCursor(
+        namedtuple('FlowCursor', [
+            'passidx',
+            'chunk',
+            'step',
+            'nflowed',
+            'shuffle_seed',
+            'seeding',
+            'npasses',
+            'nchunks',
+            'num_shards',
+            'shard_index',
+        ])):  # yapf: disable
+    """ Where the flow of an inputs provider is, to resume it from there later.
+
+    The next inputs to flow are the `step`-th (0 if not stepped) of the `chunk`-th chunk
+    (in the chunk order) of pass `passidx`. `nflowed` inputs have flowed before them.
+
+    The order of chunks and the shuffling of each depend only on the pass, the chunk
+    and the seeding, hence no other RNG state is needed, and the flow can be resumed
+    directly, without replaying the earlier chunks. The rest of the fields are checked
+    against the provider resuming the flow.
+    """
+    __slots__ = ()
+
+    def save(self, filepath):
+        """ Save as JSON at `filepath` (atomically). """
+        tmppath = "{}.{}.tmp".format(filepath, getpid())
+        with open(tmppath, 'w') as f:
+            json.dump(
+                {
+                    k: (None if v is None else v if isinstance(v, string_types) else int(v))
+                    for k, v in self._asdict().items()
+                }, f
+            )
+
+        replace_file(tmppath, filepath)
+
+    @classmethod
+    def load(cls, filepath):
+        with open(filepath, 'r') as f:
+            return cls(**json.load(f))
+
+
 class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint: disable=abstract-method
-    def __init__(self, filepath, shuffle_seed=None, npasses=1, **kwargs):
+    """ Base class for providing prepped inputs chunk by chunk, over multiple passes.
+
+    When `shuffle_seed` is provided, the order of chunks in each pass, the seeds
+    to shuffle each chunk with, and the RNGs used for shuffling, are decided by `seeding`:
+    - 'legacy' (default) : produces exactly the same order and shuffles as seeding
+        numpy's global RNG did in earlier versions, so older experiments are reproduced.
+    - 'philox' : lazily derived from a counter-based RNG; check `ChunkSeedSchedule`.
+        Shuffling is done with `numpy.random.Generator`s seeded with the chunk's seed.
+        Prefer it for new experiments, especially with many chunks or passes.
+
+    In both cases, numpy's global RNG is never touched (check `rng`), so multiple chunks
+    can be prepped concurrently with deterministic results.
+
+    While flowing, `cursor` is where the flow is (check `FlowCursor`), and can be used to
+    resume it later with `flow(starting_cursor=...)`. The cursors of the last
+    `CURSOR_HISTORY` inputs are kept, to find the one after the inputs actually consumed
+    when they are queued ahead (e.g. by Keras). Check `cursor_after`.
+
+    To split the flow between multiple workers, each can flow only its own share of
+    the chunks. Check `shard`.
+
+    Small datasets (e.g. for validation) can be kept in memory once prepped, instead
+    of being read again in every pass. Check `cache_in_memory`.
+
+    With `reuse_read_buffers`, each flow reads the chunks into the same buffers (check
+    `ReadArena`), instead of new arrays, wherever the provided inputs are copied out
+    of the chunk anyway (e.g. when shuffling, subsampling, or picking steps from it).
+    NOTE: Subclasses providing views of the chunk read should drop the `read_arena`
+    from the kwargs of `get_prepped_data_label`.
+
+    With `label_indices`, the labels are carried as `np.uint8` class indices instead of
+    categorical arrays, all through the prepping, subsampling, adding context, shuffling
+    and stepping, and are provided as such, e.g. for training with sparse categorical
+    crossentropy. Use `onehot_labels` on the flow to one-hot encode them per batch.
+    NOTE: The preppers should support it. Check `BaseH5ChunkPrepper`.
+    """
+    CURSOR_HISTORY = 256
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            filepath,
+            shuffle_seed=None,
+            npasses=1,
+            seeding='legacy',
+            reuse_read_buffers=False,
+            label_indices=False,
+            **kwargs):
         assert npasses >= 1, "npasses should be >= 1, v/s {}".format(npasses)
         self.npasses = npasses
 
@@ -279,12 +2123,32 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
                  " or an integer, v/s {}".format(shuffle_seed))
         self.shuffle_seed = shuffle_seed
 
+        assert seeding in ('philox', 'legacy'), (
+            "seeding should be either 'philox' or 'legacy', v/s {}".format(seeding)
+        )
+        self.seeding = seeding
+        self._seed_schedule = None
+
         self._pseeds = None  # sets the order of chunk reading
         self._corder = None
 
         self._cseeds = None  # sets the shuffling of arrays within a chunk
 
         self._input_shapes = None
+        self.prefetch_stats = None  # set by the latest prefetched flow
+
+        self.reuse_read_buffers = reuse_read_buffers
+        self.read_arena = None  # set by the latest flow, if reuse_read_buffers
+
+        self.label_indices = label_indices
+
+        self.cursor = None  # set by the latest flow
+        self._cursors = deque(maxlen=self.CURSOR_HISTORY)
+
+        self.num_shards = 1
+        self.shard_index = 0
+        self._shard_of_chunks = None
+        self._shard_order = None  # (pass, chunk order in the shard) of the latest pass
 
         super(BaseInputsProvider, self).__init__(filepath, **kwargs)
 
@@ -309,47 +2173,176 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
 
     @property
     def steps_per_pass(self):
-        return self.nchunks
+        if self.num_shards == 1:
+            return self.nchunks
+
+        return int(np.sum(self.shard_of_chunks == self.shard_index))
+
+    def shard(self, num_shards, index):
+        """ Flow only the chunks in the `index`-th of `num_shards` disjoint shards.
+
+        The chunks are split (once) into `num_shards` runs with about the same total
+        number of rows, in a permutation of the chunks decided by `shuffle_seed` (in order
+        if `None`), which is the same for all the shards. Each pass then flows the chunks
+        of the shard in the chunk order of the pass.
+
+        Hence, each shard flows exactly the same chunks (and `steps_per_pass`) in every
+        pass, and the shards differ by at most about a chunk in their number of rows.
+
+        Returns the provider itself.
+        """
+        assert num_shards >= 1, "num_shards should be >= 1, v/s {}".format(num_shards)
+        assert 0 <= index < num_shards, (
+            "index should be >= 0 and < {}, v/s {}".format(num_shards, index)
+        )
+        self.num_shards = num_shards
+        self.shard_index = index
+        self._shard_of_chunks = None
+        self._shard_order = None
+
+        return self
+
+    def cache_in_memory(self, max_nbytes=2 * 1024**3):
+        """ Keep the prepped data and labels of the chunks in memory (upto `max_nbytes`)
+        when they are first read, and serve them from there in the later passes.
+
+        The chunks that do not fit are read from the file each time. Call after `shard`,
+        so that only the chunks of the shard are cached. Set `max_nbytes` to `None` to
+        stop caching.
+
+        NOTE: Prefetching processes (check `flow`) each use their own cache, which is
+        discarded at the end of the flow. Prefetch with threads to keep the cache.
+
+        Returns the provider itself.
+        """
+        if max_nbytes is None:
+            self.prepped_cache = None
+            return self
+
+        lengths = self.chunk_lengths
+        if self.num_shards > 1:
+            lengths = np.where(self.shard_of_chunks == self.shard_index, lengths, 0)
+
+        self.prepped_cache = PreppedChunksCache(lengths, max_nbytes)
+        return self
+
+    @property
+    def chunk_lengths(self):
+        """ Number of rows (of labels) in each chunk, or 1 each if unknown. """
+        if isinstance(self.chunkings, ChunkingTable):
+            return self.chunkings.lengths
+
+        groups = _label_row_groups(self.chunkings)
+        if groups is None:
+            return np.ones(self.nchunks, dtype=np.int64)
+
+        return np.concatenate([np.zeros(0, dtype=np.int64)] +
+                              [ends - starts for _, starts, ends in groups])
+
+    @property
+    def shard_of_chunks(self):
+        """ The shard of each chunk. Check `shard`. """
+        if self._shard_of_chunks is None:
+            if self.shuffle_seed is None:
+                order = np.arange(self.nchunks)
+            else:
+                # The trailing 2 keeps it independent of the other RNGs from the seed
+                rng = rng_for_seed([self.shuffle_seed, 2], 'philox')
+                order = rng.permutation(self.nchunks)
+
+            lengths = self.chunk_lengths[order]
+            ends = np.cumsum(lengths)
+            total = max(ends[-1], 1) if len(ends) > 0 else 1
+
+            # each chunk is in the shard its middle falls in
+            shards = np.zeros(self.nchunks, dtype=np.int64)
+            shards[order] = np.minimum(
+                ((ends - lengths / 2) * self.num_shards) // total, self.num_shards - 1
+            )
+            self._shard_of_chunks = shards
+
+        return self._shard_of_chunks
+
+    def close(self):
+        """ Close the source file of this provider in `H5_FILES_POOL`.
+
+        It will be opened again if the provider is used afterwards.
+        """
+        H5_FILES_POOL.close(self.filepath)
 
     def _setup_shuffling_seeds(self):
         if self.shuffle_seed is None:
             self._pseeds = (None, ) * self.npasses
             self._corder = (np.arange(self.nchunks), ) * self.npasses
             self._cseeds = ((None, ) * self.nchunks, ) * self.npasses
-        else:
+        elif self.seeding == 'philox':
+            self._seed_schedule = ChunkSeedSchedule(
+                self.shuffle_seed, self.npasses, self.nchunks
+            )
+        else:  # legacy
             nseeds = self.npasses * (1 + self.nchunks)
-            nr.seed(self.shuffle_seed)
-            seeds = nr.randint(41184535, size=nseeds)
+            seeds = randseeds_from(rng_for_seed(self.shuffle_seed, 'legacy'), nseeds)
 
             self._pseeds = tuple(seeds[:self.npasses])
 
             _corder = []
             for s in self._pseeds:
-                nr.seed(s)
-                _corder.append(nr.permutation(self.nchunks))
+                _corder.append(rng_for_seed(s, 'legacy').permutation(self.nchunks))
 
             self._corder = tuple(_corder)
             self._cseeds = nu.totuples(seeds[self.npasses:].reshape((self.npasses, -1)))
 
     def _chunk_order_for_pass(self, p):
-        if self._corder is None:
+        if self._corder is None and self._seed_schedule is None:
             self._setup_shuffling_seeds()
 
-        return self._corder[p]
+        if self._seed_schedule is not None:
+            order = self._seed_schedule.chunk_order(p)
+        else:
+            order = self._corder[p]
+
+        if self.num_shards == 1:
+            return order
+
+        cached = self._shard_order
+        if cached is None or cached[0] != p:
+            cached = (p, order[self.shard_of_chunks[order] == self.shard_index])
+            self._shard_order = cached
+
+        return cached[1]
 
     def _seed_for_chunk_in_pass(self, p, chunkidx):
-        if self._cseeds is None:
+        if self._cseeds is None and self._seed_schedule is None:
             self._setup_shuffling_seeds()
 
+        if self._seed_schedule is not None:
+            return self._seed_schedule.seed_for_chunk(p, chunkidx)
+
         return self._cseeds[p][chunkidx]
 
-    @staticmethod
-    def maybe_shuffle_array(arr, shuffle_seed):
+    def rng(self, seed):
+        """ An independent random number generator for `seed`, based on `self.seeding`.
+
+        Always use this instead of numpy's global RNG, so that multiple chunks can be
+        prepped concurrently, and still give deterministic results.
+        """
+        return rng_for_seed(seed, self.seeding)
+
+    def split_seed(self, seed, n=2):
+        """ `n` new seeds derived from `seed`, or all `None` if `seed` is `None`. """
+        if seed is None:
+            return (None, ) * n
+
+        return tuple(randseeds_from(self.rng(seed), n))
+
+    def maybe_shuffle_array(self, arr, shuffle_seed):
         if shuffle_seed is None:
             return arr
         elif isinstance(shuffle_seed, (int, np.int_)):
-            nr.seed(shuffle_seed)
-            nr.shuffle(arr)
+            if not arr.flags.writeable:  # e.g. served from prepped_cache
+                arr = arr.copy()
+
+            self.rng(shuffle_seed).shuffle(arr)
             return arr
         else:
             raise ValueError(
@@ -366,6 +2359,7 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
         However, other classes expect the first two arrays in the tuple to be
         data and label, in that order.
         """
+        kwargs.pop('read_arena', None)  # the whole chunk is provided, and can't be reused
         data, label = self.get_prepped_data_label(
             chunking, only_labels=only_labels, **kwargs
         )
@@ -377,6 +2371,63 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
             self.maybe_shuffle_array(label, array_shuffle_seed)
         )
 
+    def _print_flow_stopped_at(self, at, chunk):
+        # print info helpful to resume if any error happened
+        s = ".".join((self.__module__.split('.')[-1], self.__class__.__name__))
+        print("{}: An Error has stopped the flow at:".format(s))
+        print("pass: {}\nchunk: {}".format(at, chunk))
+        print("npasses: {}\nshuffle_seed: {}".format(self.npasses, self.shuffle_seed))
+        print("soucefile:\n{}".format(self.filepath))
+        print("cursor (to resume with flow(starting_cursor=...)):\n{}".format(self.cursor))
+
+    def _make_cursor(self, passidx, chunk, step, nflowed):
+        return FlowCursor(
+            passidx,
+            chunk,
+            step,
+            nflowed,
+            self.shuffle_seed,
+            self.seeding,
+            self.npasses,
+            self.nchunks,
+            self.num_shards,
+            self.shard_index,
+        )
+
+    def _start_cursor(self, passidx, chunk, step=0, nflowed=0):
+        self.cursor = self._make_cursor(passidx, chunk, step, nflowed)
+        self._cursors.clear()
+        self._cursors.append(self.cursor)
+
+    def _advance_cursor(self, passidx, chunk, step=0):
+        self.cursor = self._make_cursor(passidx, chunk, step, self.cursor.nflowed + 1)
+        self._cursors.append(self.cursor)
+
+    def _flowed_chunk(self, passidx, chunk):
+        """ Called by the flows before the inputs for the `chunk`-th chunk of pass
+        `passidx` are provided.
+        """
+        self._advance_cursor(passidx, chunk + 1)
+
+    def cursor_after(self, nflowed):
+        """ The cursor of the flow after `nflowed` inputs had flowed (in total). """
+        for cursor in reversed(self._cursors):
+            if cursor.nflowed == nflowed:
+                return cursor
+
+        raise ValueError(
+            "The cursor after {} inputs is not among the {} kept, "
+            "increase CURSOR_HISTORY".format(nflowed, len(self._cursors))
+        )
+
+    def check_cursor(self, cursor):
+        """ Raise ValueError if the flow of this provider cannot be resumed at `cursor`. """
+        expected = self._make_cursor(*cursor[:4])
+        if cursor != expected:
+            raise ValueError(
+                "The cursor {} doesn't match the provider: {}".format(cursor, expected)
+            )
+
     def flow_for_pass(
             self, at, starting_chunk_at=0, only_labels=False, with_chunking=False, **kwargs
     ):  # yapf: disable
@@ -393,6 +2444,8 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
                     chunking=chunking,
                     array_shuffle_seed=seed,
                     only_labels=only_labels,
+                    chunkidx=chunkidx,
+                    passidx=at,
                     **kwargs
                 )
 
@@ -404,14 +2457,150 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
         except GeneratorExit:
             return
 
-        except:  # print info helpful to resume if any error happened
-            s = ".".join((self.__module__.split('.')[-1], self.__class__.__name__))
-            print("{}: An Error has stopped the flow at:".format(s))
-            print("pass: {}\nchunk: {}".format(at, n_seen_chunks))
-            print("npasses: {}\nshuffle_seed: {}".format(self.npasses, self.shuffle_seed))
-            print("soucefile:\n{}".format(self.filepath))
+        except:
+            self._print_flow_stopped_at(at, n_seen_chunks)
+            raise
+
+    def chunks_to_flow(self, indefinitely=False, starting_pass_at=0, starting_chunk_at=0):
+        """ Yield `(pass, position in pass, index in chunkings, shuffle seed)` for the
+        chunks in the order in which they will flow.
+        """
+        while True:
+            for p in range(starting_pass_at, self.npasses):
+                chunk_order = self._chunk_order_for_pass(p)
+                for i in range(starting_chunk_at, len(chunk_order)):
+                    chunkidx = chunk_order[i]
+                    yield p, i, chunkidx, self._seed_for_chunk_in_pass(p, chunkidx)
+
+                starting_chunk_at = 0
+
+            starting_pass_at = 0
+
+            if not indefinitely:
+                break
+
+    def prepare_for_prefetching(self):
+        """ Read what is shared by all chunks, before the prefetching workers start. """
+        _ = self.chunkings
+
+    def prepped_inputs_for_chunk(
+            self, chunkidx, seed, passidx=None, only_labels=False, **kwargs
+    ):  # yapf: disable
+        """ `get_prepped_inputs` for the chunk at `chunkidx` in `chunkings`, in pass
+        `passidx` (when known).
+
+        Stepped inputs (returned as a generator) are prepped completely into a list.
+        """
+        inputs = self.get_prepped_inputs(
+            chunking=self.chunkings[chunkidx],
+            array_shuffle_seed=seed,
+            only_labels=only_labels,
+            chunkidx=chunkidx,
+            passidx=passidx,
+            **kwargs
+        )
+
+        return list(inputs) if isgenerator(inputs) else inputs
+
+    def steps_of_prepped_labels(self, labels, nperchunk, at=0, chunkidxs=None):  # pylint: disable=unused-argument
+        """ Given the concatenated prepped `labels` of the chunks at `chunkidxs` (all in
+        order if `None`), with `nperchunk` of them for each chunk, the labels that flow
+        in pass `at` without shuffling, and the number of them in each step.
+
+        Providers that subsample or step through chunks extend this accordingly.
+        """
+        return labels, nperchunk
+
+    def prepped_labels_for_pass(self, at=0):
+        """ All the prepped labels flowing in pass `at`, in the same order, as one
+        contiguous array, and the number of them in each step.
+
+        Without shuffling, the label datasets are read in bulk, and prepped, subsampled
+        and stepped through in a vectorized way (check `get_prepped_labels_in_bulk` and
+        `steps_of_prepped_labels`). Otherwise, only the labels are flowed for the pass.
+        """
+        groups = None
+        if self.shuffle_seed is None:
+            chunkings = self.chunkings
+            chunkidxs = self._chunk_order_for_pass(at)  # in order, and maybe sharded
+            if self.num_shards > 1:
+                if isinstance(chunkings, ChunkingTable):
+                    chunkings = chunkings[chunkidxs]
+                else:
+                    chunkings = [chunkings[i] for i in chunkidxs]
+
+            groups = _label_row_groups(chunkings)
+
+        if groups is None:
+            labels, nperstep = [], []
+            for inputs in self.flow_for_pass(at, only_labels=True):
+                for step in steps_in(inputs):
+                    labels.append(step[1])
+                    nperstep.append(len(step[1]))
+
+            return np.concatenate(labels), np.array(nperstep, dtype=np.int64)
+
+        labels, nperchunk = [], []
+        for labelpath, starts, ends in groups:
+            l, n = self.get_prepped_labels_in_bulk(labelpath, starts, ends)
+            labels.append(l)
+            nperchunk.append(n)
+
+        return self.steps_of_prepped_labels(
+            np.concatenate(labels), np.concatenate(nperchunk), at=at, chunkidxs=chunkidxs
+        )
+
+    def flow_prefetched(  # pylint: disable=too-many-arguments
+            self,
+            prefetch=2,
+            prefetch_workers=1,
+            prefetch_processes=False,
+            prefetch_shared_memory=False,
+            indefinitely=False,
+            starting_pass_at=0,
+            starting_chunk_at=0,
+            only_labels=False,
+            with_chunking=False,
+            **kwargs):
+        """ Same as `flow_for_pass` over all passes, but the next `prefetch` chunks are
+        prepped in the background. Check `ChunkPrefetcher`.
+
+        With `prefetch_shared_memory` (and `prefetch_processes`), the prepped arrays are
+        valid only until the next chunk is asked for.
+
+        `self.prefetch_stats` is updated as the chunks flow.
+        """
+        prefetcher = ChunkPrefetcher(
+            self,
+            nahead=prefetch,
+            nworkers=prefetch_workers,
+            use_processes=prefetch_processes,
+            use_shared_memory=prefetch_shared_memory,
+        )
+        self.prefetch_stats = prefetcher.stats
+
+        chunks = self.chunks_to_flow(indefinitely, starting_pass_at, starting_chunk_at)
+        try:
+            for (p, i, chunkidx, _), inputs in prefetcher.imap(
+                    chunks, only_labels=only_labels, **kwargs
+            ):  # yapf: disable
+                self._flowed_chunk(p, i)
+                if with_chunking:
+                    yield inputs, ((chunkidx, ), self.chunkings[chunkidx])
+                else:
+                    yield inputs
+
+        except GeneratorExit:
+            return
+
+        except:
+            if prefetcher.last_chunk is not None:
+                self._print_flow_stopped_at(*prefetcher.last_chunk[:2])
             raise
 
+        finally:
+            prefetcher.close()
+
     def flow(  # pylint: disable=too-many-arguments
             self,
             indefinitely=False,
@@ -420,16 +2609,64 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
             only_labels=False,
             only_data=False,
             with_chunking=False,
+            prefetch=0,
+            starting_cursor=None,
+            starting_step_at=0,
             **kwargs):
+        """ Flow the prepped inputs for all passes (and again if `indefinitely`).
+
+        With `prefetch > 0`, that many chunks are prepped ahead in the background, in
+        exactly the same order. Pass `prefetch_workers`, `prefetch_processes` and
+        `prefetch_shared_memory` to configure the workers. Check `flow_prefetched`.
+
+        With `starting_cursor` (check `FlowCursor`), the flow is resumed where the cursor
+        is, ignoring `starting_pass_at`, `starting_chunk_at` and `starting_step_at`.
+        `starting_step_at` is used only by stepped providers.
+        """
+        if self.reuse_read_buffers and kwargs.get('read_arena', None) is None:
+            kwargs['read_arena'] = ReadArena()
+
+        self.read_arena = kwargs.get('read_arena', None)
+
+        nflowed = 0
+        if starting_cursor is not None:
+            self.check_cursor(starting_cursor)
+            starting_pass_at, starting_chunk_at, starting_step_at, nflowed = (
+                starting_cursor[:4]
+            )
+
+        self._start_cursor(starting_pass_at, starting_chunk_at, starting_step_at, nflowed)
+
+        if prefetch > 0:
+            for inputs in self.flow_prefetched(
+                    prefetch=prefetch,
+                    indefinitely=indefinitely,
+                    starting_pass_at=starting_pass_at,
+                    starting_chunk_at=starting_chunk_at,
+                    only_labels=only_labels,
+                    with_chunking=with_chunking,
+                    **kwargs
+            ):  # yapf: disable
+                if only_data:
+                    inputs = inputs[0]
+
+                yield inputs
+
+            return
+
         while True:
             for p in range(starting_pass_at, self.npasses):
-                for inputs in self.flow_for_pass(
-                        at=p,
-                        starting_chunk_at=starting_chunk_at,
-                        only_labels=only_labels,
-                        with_chunking=with_chunking,
-                        **kwargs
+                for i, inputs in enumerate(
+                        self.flow_for_pass(
+                            at=p,
+                            starting_chunk_at=starting_chunk_at,
+                            only_labels=only_labels,
+                            with_chunking=with_chunking,
+                            **kwargs
+                        ),
+                        start=starting_chunk_at,
                 ):  # yapf: disable
+                    self._flowed_chunk(p, i)
                     if only_data:
                         inputs = inputs[0]
 
@@ -446,12 +2683,14 @@ class BaseInputsProvider(BaseH5ChunkingsReader, BaseH5ChunkPrepper):  # pylint:
 class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable=abstract-method
     """ Subsamples the inputs based on class.
 
-    The class is determined by classkeyfn applied to each prepped label.
+    The class is determined by classkeyfn applied to each prepped label, or is the label
+    itself, if it is a class index (check `label_indices` of `BaseInputsProvider`).
 
     NOTE: Sub-sampling can be uniform-random or hopped (based on shuffle_seed), but
     it is always done within a contiguous segment of the label (contiguous set of
     prepped labels with the same result for classkeyfn). This may result is less
     subsampling (more number of samples in final output) than provided ratios.
+    Use `BaseClassBalancingInputsProvider` to subsample exactly to the ratios.
 
     """
 
@@ -510,13 +2749,11 @@ class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable
 
         return self._ratios
 
-    @staticmethod
-    def _prep_keep(segs_keeps, keep_seed=None, **kwargs):  # pylint: disable=unused-argument
+    def _prep_keep(self, segs_keeps, keep_seed=None, **kwargs):  # pylint: disable=unused-argument
         if keep_seed is None:
             return np.sort(np.concatenate([seg[:keep] for seg, keep in segs_keeps]))
 
-        nr.seed(keep_seed)
-        seeds = nr.randint(41184535, size=len(segs_keeps))
+        seeds = randseeds_from(self.rng(keep_seed), len(segs_keeps))
 
         keeps = []
         for i, (s, k) in enumerate(segs_keeps):
@@ -524,8 +2761,7 @@ class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable
                 # we're keeping all
                 keeps.append(s)
             else:
-                nr.seed(seeds[i])
-                keeps.append(nr.permutation(s)[:k])
+                keeps.append(self.rng(seeds[i]).permutation(s)[:k])
 
         # NOTE: We only do random sampling, not shuffling
         return np.sort(np.concatenate(keeps))
@@ -549,7 +2785,7 @@ class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable
 
         seg_keep = []
         for s, e, l in zip(starts, ends, labels[starts]):
-            ratio = self.ratios[self.classkeyfn(l)]
+            ratio = self.ratios[_class_key(l, self.classkeyfn)]
             idx = np.arange(s, e)
 
             if ratio == 0.:  # skip all
@@ -566,16 +2802,33 @@ class BaseClassSubsamplingInputsProvider(BaseInputsProvider):  # pylint: disable
 
         return self._prep_keep(seg_keep, keep_seed=keep_seed, **kwargs)
 
+    def steps_of_prepped_labels(self, labels, nperchunk, at=0, chunkidxs=None):
+        sup = super(BaseClassSubsamplingInputsProvider, self)
+        if all(r == 1. for r in self.ratios.values()):
+            return sup.steps_of_prepped_labels(labels, nperchunk, at=at, chunkidxs=chunkidxs)
+
+        if chunkidxs is None:
+            chunkidxs = np.arange(len(nperchunk))
+
+        keeps = []
+        for i, s, n in zip(chunkidxs, np.cumsum(nperchunk) - nperchunk, nperchunk):
+            keeps.append(
+                s + self.keeping_decision([None, labels[s:s + n]], chunkidx=i, passidx=at)
+            )
+
+        return sup.steps_of_prepped_labels(
+            labels[np.concatenate(keeps)],
+            np.array([len(k) for k in keeps]),
+            at=at,
+            chunkidxs=chunkidxs,
+        )
+
     def get_prepped_inputs(self, chunking, array_shuffle_seed=None, **kwargs):  # pylint: disable=arguments-differ
         sup = super(BaseClassSubsamplingInputsProvider, self)
         inputs = sup.get_prepped_data_label(chunking, **kwargs)
 
         # shuffle seeds for order of steps, and shuffling data
-        if array_shuffle_seed is None:
-            kseed, aseed = None, None
-        elif isinstance(array_shuffle_seed, (int, np.int_)):
-            nr.seed(array_shuffle_seed)
-            kseed, aseed = nr.randint(41184535, size=2)
+        kseed, aseed = self.split_seed(array_shuffle_seed)
 
         keeps = self.keeping_decision(inputs, keep_seed=kseed, **kwargs)
 
@@ -604,6 +2857,7 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
             "steps_per_chunk should be >= 1, v/s {}".format(steps_per_chunk)
         )
         self.steps_per_chunk = steps_per_chunk
+        self._flowing_chunk = None  # (pass, chunk) of the steps flowing
 
         super(BaseSteppedInputsProvider, self).__init__(
             filepath, npasses=npasses, shuffle_seed=shuffle_seed, **kwargs
@@ -638,17 +2892,30 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
         # that cannot shuffle the data as is ... like the ones that use striding tricks
 
         # shuffle seeds for order of steps, and shuffling data
-        if shuffle_seed is None:
-            oseed, aseed = None, None
-        elif isinstance(shuffle_seed, (int, np.int_)):
-            nr.seed(shuffle_seed)
-            oseed, aseed = nr.randint(41184535, size=2)
+        oseed, aseed = self.split_seed(shuffle_seed)
 
         starts = self.maybe_shuffle_array(np.array(starts), oseed)
         ends = self.maybe_shuffle_array(np.array(ends), oseed)
 
         return starts, ends, aseed
 
+    def steps_of_prepped_labels(self, labels, nperchunk, at=0, chunkidxs=None):
+        nperstep = []
+        for n in nperchunk:
+            if n == 0:
+                # subsampled to zero-length, but we honor the steps per chunk
+                nperstep.append(np.zeros(self.steps_per_chunk, dtype=np.int64))
+            else:
+                starts, ends, _ = self.se_for_chunksteps_maybeshuffled(n)
+                nperstep.append(ends - starts)
+
+        return super(BaseSteppedInputsProvider, self).steps_of_prepped_labels(
+            labels,
+            np.concatenate(nperstep) if nperstep else nperchunk[:0],
+            at=at,
+            chunkidxs=chunkidxs,
+        )
+
     def get_prepped_inputs(
             self, chunking, array_shuffle_seed=None, only_labels=False, **kwargs
     ):  # yapf: disable
@@ -665,6 +2932,10 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
         for s, e in zip(starts, ends):
             yield [i[keeps[s:e], ...] for i in inputs]
 
+    def _flowed_chunk(self, passidx, chunk):
+        # the cursor is advanced for each step instead
+        self._flowing_chunk = (passidx, chunk)
+
     def flow(  # pylint: disable=too-many-arguments, too-many-locals, arguments-differ
             self,
             *args,
@@ -674,6 +2945,8 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
             only_labels=False,
             only_data=False,
             with_chunking=False,
+            starting_cursor=None,
+            starting_step_at=0,
             **kwargs):
         sup = super(BaseSteppedInputsProvider, self)
         gen = sup.flow(
@@ -682,15 +2955,30 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
             starting_chunk_at=starting_chunk_at,
             only_labels=only_labels,
             with_chunking=with_chunking,
+            starting_cursor=starting_cursor,
+            starting_step_at=starting_step_at,
             *args,
             **kwargs
         )
 
+        if starting_cursor is not None:
+            starting_step_at = starting_cursor.step
+
         for stepped_inputs in gen:
             if with_chunking:
                 stepped_inputs, (chunkidx, chunking) = stepped_inputs
 
             for i, inputs in enumerate(stepped_inputs):
+                if i < starting_step_at:
+                    # resuming in the middle of the first chunk
+                    continue
+
+                p, c = self._flowing_chunk
+                if i + 1 < self.steps_per_chunk:
+                    self._advance_cursor(p, c, step=i + 1)
+                else:  # no more steps in a chunk
+                    self._advance_cursor(p, c + 1)
+
                 if only_data:
                     inputs = inputs[0]
 
@@ -699,6 +2987,8 @@ class BaseSteppedInputsProvider(BaseInputsProvider):  # pylint: disable=abstract
                 else:
                     yield inputs
 
+            starting_step_at = 0
+
 
 class BaseClassSubsamplingSteppedInputsProvider(  # pylint: disable=abstract-method
         BaseClassSubsamplingInputsProvider, BaseSteppedInputsProvider):
@@ -708,7 +2998,8 @@ class BaseClassSubsamplingSteppedInputsProvider(  # pylint: disable=abstract-met
     consecutive empty steps for such chunks.
     Yes, we will still honor the steps_per_chunk, even though the inputs provided
     will be of zero length. Don't worry ... they will still have the original shape,
-    if at all the original prepped data had the necessary shape
+    if at all the original prepped data had the necessary shape.
+    Use `FixedSizeBatchRepacker` on top to get batches of a fixed size instead.
     """
 
     def __init__(  # pylint: disable=too-many-arguments
@@ -740,11 +3031,7 @@ class BaseClassSubsamplingSteppedInputsProvider(  # pylint: disable=abstract-met
         inputs = sup.get_prepped_data_label(chunking, **kwargs)
 
         # shuffle seeds for order of steps, and shuffling keeps
-        if array_shuffle_seed is None:
-            kseed, seed = None, None
-        elif isinstance(array_shuffle_seed, (int, np.int_)):
-            nr.seed(array_shuffle_seed)
-            kseed, seed = nr.randint(41184535, size=2)
+        kseed, seed = self.split_seed(array_shuffle_seed)
 
         keeps = self.keeping_decision(inputs, keep_seed=kseed, **kwargs)
         if keeps.shape[0] < 1:
@@ -756,6 +3043,8 @@ class BaseClassSubsamplingSteppedInputsProvider(  # pylint: disable=abstract-met
                 # zero-length, but we honor the steps per chunk
                 yield [i[keeps, ...] for i in inputs]
 
+            return
+
         starts, ends, aseed = self.se_for_chunksteps_maybeshuffled(
             len(keeps), shuffle_seed=seed, **kwargs
         )
@@ -816,6 +3105,9 @@ class BaseWithContextSteppedInputsProvider(  # pylint: disable=abstract-method
         # cooperating with simply calling SteppedInputsProvider when shuffling,
         # and recursing indefinitely. Hence, this copied implementation
 
+        if array_shuffle_seed is None:
+            kwargs.pop('read_arena', None)  # the steps will be views of the chunk
+
         sup = super(BaseWithContextSteppedInputsProvider, self)
         inputs = sup.get_prepped_data_label(chunking, only_labels=only_labels, **kwargs)
 
@@ -891,20 +3183,20 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
         # cooperating with simply calling SteppedInputsProvider when shuffling,
         # and recursing indefinitely. Hence, this copied implementation
 
+        copying = array_shuffle_seed is not None or not all(
+            v == 1. for v in self.ratios.values()
+        )  # yapf: disable
+        if not copying:
+            kwargs.pop('read_arena', None)  # the steps will be views of the chunk
+
         sup = super(BaseWithContextClassSubsamplingSteppedInputsProvider, self)
         inputs = sup.get_prepped_data_label(chunking, only_labels=only_labels, **kwargs)
 
-        if array_shuffle_seed is not None or not all(
-                v == 1. for v in self.ratios.values()
-        ):  # yapf: disable
+        if copying:
             # there will be copying, whether due to shuffling or subsampling
 
             # shuffle seeds for order of steps, and shuffling keeps
-            if array_shuffle_seed is None:
-                kseed, seed = None, None
-            elif isinstance(array_shuffle_seed, (int, np.int_)):
-                nr.seed(array_shuffle_seed)
-                kseed, seed = nr.randint(41184535, size=2)
+            kseed, seed = self.split_seed(array_shuffle_seed)
 
             # decide which to keep
             keeps = self.keeping_decision(inputs, keep_seed=kseed, **kwargs)
@@ -919,6 +3211,8 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
                     # zero-length, but we honor the steps per chunk
                     yield [i[keeps, ...] for i in inputs]
 
+                return
+
             # decide stepping through the keeps
             starts, ends, seed = self.se_for_chunksteps_maybeshuffled(
                 len(keeps), shuffle_seed=seed, **kwargs
@@ -942,3 +3236,511 @@ class BaseWithContextClassSubsamplingSteppedInputsProvider(  # pylint: disable=a
 
 BaseWCtxSubsplStpdInputsProvider = BaseWithContextClassSubsamplingSteppedInputsProvider
 BaseWCtxStpdInputsProvider = BaseWithContextSteppedInputsProvider
+
+
+# CLASS BALANCING ########################################### CLASS BALANCING #
+
+
+def _class_key(label, classkeyfn):
+    # labels that are class indices are their own keys
+    return int(label) if np.ndim(label) == 0 else classkeyfn(label)
+
+
+def _class_keys_for(labels, classkeyfn):
+    """ `classkeyfn` applied to each of the prepped `labels`, vectorized when possible.
+    Labels that are class indices (`labels` has one dimension) are their own keys.
+    """
+    if len(labels) == 0:
+        return np.empty(0, dtype=np.int64)
+
+    if labels.ndim == 1:
+        return labels.astype(np.int64)
+
+    if classkeyfn in (np.argmax, np.argmin):
+        return classkeyfn(labels.reshape((len(labels), -1)), axis=1)
+
+    return np.array([classkeyfn(l) for l in labels], dtype=np.int64)
+
+
+def _apportioned(counts, totals):
+    """ Largest remainder apportionment of each of `totals` over the rows of `counts`,
+    proportionally to the counts in its column.
+    """
+    exact = counts * (totals / np.maximum(counts.sum(axis=0), 1))
+    apportioned = np.floor(exact).astype(np.int64)
+    remains = totals - apportioned.sum(axis=0)
+    for c in np.flatnonzero(remains):
+        order = np.argsort(apportioned[:, c] - exact[:, c], kind='mergesort')
+        apportioned[order[:remains[c]], c] += 1
+
+    return apportioned
+
+
+class ChunkClassIndex(object):
+    """ Per-chunk, per-class counts of the prepped labels of an inputs provider, and the
+    runs (contiguous rows of the same class) they are in.
+
+    Built once with `build`, by prepping only the labels of each chunk. Afterwards, the
+    rows of any class in any chunk can be found with `positions` without looking at the
+    labels again.
+
+    `counts` is of shape (nchunks, nclasses). The runs of chunk `i` are at
+    `run_bounds[i]:run_bounds[i + 1]` in `run_starts`, `run_ends` and `run_classes`,
+    with the starts and ends relative to the chunk.
+    """
+
+    def __init__(self, counts, run_bounds, run_starts, run_ends, run_classes):  # pylint: disable=too-many-arguments
+        self.counts = counts
+        self.run_bounds = run_bounds
+        self.run_starts = run_starts
+        self.run_ends = run_ends
+        self.run_classes = run_classes
+
+    @property
+    def nchunks(self):
+        return self.counts.shape[0]
+
+    @property
+    def nclasses(self):
+        return self.counts.shape[1]
+
+    @classmethod
+    def build(cls, provider, nclasses=None, classkeyfn=None):
+        """ Index the prepped labels of all the chunks of `provider`.
+
+        `nclasses` and `classkeyfn` are the provider's when not given.
+        """
+        nclasses = provider.nclasses if nclasses is None else nclasses
+        classkeyfn = provider.classkeyfn if classkeyfn is None else classkeyfn
+
+        counts = np.zeros((provider.nchunks, nclasses), dtype=np.int64)
+        nruns = np.zeros(provider.nchunks + 1, dtype=np.int64)
+        runs = []
+        for i, chunking in enumerate(provider.chunkings):
+            _, labels = provider.get_prepped_data_label(chunking, only_labels=True)
+            keys = _class_keys_for(labels, classkeyfn)
+
+            assert len(keys) == 0 or 0 <= keys.min() <= keys.max() < nclasses, (
+                "Class keys should be in [0, {}), found in [{}, {}] for chunking {}".
+                format(nclasses, keys.min(), keys.max(), chunking)
+            )  # yapf: disable
+            counts[i] = np.bincount(keys, minlength=nclasses)
+
+            starts_ends, classes = nu.group_by_values(keys)
+            runs.append((starts_ends, classes))
+            nruns[i + 1] = len(classes)
+
+        if runs:
+            starts_ends = np.concatenate([se for se, _ in runs])
+            classes = np.concatenate([c for _, c in runs]).astype(np.int64)
+        else:
+            starts_ends = np.empty((0, 2), dtype=np.int64)
+            classes = np.empty(0, dtype=np.int64)
+
+        return cls(counts, np.cumsum(nruns), starts_ends[:, 0], starts_ends[:, 1], classes)
+
+    def positions(self, chunkidx, classidx):
+        """ Sorted rows (relative to the chunk) of class `classidx` in chunk `chunkidx`. """
+        lo, hi = self.run_bounds[chunkidx], self.run_bounds[chunkidx + 1]
+        isclass = self.run_classes[lo:hi] == classidx
+
+        return _concatenated_ranges(
+            self.run_starts[lo:hi][isclass], self.run_ends[lo:hi][isclass]
+        )
+
+
+class BaseClassBalancingInputsProvider(BaseClassSubsamplingInputsProvider):  # pylint: disable=abstract-method
+    """ Subsamples the inputs based on class, exactly to the given ratios, in every pass.
+
+    Unlike `BaseClassSubsamplingInputsProvider`, the classes are not decided from the
+    labels while flowing, but from a `ChunkClassIndex` built (once) before the first chunk
+    is provided. The number of rows of class `c` kept in a pass is exactly
+    `round(ratios[c] * total number of rows of class c)`.
+
+    With `shuffle_seed`, these are a uniformly random sample of all the rows of each class,
+    different in each pass. Otherwise, they are spread over the chunks proportionally
+    to the rows of the class in them, and hopped evenly over the rows in each chunk.
+
+    The chunk and pass have to be known to apply this subsampling (as is the case when
+    flowing). Otherwise, it falls back to the one of `BaseClassSubsamplingInputsProvider`.
+
+    The total number of rows in a pass is `nrows_per_pass`. The stepped providers below
+    provide exactly `steps_per_chunk` steps for each chunk, even if some are empty
+    (check `BaseFixedStepsInputsProvider`).
+    When sharded, the kept rows of each class are first apportioned over the shards,
+    so that each shard keeps the same number of rows in every pass.
+
+    Use it by adding it before the class-subsampling provider being used, e.g.
+    `class Provider(Reader, Prepper, BaseClassBalancingInputsProvider,
+    BaseFixedStepsInputsProvider, BaseClassSubsamplingSteppedInputsProvider)`, or
+    with the ones below.
+    """
+
+    def __init__(self, filepath, **kwargs):
+        self._class_index = None
+        self._keep_counts = None  # (passidx, keep_counts) of the latest pass
+
+        super(BaseClassBalancingInputsProvider, self).__init__(filepath, **kwargs)
+
+    @property
+    def class_index(self):
+        if self._class_index is None:
+            self._class_index = ChunkClassIndex.build(self)
+
+        return self._class_index
+
+    def _ratios_array(self):
+        return np.array([self.ratios[c] for c in range(self.nclasses)], dtype=np.float64)
+
+    @property
+    def class_keep_counts(self):
+        """ Total number of rows of each class that are kept in a pass (in all shards). """
+        totals = self.class_index.counts.sum(axis=0)
+        return np.rint(self._ratios_array() * totals).astype(np.int64)
+
+    @property
+    def shard_class_keep_counts(self):
+        """ Number of rows of each class kept from each shard in a pass (check `shard`),
+        of shape (num_shards, nclasses).
+        """
+        shard_counts = np.zeros((self.num_shards, self.nclasses), dtype=np.int64)
+        np.add.at(shard_counts, self.shard_of_chunks, self.class_index.counts)
+        return _apportioned(shard_counts, self.class_keep_counts)
+
+    @property
+    def nrows_per_pass(self):
+        return int(self.shard_class_keep_counts[self.shard_index].sum())
+
+    def _apportioned_keep_counts(self):
+        counts = self.class_index.counts
+        shards = self.shard_of_chunks
+
+        keep_counts = np.zeros_like(counts)
+        for s, keep_totals in enumerate(self.shard_class_keep_counts):
+            inshard = shards == s
+            keep_counts[inshard] = _apportioned(counts[inshard], keep_totals)
+
+        return keep_counts
+
+    def _sampled_keep_counts(self, passidx):
+        counts = self.class_index.counts
+        shards = self.shard_of_chunks
+
+        # Generator.multivariate_hypergeometric, irrespective of self.seeding.
+        # The trailing 1 keeps it independent of the other per-pass RNGs
+        rng = rng_for_seed([self.shuffle_seed, passidx, 1], 'philox')
+        keep_counts = np.zeros_like(counts)
+        for s, keep_totals in enumerate(self.shard_class_keep_counts):
+            inshard = np.flatnonzero(shards == s)
+            for c in np.flatnonzero(keep_totals):
+                ccounts = counts[inshard, c]
+                if keep_totals[c] == ccounts.sum():
+                    keep_counts[inshard, c] = ccounts
+                else:
+                    keep_counts[inshard, c] = rng.multivariate_hypergeometric(
+                        ccounts, keep_totals[c]
+                    )
+
+        return keep_counts
+
+    def keep_counts_for_pass(self, passidx):
+        """ Number of rows of each class to keep from each chunk in pass `passidx`,
+        of shape (nchunks, nclasses).
+        """
+        if self.shuffle_seed is None:
+            passidx = None
+
+        cached = self._keep_counts
+        if cached is None or cached[0] != passidx:
+            if passidx is None:
+                cached = (passidx, self._apportioned_keep_counts())
+            else:
+                cached = (passidx, self._sampled_keep_counts(passidx))
+
+            self._keep_counts = cached
+
+        return cached[1]
+
+    def keeping_decision(  # pylint: disable=arguments-differ
+            self, inputs, keep_seed=None, chunkidx=None, passidx=None, **kwargs
+    ):  # yapf: disable
+        sup = super(BaseClassBalancingInputsProvider, self)
+        if chunkidx is None or passidx is None or all(
+                r == 1. for r in self.ratios.values()
+        ):  # yapf: disable
+            return sup.keeping_decision(inputs, keep_seed=keep_seed, **kwargs)
+
+        assert len(inputs[1]) == self.class_index.counts[chunkidx].sum(), (
+            "The class index doesn't match the prepped labels of chunk {}: "
+            "{} v/s {} rows".format(
+                chunkidx, self.class_index.counts[chunkidx].sum(), len(inputs[1])
+            )
+        )
+
+        keep_counts = self.keep_counts_for_pass(passidx)[chunkidx]
+        rng = None if keep_seed is None else self.rng(keep_seed)
+
+        keeps = [np.empty(0, dtype=np.int64)]
+        for c in np.flatnonzero(keep_counts):
+            pos = self.class_index.positions(chunkidx, c)
+            k = keep_counts[c]
+            if k == len(pos):
+                keeps.append(pos)
+            elif rng is None:
+                keeps.append(pos[(np.arange(k) * len(pos)) // k])
+            else:
+                keeps.append(rng.choice(pos, k, replace=False))
+
+        # NOTE: We only do random sampling, not shuffling
+        return np.sort(np.concatenate(keeps))
+
+    def prepare_for_prefetching(self):
+        super(BaseClassBalancingInputsProvider, self).prepare_for_prefetching()
+        _ = self.class_index
+
+
+class BaseFixedStepsInputsProvider(BaseSteppedInputsProvider):  # pylint: disable=abstract-method
+    """ Stepped provider that provides exactly `steps_per_chunk` steps for each chunk,
+    some empty when there are fewer rows than that.
+    """
+
+    def se_for_chunksteps_maybeshuffled(self, len_input, shuffle_seed=None, **kwargs):
+        sup = super(BaseFixedStepsInputsProvider, self)
+        if len_input == 0 or len_input >= self.steps_per_chunk:
+            return sup.se_for_chunksteps_maybeshuffled(
+                len_input, shuffle_seed=shuffle_seed, **kwargs
+            )
+
+        starts = np.minimum(np.arange(self.steps_per_chunk), len_input)
+        ends = np.minimum(starts + 1, len_input)
+
+        oseed, aseed = self.split_seed(shuffle_seed)
+        order = self.maybe_shuffle_array(np.arange(self.steps_per_chunk), oseed)
+
+        return starts[order], ends[order], aseed
+
+
+class BaseClassBalancingSteppedInputsProvider(  # pylint: disable=abstract-method
+        BaseClassBalancingInputsProvider,
+        BaseFixedStepsInputsProvider,
+        BaseClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+class BaseWithContextClassBalancingSteppedInputsProvider(  # pylint: disable=abstract-method, too-many-ancestors
+        BaseClassBalancingInputsProvider,
+        BaseFixedStepsInputsProvider,
+        BaseWithContextClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+BaseWCtxBlncStpdInputsProvider = BaseWithContextClassBalancingSteppedInputsProvider
+
+
+# REPACKING ####################################################### REPACKING #
+
+
+def steps_in(inputs):
+    """ The steps in prepped `inputs` for a chunk, whether they were stepped or not. """
+    if isgenerator(inputs):
+        return inputs
+
+    inputs = list(inputs)
+    if inputs and not isinstance(inputs[0], np.ndarray):
+        return inputs  # already a list of steps
+
+    return [inputs]
+
+
+def onehot_labels(flow, nclasses, dtype=np.float32):
+    """ One-hot encode the labels (the class indices) in the inputs from `flow`, e.g.
+    of an inputs provider with `label_indices`, or a `FixedSizeBatchRepacker` on it, only
+    for each batch, as they are provided.
+    """
+    for inputs in flow:
+        inputs = list(inputs)
+        inputs[1] = nu.to_categorical(inputs[1], nclasses, dtype=dtype)
+        yield inputs
+
+
+class FixedSizeBatchRepacker(object):
+    """ Re-packs the (variable sized, even empty) steps flowing from an inputs provider
+    into batches of exactly `batch_size` rows.
+
+    The rows are gathered across chunks into preallocated buffers, and batches never
+    cross passes. The last batch of a pass is smaller, unless `drop_remainder`, in which
+    case the rows that don't make a full batch are skipped.
+
+    When `shuffle_buffer > 0`, the rows are gathered into a buffer of (at least)
+    that many rows, and each batch is drawn randomly from it, mixing rows from
+    different chunks. The randomness is decided by `shuffle_seed` (provider's if `None`),
+    and the pass. Without any seed, the buffer is not used.
+
+    With `reuse_buffers`, the provided batches are views of the same preallocated arrays,
+    and are valid only till the next batch is asked for. Otherwise, they are copies.
+    """
+
+    def __init__(  # pylint: disable=too-many-arguments
+            self,
+            provider,
+            batch_size,
+            shuffle_buffer=0,
+            shuffle_seed=None,
+            drop_remainder=False,
+            reuse_buffers=False):
+        assert batch_size >= 1, "batch_size should be >= 1, v/s {}".format(batch_size)
+        assert shuffle_buffer >= 0, (
+            "shuffle_buffer should be >= 0, v/s {}".format(shuffle_buffer)
+        )
+        self.provider = provider
+        self.batch_size = batch_size
+        self.shuffle_seed = provider.shuffle_seed if shuffle_seed is None else shuffle_seed
+        self.shuffle_buffer = shuffle_buffer if self.shuffle_seed is not None else 0
+        self.drop_remainder = drop_remainder
+        self.reuse_buffers = reuse_buffers
+
+        self._nrows_per_pass = None
+
+    @property
+    def nrows_per_pass(self):
+        """ Number of rows flowing from the provider in a pass.
+
+        Taken from the provider if it knows it (e.g. `BaseClassBalancingInputsProvider`),
+        else computed by flowing only the labels for the first pass, once.
+        NOTE: Assumes that it doesn't change between passes, as is the case for the
+        inputs providers here, where sub-sampling keeps a fixed number per segment.
+        """
+        if self._nrows_per_pass is None and hasattr(self.provider, 'nrows_per_pass'):
+            self._nrows_per_pass = self.provider.nrows_per_pass
+
+        if self._nrows_per_pass is None:
+            nrows = 0
+            for p, _, chunkidx, seed in self.provider.chunks_to_flow():
+                if p > 0:
+                    break
+
+                inputs = self.provider.prepped_inputs_for_chunk(
+                    chunkidx, seed, passidx=p, only_labels=True
+                )
+                nrows += sum(len(step[1]) for step in steps_in(inputs))
+
+            self._nrows_per_pass = nrows
+
+        return self._nrows_per_pass
+
+    @property
+    def steps_per_pass(self):
+        nfull, rem = divmod(self.nrows_per_pass, self.batch_size)
+        return nfull + int(rem > 0 and not self.drop_remainder)
+
+    def _chunks_inputs(self, indefinitely=False, prefetch=0, **kwargs):
+        """ Yield `(chunk, prepped inputs)` for each chunk, maybe prefetched.
+
+        Check `BaseInputsProvider.chunks_to_flow` for what `chunk` is.
+        """
+        chunks = self.provider.chunks_to_flow(indefinitely=indefinitely)
+        if prefetch > 0:
+            prefetcher = ChunkPrefetcher(
+                self.provider,
+                nahead=prefetch,
+                nworkers=kwargs.pop('prefetch_workers', 1),
+                use_processes=kwargs.pop('prefetch_processes', False),
+                use_shared_memory=kwargs.pop('prefetch_shared_memory', False),
+            )
+            self.provider.prefetch_stats = prefetcher.stats
+            try:
+                for chunk, inputs in prefetcher.imap(chunks, **kwargs):
+                    yield chunk, inputs
+            finally:
+                prefetcher.close()
+        else:
+            for chunk in chunks:
+                yield chunk, self.provider.prepped_inputs_for_chunk(
+                    chunk[-2], chunk[-1], passidx=chunk[0], **kwargs
+                )
+
+    def flow(self, indefinitely=False, only_data=False, prefetch=0, **kwargs):
+        """ Flow batches of exactly `batch_size` rows. Check the class' docs.
+
+        `prefetch` (and the related kwargs) are as in `BaseInputsProvider.flow`.
+        """
+        bs = self.batch_size
+        cap = max(bs, self.shuffle_buffer)
+        pool = None  # buffers gathering the rows
+        out = None  # buffers for shuffled batches
+        n = 0  # number of rows in pool
+        rng = None
+        at = (None, None)  # pass, and position in pass of the current chunk
+
+        def batch(arrays, size):
+            batch = [a[:size] for a in arrays]
+            if not self.reuse_buffers:
+                batch = [a.copy() for a in batch]
+
+            return batch[0] if only_data else batch
+
+        def drawn(size):
+            # a random batch from pool, and the rows from pool's end fill the holes
+            idx = np.sort(rng.choice(n, size, replace=False))
+            for p, o in zip(pool, out):
+                np.take(p, idx, axis=0, out=o[:size])
+
+            holes = idx[idx < n - size]
+            tail = np.arange(n - size, n)
+            fills = tail[~np.in1d(tail, idx, assume_unique=True)]
+            for p in pool:
+                p[holes] = p[fills]
+
+            return batch(out, size)
+
+        def remaining():
+            # the batches from rows remaining at the end of a pass
+            if rng is not None and n > 1:
+                order = rng.permutation(n)
+                for p in pool:
+                    p[:n] = p[order]
+
+            nbatches = n // bs if self.drop_remainder else -(-n // bs)
+            for b in range(nbatches):
+                s = b * bs
+                yield batch([p[s:] for p in pool], min(bs, n - s))
+
+        for (p, i, _, _), inputs in self._chunks_inputs(indefinitely, prefetch, **kwargs):
+            if p != at[0] or i <= at[1]:  # a new pass has started
+                if at[0] is not None:
+                    for b in remaining():
+                        yield b
+
+                n = 0
+                if self.shuffle_buffer > 0:
+                    rng = rng_for_seed([self.shuffle_seed, p], self.provider.seeding)
+
+            at = (p, i)
+            for step in steps_in(inputs):
+                if pool is None:
+                    pool = [np.empty((cap, ) + a.shape[1:], dtype=a.dtype) for a in step]
+                    if self.shuffle_buffer > 0:
+                        out = [np.empty((bs, ) + a.shape[1:], dtype=a.dtype) for a in step]
+
+                s, m = 0, len(step[0])
+                while s < m:
+                    k = min(cap - n, m - s)
+                    for pl, a in zip(pool, step):
+                        pl[n:n + k] = a[s:s + k]
+
+                    n += k
+                    s += k
+
+                    if n == cap:
+                        if rng is None:
+                            yield batch(pool, bs)
+                            n = 0
+                        else:
+                            yield drawn(bs)
+                            n -= bs
+
+        if at[0] is not None:
+            for b in remaining():
+                yield b
@@ -18,14 +18,14 @@ Created: 05-08-2017
 """
 from __future__ import print_function, division, absolute_import
 from os.path import join as pjoin
+from itertools import islice
 from six.moves import zip
 import numpy as np
 from h5py import File as hFile
 import tensorflow
 
 from .np_utils import (
-    to_categorical, confusion_matrix_forcategorical, normalize_confusion_matrix,
-    printoptions, print_prec_rec
+    to_categorical, ConfusionAccumulator, printoptions, print_prec_rec
 )
 
 kl = tensorflow.keras.layers  # pylint: disable=invalid-name
@@ -43,7 +43,7 @@ class ChattyConfusionHistory(Callback):
     It accepts only a valid BaseInputsProvider to read data from.
     Check the relevant module for more details.
 
-    NOTE: Expects Softmax/categorical labels from the model/inputs_provider
+    NOTE: Expects Softmax/categorical labels (or class indices) from the inputs_provider
     """
 
     def __init__(self, inputs_provider, epochs_per_pass=1, export_dir=None, **kwargs):
@@ -60,47 +60,58 @@ class ChattyConfusionHistory(Callback):
         else:
             self.export_to = None
 
-        self.trues, self.nsteps = self._read_trues()
-        self.nsteps = kwargs.get('steps_per_epoch', self.nsteps) or self.nsteps
-        self.trues = np.concatenate(self.trues[:self.nsteps])
+        # NOTE: all the steps of the flow, if None
+        self.nsteps = kwargs.get('steps_per_epoch', None) or None
 
         self.prefixtr = "{:<9} "
 
         super(ChattyConfusionHistory, self).__init__()
 
-    def _read_trues(self):
-        gen = self.inputs_provider.flow(
-            indefinitely=False, only_labels=True, with_chunking=False
-        )
-
-        trues = []
-        nsteps = 0
-        for x_y_ in gen:
-            trues.append(x_y_[1])  # as per keras's expectations
-            nsteps += 1
-
-        # trues = np.concatenate(trues)
-        return trues, nsteps
-
-    def _predict_calculate(self):
-        gen = self.inputs_provider.flow(
-            indefinitely=True, only_labels=False, only_data=True, with_chunking=False
-        )
-        preds = self.model.predict_generator(gen, self.nsteps, **self._kwargs)
+    def _predict_calculate(self, preds_path, trues_path=None):
+        """ Predict one step at a time, accumulating the confusions, in constant memory.
 
-        _preds = to_categorical(
-            preds.argmax(axis=-1),
-            nclasses=self.trues.shape[-1],
+        The predictions (and trues, if `trues_path`) are appended to the export file as
+        the steps come, but not to those exported earlier.
+        """
+        gen = islice(
+            self.inputs_provider.flow(
+                indefinitely=False, only_labels=False, with_chunking=False
+            ),
+            self.nsteps,
         )
-        conf = confusion_matrix_forcategorical(self.trues, _preds)
 
-        with np.errstate(invalid='ignore'):
-            prec_rec = normalize_confusion_matrix(conf)
+        f = hFile(self.export_to, 'a') if self.export_to is not None else None
+        try:
+            skip_paths = {
+                p for p in (preds_path, trues_path) if p is None or f is None or p in f
+            }
 
-        return (
-            preds,
-            conf,
-        ) + prec_rec
+            confs = None
+            for x, y in gen:
+                ypred = self.model.predict_on_batch(x)  # NOTE: Assumed softmax
+                if y.ndim == 1:  # class indices, e.g. with `label_indices`
+                    ytrue = y
+                    nclasses = self.inputs_provider.nclasses
+                else:  # as per keras's expectations, assumed categorical
+                    ytrue = y.argmax(axis=-1)
+                    nclasses = y.shape[-1]
+
+                if confs is None:
+                    confs = ConfusionAccumulator(nclasses)
+
+                confs.update(ytrue, ypred.argmax(axis=-1))
+
+                if preds_path not in skip_paths:
+                    _append_to_dataset(f, preds_path, ypred)
+                if trues_path not in skip_paths:
+                    _append_to_dataset(
+                        f, trues_path, to_categorical(ytrue, nclasses=nclasses)
+                    )
+        finally:
+            if f is not None:
+                f.close()
+
+        return (confs.confusion, ) + confs.precision_recall()
 
     def _maybe_export(self, datas, paths, multi=False):
         if self.export_to is not None:
@@ -117,7 +128,8 @@ class ChattyConfusionHistory(Callback):
 
                 f.flush()
 
-    def _print_class_stats(self):
+    @staticmethod
+    def _print_class_stats(confusion):
         with printoptions(
             suppress=True,
             formatter={
@@ -125,48 +137,48 @@ class ChattyConfusionHistory(Callback):
                 'int': '{: >9d}'.format
             }
         ):
-            print("Confusions on {}".format(len(self.trues)))
-            print("per class {}".format(self.trues.sum(axis=0).astype(int)))
-            print("percents  {}".format(100 * self.trues.sum(axis=0) / self.trues.sum()))
+            perclass = confusion.sum(axis=1)
+            print("Confusions on {}".format(perclass.sum()))
+            print("per class {}".format(perclass))
+            print("percents  {}".format(100 * perclass / perclass.sum()))
 
     def on_train_begin(self, *args, **kwargs):  # pylint: disable=unused-argument, arguments-differ
-        res = self._predict_calculate()
+        res = self._predict_calculate("initial/preds", trues_path="trues")
 
-        self._maybe_export(self.trues, "trues", multi=False)
         print()
-        self._print_class_stats()
+        self._print_class_stats(res[0])
         print()
 
         print(self.prefixtr.format('INITIAL'))
         print_prec_rec(*res[-2:], onlydiag=False)
         print()
 
-        paths = ["initial/{}".format(n) for n in ['preds', 'confs', 'precs', 'recs']]
+        paths = ["initial/{}".format(n) for n in ['confs', 'precs', 'recs']]
         self._maybe_export(res, paths, multi=True)
 
         print(self.prefixtr.format('INITIAL'))
         print_prec_rec(*res[-2:], onlydiag=True)
 
     def on_train_end(self, *args, **kwargs):  # pylint: disable=unused-argument, arguments-differ
-        res = self._predict_calculate()
+        res = self._predict_calculate("final/preds")
 
         print()
-        self._print_class_stats()
+        self._print_class_stats(res[0])
         print()
 
         print(self.prefixtr.format('FINAL'))
         print_prec_rec(*res[-2:], onlydiag=False)
         print()
 
-        paths = ["final/{}".format(n) for n in ['preds', 'confs', 'precs', 'recs']]
+        paths = ["final/{}".format(n) for n in ['confs', 'precs', 'recs']]
         self._maybe_export(res, paths, multi=True)
 
     def on_epoch_end(self, e, *args, **kwargs):  # pylint: disable=unused-argument, arguments-differ
-        res = self._predict_calculate()
-
         _pass = 1 + e // self.epp
         _epoc = 1 + e % self.epp
 
+        res = self._predict_calculate("preds/{}/{}".format(_pass - 1, _epoc - 1))
+
         pre = "{}-{:>3}-{:>3}".format(
             'e' if _epoc < self.epp else 'p',
             _pass,
@@ -178,13 +190,52 @@ class ChattyConfusionHistory(Callback):
 
         paths = [
             "{}/{}/{}".format(n, _pass - 1, _epoc - 1)
-            for n in ['preds', 'confs', 'precs', 'recs']
+            for n in ['confs', 'precs', 'recs']
         ]
         self._maybe_export(res, paths, multi=True)
 
 
+class InputsProviderCursorCheckpoint(Callback):
+    """ Callback to save the cursor of the training inputs provider at the end of each
+    epoch (and every `every_nbatches` batches, if given), to resume training from there.
+
+    The cursor is that after the inputs actually trained on, and not the ones queued
+    ahead by Keras. If training is itself resumed from a cursor, pass it as
+    `starting_cursor`. Check `FlowCursor` in the `h5_utils` module for more details.
+
+    `filepath` can have `{epoch}` in it, like the pattern for `ModelCheckpoint`.
+    Resume with `provider.flow(starting_cursor=FlowCursor.load(filepath))`.
+    """
+
+    def __init__(self, inputs_provider, filepath, starting_cursor=None, every_nbatches=None):
+        self.inputs_provider = inputs_provider
+        self.filepath = filepath
+        self.every_nbatches = every_nbatches
+        self.nflowed = 0 if starting_cursor is None else starting_cursor.nflowed
+        self._epoch = 0
+
+        super(InputsProviderCursorCheckpoint, self).__init__()
+
+    def _save(self):
+        cursor = self.inputs_provider.cursor_after(self.nflowed)
+        cursor.save(self.filepath.format(epoch=self._epoch))
+
+    def on_epoch_begin(self, epoch, *args, **kwargs):  # pylint: disable=unused-argument, arguments-differ
+        self._epoch = epoch
+
+    def on_batch_end(self, *args, **kwargs):  # pylint: disable=unused-argument, arguments-differ
+        self.nflowed += 1
+        if self.every_nbatches and self.nflowed % self.every_nbatches == 0:
+            self._save()
+
+    def on_epoch_end(self, epoch, *args, **kwargs):  # pylint: disable=unused-argument, arguments-differ
+        self._epoch = epoch + 1
+        self._save()
+
+
 MODEL_CHECKPOINT_PATTERN = 'w.{epoch:03d}-{val_loss:.3f}-{val_categorical_accuracy:.3f}.h5'
 model_checkpoint_pattern = MODEL_CHECKPOINT_PATTERN  # pylint: disable=invalid-name
+CURSOR_CHECKPOINT_PATTERN = 'cursor.{epoch:03d}.json'
 
 
 def create_callbacks(
@@ -192,10 +243,20 @@ def create_callbacks(
         activity_dir=None,
         epochs_per_pass=None,
         checkpoints_pattern=MODEL_CHECKPOINT_PATTERN,
+        training_inputs_provider=None,
+        training_starting_cursor=None,
         **kwargs
 ):  # yapf: disable
     callbacks = []
     if activity_dir:
+        if training_inputs_provider:
+            callbacks += [
+                InputsProviderCursorCheckpoint(
+                    training_inputs_provider,
+                    pjoin(activity_dir, CURSOR_CHECKPOINT_PATTERN),
+                    starting_cursor=training_starting_cursor,
+                )
+            ]
         callbacks += [
             ModelCheckpoint(
                 pjoin(activity_dir, checkpoints_pattern),
@@ -224,67 +285,93 @@ def create_callbacks(
     return callbacks
 
 
-def predict_on_inputs_provider(model, inputs_provider, export_to_dir, **kwargs):
-    export_to = pjoin(export_to_dir, "predictions.h5")
-
-    def _calconf_save(Ytrue, Ypred, path_postfix):
-        conf = confusion_matrix_forcategorical(
-            Ytrue,  # NOTE: Assumed categorical!!
-            to_categorical(
-                Ypred.argmax(
-                    axis=-1
-                ),  # NOTE: Assumed categorical "predictions". Argmax for softmax.
-                nclasses=Ytrue.shape[-1],
-            ),
+def _append_to_dataset(f, path, data):
+    """ Append `data` along the first axis of the resizable dataset at `path` in `f`. """
+    if path not in f:
+        f.create_dataset(
+            path,
+            data=data,
+            maxshape=(None, ) + data.shape[1:],
+            compression='lzf',
+            fletcher32=True
         )
-        paths = ["{}/{}".format(_p, path_postfix) for _p in ('trues', 'preds', 'confs')]
-        datas = [Ytrue, Ypred, conf]
+    else:
+        d = f[path]
+        n = d.shape[0]
+        d.resize(n + len(data), axis=0)
+        d[n:, ...] = data
+
 
-        with hFile(export_to, 'a') as f:
-            for path, data in zip(paths, datas):
-                if path not in f.keys():
-                    f.create_dataset(path, data=data, compression='lzf', fletcher32=True)
+def predict_on_inputs_provider(model, inputs_provider, export_to_dir, **kwargs):
+    """ Predict, and export and print confusions for each labelpath in `inputs_provider`.
 
-            f.flush()
+    The trues and predictions are appended to the export file as they come,
+    and the confusions are accumulated, so only one step is kept in memory at a time.
+    A labelpath may come again after others (e.g. when the chunks are shuffled), and is
+    then appended to, and its confusions updated, but not those exported in earlier runs.
 
-        return conf
+    Returns the `ConfusionAccumulator`, with the confusions for each labelpath as keys.
+    """
+    export_to = pjoin(export_to_dir, "predictions.h5")
 
+    confs = None
     currn = None
-    ctrue = []
-    cpred = []
-    for xy, (_, chunking) in inputs_provider.flow(
-            indefinitely=False, only_labels=False, with_chunking=True, **kwargs
-    ):  # yapf: disable
-
-        ctrue.append(xy[1])
-        cpred.append(model.predict_on_batch(xy[0]))
-
-        if currn is None:
-            currn = chunking.labelpath
-            continue
-
-        if chunking.labelpath != currn:
-            conf = _calconf_save(
-                np.concatenate(ctrue[:-1]),
-                np.concatenate(cpred[:-1]),
-                path_postfix=currn,
+    skip_paths = set()  # found in the export file, from earlier runs
+    exported = set()  # exported in this run
+
+    def _finish(f, labelpath):
+        path = "{}/{}".format('confs', labelpath)
+        if path in exported:  # the labelpath came again
+            f[path][...] = confs[labelpath].confusion
+        elif path not in f:
+            f.create_dataset(
+                path, data=confs[labelpath].confusion, compression='lzf', fletcher32=True
             )
-
-            print(currn, end=' ')
-            print_prec_rec(*normalize_confusion_matrix(conf), onlydiag=True)
-            currn = chunking.labelpath
-            ctrue = ctrue[-1:]
-            cpred = cpred[-1:]
-
-    # Last Chunking
-    conf = _calconf_save(
-        np.concatenate(ctrue),
-        np.concatenate(cpred),
-        path_postfix=currn,
-    )
-
-    print(currn, end=' ')
-    print_prec_rec(*normalize_confusion_matrix(conf), onlydiag=True)
+            exported.add(path)
+        f.flush()
+
+        print(labelpath, end=' ')
+        print_prec_rec(*confs[labelpath].precision_recall(), onlydiag=True)
+
+    with hFile(export_to, 'a') as f:
+        for xy, (_, chunking) in inputs_provider.flow(
+                indefinitely=False, only_labels=False, with_chunking=True, **kwargs
+        ):  # yapf: disable
+            if len(xy[1]) == 0:
+                continue
+
+            ytrue = xy[1]  # NOTE: Assumed categorical, or class indices
+            ypred = model.predict_on_batch(xy[0])  # NOTE: Assumed softmax "predictions".
+            if ytrue.ndim == 1:
+                ytrue = to_categorical(ytrue, ypred.shape[-1], dtype=np.uint8)
+
+            if confs is None:
+                confs = ConfusionAccumulator(ytrue.shape[-1])
+
+            if currn is not None and chunking.labelpath != currn:
+                _finish(f, currn)
+
+            if chunking.labelpath != currn:
+                currn = chunking.labelpath
+                for _p in ('trues', 'preds'):
+                    path = "{}/{}".format(_p, currn)
+                    if path in f and path not in exported:
+                        # don't overwrite, or append to, results from earlier runs
+                        skip_paths.add(path)
+
+            confs.update_categorical(ytrue, ypred, key=currn)
+
+            for _p, data in zip(('trues', 'preds'), (ytrue, ypred)):
+                path = "{}/{}".format(_p, currn)
+                if path not in skip_paths:
+                    _append_to_dataset(f, path, data)
+                    exported.add(path)
+
+        # Last Chunking
+        if currn is not None:
+            _finish(f, currn)
+
+    return confs
 
 
 # MODELS ############################################################# MODELS #
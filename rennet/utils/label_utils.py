@@ -30,10 +30,46 @@ from pympi import Eaf
 
 from .. import __version__ as rennet_version
 from .py_utils import BaseSlotsOnlyClass
-from .np_utils import normalize_confusion_matrix, confusion_matrix_forcategorical
+from .np_utils import (
+    normalize_confusion_matrix, confusion_matrix_forcategorical, group_by_values
+)
 from .mpeg7_utils import parse_mpeg7
 
 
+# numpy reductions that, when used as a groupby key function on each label,
+# are equivalent to being applied on all the (flattened) labels at once.
+_VECTORIZABLE_KEYFNS = (
+    np.argmax,
+    np.argmin,
+    np.amax,
+    np.amin,
+    np.sum,
+    np.any,
+    np.all,
+)
+
+
+def _dense_keys_vectorized(labels, groupby_keyfn=None, keyfn_vectorized=False):
+    """ Keys for each of the dense `labels` computed in one go, or None if not possible. """
+    if not isinstance(labels, np.ndarray) or labels.ndim == 0 or labels.dtype == object:
+        return None
+
+    if groupby_keyfn is None:
+        return labels
+    elif keyfn_vectorized:
+        keys = np.asarray(groupby_keyfn(labels))
+        if len(keys) != len(labels):
+            raise ValueError(
+                "vectorized groupby_keyfn should return one key per label, "
+                "{} v/s {}".format(len(keys), len(labels))
+            )
+        return keys
+    elif any(groupby_keyfn is fn for fn in _VECTORIZABLE_KEYFNS):
+        return groupby_keyfn(labels.reshape((len(labels), -1)), axis=1)
+
+    return None
+
+
 class SequenceLabels(object):
     """Base class for working with labels for a sequence.
 
@@ -415,6 +451,7 @@ class SequenceLabels(object):
             keep='both',
             min_start=0,
             samplerate=1,
+            keyfn_vectorized=False,
             **kwargs):
         """ Create SequenceLabels instance from dense list of labels.
 
@@ -440,6 +477,17 @@ class SequenceLabels(object):
             samplerate at which the labels were taken.
             That is, how many labels occur in 1 second.
             The start time can be changed by setting the min_start.
+        keyfn_vectorized: bool (default: False)
+            Whether `groupby_keyfn` accepts the entire `labels` array and returns
+            one key per label, instead of being applied to each label separately.
+
+        Note
+        ----
+        When `labels` is a (non-object) `numpy.ndarray`, and `groupby_keyfn` is either
+        `None`, one of the numpy reductions like `np.argmax`, or is marked as
+        `keyfn_vectorized`, the groups are found with array operations only,
+        and with `keep='keys'`, the labels in each group are never collected.
+        Otherwise, `itertools.groupby` is used.
 
         Examples
         --------
@@ -473,24 +521,39 @@ class SequenceLabels(object):
         if samplerate <= 0:
             raise ValueError('samplerate should be >= 0, not {}'.format(samplerate))
 
-        keylabels = []
-        bins = [0]
-        for k, itr in groupby(labels, groupby_keyfn):
-            lit = tuple(itr)
-            keylabels.append((k, lit))
-            bins.append(bins[-1] + len(lit))
-
-        bins = np.array(bins) + min_start
-        se = np.stack((bins[:-1], bins[1:]), axis=1)
-
-        if keep == 'both':
-            keylabels = np.array(keylabels, dtype=np.object)
-        else:
-            label_keys, label_list = list(zip(*keylabels))
-            if keep == 'keys':
+        keys = _dense_keys_vectorized(labels, groupby_keyfn, keyfn_vectorized)
+        if keys is not None:
+            # fast path, no python-level grouping
+            group_se, label_keys = group_by_values(keys)
+            bins = np.append(group_se[:, 0], len(keys))
+            if keep != 'keys':
+                label_list = [tuple(labels[s:e]) for s, e in group_se]
+
+            if keep == 'both':
+                keylabels = np.array(list(zip(label_keys, label_list)), dtype=object)
+            elif keep == 'keys':
                 keylabels = label_keys
             elif keep == 'labels':
                 keylabels = label_list
+        else:
+            keylabels = []
+            bins = [0]
+            for k, itr in groupby(labels, groupby_keyfn):
+                lit = tuple(itr)
+                keylabels.append((k, lit))
+                bins.append(bins[-1] + len(lit))
+
+            if keep == 'both':
+                keylabels = np.array(keylabels, dtype=object)
+            else:
+                label_keys, label_list = list(zip(*keylabels))
+                if keep == 'keys':
+                    keylabels = label_keys
+                elif keep == 'labels':
+                    keylabels = label_list
+
+        bins = np.array(bins) + min_start
+        se = np.stack((bins[:-1], bins[1:]), axis=1)
 
         return (
             cls(se, keylabels, samplerate)
@@ -945,6 +1008,7 @@ class ContiguousSequenceLabels(SequenceLabels):
             keep='both',
             min_start=0,
             samplerate=1,
+            keyfn_vectorized=False,
             **kwargs):
         """ Create SequenceLabels instance from dense list of labels.
 
@@ -966,6 +1030,17 @@ class ContiguousSequenceLabels(SequenceLabels):
             samplerate at which the labels were taken.
             That is, how many labels occur in 1 second.
             The start time can be changed by setting the min_start.
+        keyfn_vectorized: bool (default: False)
+            Whether `groupby_keyfn` accepts the entire `labels` array and returns
+            one key per label, instead of being applied to each label separately.
+
+        Note
+        ----
+        When `labels` is a (non-object) `numpy.ndarray`, and `groupby_keyfn` is either
+        `None`, one of the numpy reductions like `np.argmax`, or is marked as
+        `keyfn_vectorized`, the groups are found with array operations only,
+        and with `keep='keys'`, the labels in each group are never collected.
+        Otherwise, `itertools.groupby` is used.
 
         Examples
         --------
@@ -988,7 +1063,13 @@ class ContiguousSequenceLabels(SequenceLabels):
          (array([ 36.,  37.]), array([1, ([0.4, 0.6],)], dtype=object))]
         """
         params = super(ContiguousSequenceLabels, cls).from_dense_labels(
-            labels, groupby_keyfn, keep, min_start, samplerate, **kwargs
+            labels,
+            groupby_keyfn,
+            keep,
+            min_start,
+            samplerate,
+            keyfn_vectorized=keyfn_vectorized,
+            **kwargs
         )
         return cls(*params[:-1]) if cls == ContiguousSequenceLabels else params
 
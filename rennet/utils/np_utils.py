@@ -17,7 +17,7 @@
 Created: 28-09-2016
 """
 from __future__ import division, print_function
-from collections import Iterable
+from collections import Iterable, OrderedDict
 from itertools import repeat
 from contextlib import contextmanager
 import numpy as np
@@ -219,14 +219,33 @@ def rolling_min(arr, win_len, *args, axis=0, **kwargs):
 
 
 def group_by_values(values):
-    # TODO: [A] make it work with 1 dimensional arrays
+    """ Group consecutive equal values along the first axis of `values`.
+
+    Works for arrays of any number of dimensions. For arrays with more than one
+    dimension, two consecutive rows belong to the same group only if all their
+    elements are equal.
+
+    Returns
+    -------
+    starts_ends: numpy.ndarray of shape (ngroups, 2)
+        start (inclusive) and end (exclusive) index of each group.
+    labels: numpy.ndarray
+        The value for each group, i.e. `values[starts]`.
+    """
     # Ref: http://stackoverflow.com/questions/4651683
+    if not isinstance(values, np.ndarray):
+        values = np.array(values)
+
+    if len(values) == 0:
+        return np.empty((0, 2), dtype=np.int64), values[:0]
 
-    initones = [[1] * values.shape[1]]
-    diff = np.concatenate([initones, np.diff(values, axis=0)])
-    starts = np.unique(np.where(diff)[0])  # remove duplicate starts
+    changed = values[1:] != values[:-1]
+    if changed.ndim > 1:
+        changed = changed.reshape(len(changed), -1).any(axis=1)
 
-    ends = np.ones(len(starts), dtype=np.int)
+    starts = np.concatenate([[0], np.flatnonzero(changed) + 1])
+
+    ends = np.ones(len(starts), dtype=np.int64)
     ends[:-1] = starts[1:]
     ends[-1] = len(values)
 
@@ -235,7 +254,26 @@ def group_by_values(values):
     return np.vstack([starts, ends]).T, labels
 
 
-def to_categorical(y, nclasses=None, warn=False):
+def _nclasses_for(y, nclasses=None, warn=False):
+    """ Check and infer the number of classes for the class labels in `y`. """
+    ymax = np.max(y) + 1  # zero is a class
+    if nclasses is None:
+        nclasses = ymax
+    elif nclasses < ymax:
+        raise RuntimeError(
+            "Some class labels are greater than provided nclasses: {} > {}".format(
+                ymax, nclasses
+            )
+        )
+    elif nclasses > ymax and warn:
+        raise RuntimeWarning(
+            "Some class labels may be missing: {} > {}".format(nclasses, ymax)
+        )
+
+    return int(nclasses)
+
+
+def to_categorical(y, nclasses=None, warn=False, dtype=np.float64):
     """ Convert class vectors to one-hot class matrix
 
     TODO: [ ] check if works for n-dim sequences
@@ -246,6 +284,8 @@ def to_categorical(y, nclasses=None, warn=False):
             please report weird behavior.
             NOTE: multi-dim Sequence not tested
         nclasses: optional total number of classes
+        dtype: dtype of the returned array (default: float, cuz it is a probability dist)
+            Use e.g. `np.uint8` or `np.float32` for compact one-hot arrays.
 
     # Returns
         A one-hot encodede class matrix
@@ -256,26 +296,49 @@ def to_categorical(y, nclasses=None, warn=False):
     if not isinstance(y, np.ndarray):
         y = np.array(y)
 
-    ymax = np.max(y) + 1  # zero is a class
-    if nclasses is None:
-        nclasses = ymax
-    elif nclasses < ymax:
-        raise RuntimeError(
-            "Some class labels are greater than provided nclasses: {} > {}".format(
-                ymax, nclasses
-            )
-        )
-    elif nclasses > ymax and warn:
-        raise RuntimeWarning(
-            "Some class labels may be missing: {} > {}".format(nclasses, ymax)
-        )
+    nclasses = _nclasses_for(y, nclasses=nclasses, warn=warn)
 
-    res = np.arange(nclasses)[np.newaxis, :] == y[..., np.newaxis]
-    res = res.astype(np.float)  # cuz it is a probability dist
+    if not np.issubdtype(y.dtype, np.integer):
+        res = np.arange(nclasses)[np.newaxis, :] == y[..., np.newaxis]
+        return res.astype(dtype)
+
+    # scatter the ones directly, without the intermediate boolean array
+    res = np.zeros(y.shape + (nclasses, ), dtype=dtype)
+    yflat = y.ravel()
+    at = np.flatnonzero(yflat >= 0)  # negative labels don't belong to any class
+    res.reshape((-1, nclasses))[at, yflat[at]] = 1
 
     return res
 
 
+def _confmat_reduce_axis(pred_shape, reduce_axis=None):
+    """ Validate or choose the axis to reduce along when calculating confusions.
+
+    `pred_shape` is the shape of the predictions, excluding any class label axis.
+    """
+    _valid_axes = [i for i in range(len(pred_shape)) if pred_shape[i] > 1]
+    if not _valid_axes:
+        msg = """ No valid reduction axes found\n
+        - Are there more than one examples, at all? Check Shape.\n\tPred: {}\n
+        """.format(pred_shape)
+        raise ValueError(msg)
+    if reduce_axis is None:
+        # choose the last axis > 1, excluding the ClassLabel axis
+        # will raise error if none qualify, since then max is looking into empty
+        reduce_axis = max(_valid_axes)
+    elif reduce_axis not in _valid_axes:
+        msg = "The axis argument cannot be:\n"
+        msg += "- The last axis (axis of class label) {}\n".format(
+            "TRUE" if reduce_axis == len(pred_shape) else ""
+        )
+        msg += "- An axis of size <= 1 {}".format(
+            "TRUE" if reduce_axis < len(pred_shape) and pred_shape[reduce_axis] <= 1 else ""
+        )
+        raise ValueError(msg)
+
+    return reduce_axis
+
+
 def _generic_confmat_forcat(  #pylint: disable=too-many-arguments
         Ytrue,
         predicate_true,
@@ -297,26 +360,7 @@ def _generic_confmat_forcat(  #pylint: disable=too-many-arguments
     #     "True {} != {} Predictions".format(Ytrue.shape, Ypred.shape)
     # NOTE: Can't use this, cuz case of multi-pred
 
-    _valid_axes = [i for i in range(len(Ypred.shape) - 1) if Ypred.shape[i] > 1]
-    if not _valid_axes:
-        msg = """ No valid reduction axes found\n
-        - Are there more than one examples, at all? Check Shape.\n\tTrue: {}, Pred: {}\n
-        - Are you providing categorical (one-hot) labels? Check Values.\n\tTRUE: {}\n\tPRED: {}
-        """.format(Ytrue.shape, Ypred.shape, Ytrue, Ypred)
-        raise ValueError(msg)
-    if reduce_axis is None:
-        # choose the last axis > 1, excluding the ClassLabel axis
-        # will raise error if none qualify, since then max is looking into empty
-        reduce_axis = max(_valid_axes)
-    elif reduce_axis not in _valid_axes:
-        msg = "The axis argument cannot be:\n"
-        msg += "- The last axis (axis of class label) {}\n".format(
-            "TRUE" if reduce_axis == len(Ypred.shape) - 1 else ""
-        )
-        msg += "- An axis of size <= 1 {}".format(
-            "TRUE" if Ypred.shape[reduce_axis] <= 1 else ""
-        )
-        raise ValueError(msg)
+    reduce_axis = _confmat_reduce_axis(Ypred.shape[:-1], reduce_axis)
 
     conf = reduce_function(
         predicate_match(
@@ -353,6 +397,20 @@ def confusion_matrix(  #pylint: disable=too-many-arguments
         axis=None,
         keepdims=False,
         warn=False):
+    """ Confusion matrix for integer class labels, without one-hot encoding them.
+
+    The labels are coded as `ytrue * nclasses + ypred` and counted with `np.bincount`,
+    hence, the memory required is only O(n) for n labels, and not O(n * nclasses**2).
+
+    The inputs follow the same layout as for `confusion_matrix_forcategorical`,
+    just without the last (class label) axis, e.g. `ytrue` of shape (B, Q) and
+    `ypred` of shape (P, B, Q). The confusions are counted along `axis` (by default,
+    the last axis of `ypred` with size > 1), and are batched for all the other axes.
+
+    # Returns
+        Confusion matrices of shape `ypred.shape` (with `axis` removed, or kept as size 1
+        when `keepdims` is True) + (nclasses, nclasses).
+    """
     if not isinstance(ytrue, np.ndarray):
         ytrue = np.array(ytrue)
 
@@ -363,18 +421,31 @@ def confusion_matrix(  #pylint: disable=too-many-arguments
 
     # assert ytrue.shape == ypred.shape, "Shape mismatch: True {} != {} Predictions".format(
     #     ytrue.shape, ypred.shape)
-    # assert len(ytrue.shape) == 1, (
-    #     "Only supports vectors of class labels. "
-    #     "If your labels are one-hot, please use confusion_matrix_forcategorical"
-    # )
     # NOTE: Can't use this, cuz case of multi-pred
 
-    Ytrue = to_categorical(ytrue, nclasses=nclasses, warn=warn)
+    # ytrue tells the correct nclasses, unless provided
+    nclasses = _nclasses_for(ytrue, nclasses=nclasses, warn=warn)
+    nclasses = _nclasses_for(ypred, nclasses=nclasses, warn=warn)
+    if np.min(ytrue) < 0 or np.min(ypred) < 0:
+        raise ValueError("Negative class labels are not supported")
+
+    axis = _confmat_reduce_axis(ypred.shape, axis)
+
+    ytrue, ypred = np.broadcast_arrays(ytrue, ypred)
+    codes = ytrue.astype(np.int64) * nclasses + ypred.astype(np.int64)
 
-    # Ytrue tells the correct nclasses now
-    Ypred = to_categorical(ypred, nclasses=Ytrue.shape[-1], warn=warn)
+    # one bincount for all the batches, with codes for each batch offset separately
+    codes = np.moveaxis(codes, axis, -1)
+    batch_shape = codes.shape[:-1]
+    codes = codes.reshape((-1, codes.shape[-1]))
+    nbatches = codes.shape[0]
+    ncodes = nclasses * nclasses
+    codes = codes + (np.arange(nbatches, dtype=np.int64) * ncodes)[:, np.newaxis]
 
-    return confusion_matrix_forcategorical(Ytrue, Ypred, axis=axis, keepdims=keepdims)
+    conf = np.bincount(codes.ravel(), minlength=nbatches * ncodes)
+    conf = conf.reshape(batch_shape + (nclasses, nclasses))
+
+    return np.expand_dims(conf, axis) if keepdims else conf
 
 
 def normalize_confusion_matrix(conf_matrix):
@@ -390,6 +461,110 @@ def normalize_confusion_matrix(conf_matrix):
     return confprec, confrec
 
 
+class ConfusionAccumulator(object):
+    """ Streaming confusion matrix for integer class labels.
+
+    The confusions are updated batch by batch, so that evaluation over arbitrarily
+    large inputs runs in constant memory. Accumulators with the same `nclasses` can be
+    merged, e.g. ones filled by different workers.
+
+    When a `key` is provided to `update`, the confusions are also accumulated
+    in a sub-accumulator for that key (e.g. per file), accessible as `self[key]`.
+
+    Check `confusion_matrix` for the non-streaming, batched version.
+    """
+
+    def __init__(self, nclasses):
+        self.nclasses = int(nclasses)
+        self.confusion = np.zeros((self.nclasses, self.nclasses), dtype=np.int64)
+        self._groups = OrderedDict()
+
+    def _confusion_for(self, ytrue, ypred):
+        ytrue = np.asarray(ytrue).ravel()
+        ypred = np.asarray(ypred).ravel()
+        if ytrue.shape != ypred.shape:
+            raise ValueError(
+                "Shape mismatch: True {} != {} Predictions".format(ytrue.shape, ypred.shape)
+            )
+
+        n = self.nclasses
+        if len(ytrue) > 0 and (
+                min(ytrue.min(), ypred.min()) < 0 or max(ytrue.max(), ypred.max()) >= n
+        ):  # yapf: disable
+            raise RuntimeError(
+                "Some class labels are not in the range [0, nclasses={})".format(n)
+            )
+
+        codes = ytrue.astype(np.int64) * n + ypred
+        return np.bincount(codes, minlength=n * n).reshape((n, n))
+
+    def update(self, ytrue, ypred, key=None):
+        """ Add the confusions between the integer class labels `ytrue` and `ypred`.
+
+        Returns the confusion matrix for only this batch.
+        """
+        conf = self._confusion_for(ytrue, ypred)
+
+        self.confusion += conf
+        if key is not None:
+            self.group(key).confusion += conf
+
+        return conf
+
+    def update_categorical(self, Ytrue, Ypred, key=None):
+        """ Same as `update`, but for categorical trues and softmax-like predictions. """
+        return self.update(
+            np.argmax(Ytrue, axis=-1), np.argmax(Ypred, axis=-1), key=key
+        )
+
+    def group(self, key):
+        """ Sub-accumulator for `key`, created if it doesn't exist yet. """
+        if key not in self._groups:
+            self._groups[key] = self.__class__(self.nclasses)
+
+        return self._groups[key]
+
+    def keys(self):
+        return self._groups.keys()
+
+    def __getitem__(self, key):
+        return self._groups[key]
+
+    def __contains__(self, key):
+        return key in self._groups
+
+    def merge(self, other):
+        """ Add all the confusions (and the ones for each key) from `other` into `self`. """
+        if other.nclasses != self.nclasses:
+            raise ValueError(
+                "Cannot merge accumulators for different nclasses: {} v/s {}".format(
+                    self.nclasses, other.nclasses
+                )
+            )
+
+        self.confusion += other.confusion
+        for key in other.keys():
+            self.group(key).merge(other[key])
+
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def reset(self):
+        self.confusion[...] = 0
+        self._groups = OrderedDict()
+
+    @property
+    def total(self):
+        return self.confusion.sum()
+
+    def precision_recall(self):
+        """ Precision and recall confusion matrices, check `normalize_confusion_matrix`. """
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return normalize_confusion_matrix(self.confusion)
+
+
 @contextmanager
 def printoptions(*args, **kwargs):
     orig_options = np.get_printoptions()
@@ -40,10 +40,10 @@ with copen(path.join(HERE, "README.md"), 'r', 'utf-8') as rf:
 ######################################################################### REQUIREMENTS #
 INSTALL_REQUIRES = [
     "six",  # your days are numbered anyways
-    "numpy >= 1.12.1",
+    "numpy >= 1.18.0",
     "matplotlib >= 2.0.2",
     "librosa >= 0.5.0",
-    "h5py >= 2.7.0",
+    "h5py >= 2.9.0",
     "tensorflow >= 1.4.0",
     "pydub >= 0.18.0",
     "pympi-ling >= 1.69",
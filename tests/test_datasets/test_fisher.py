@@ -0,0 +1,186 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the fisher chunkings readers and inputs providers
+
+@motjuste
+"""
+from __future__ import division
+import os
+import pytest
+import numpy as np
+import h5py as h
+
+from rennet.datasets import fisher
+from rennet.utils import h5_utils as hu
+from rennet.utils import np_utils as nu
+
+# pylint: disable=redefined-outer-name, missing-docstring
+
+CHUNK_LEN = 64
+
+
+@pytest.fixture(scope='module')
+def fisher_file(tmpdir_factory):
+    """ fisher like file, with the data and labels of each call """
+    filepath = str(tmpdir_factory.mktemp('fisher').join('fisher.h5'))
+    rng = np.random.RandomState(32)
+    calls = dict()
+    with h.File(filepath, 'w') as f:
+        for groupid in ('000', '001'):
+            for callid in ('{}01'.format(groupid), '{}02'.format(groupid)):
+                name = '{}/{}'.format(groupid, callid)
+                n = rng.randint(200, 300)
+                data = rng.randn(n, 4).astype(np.float32)
+                label = rng.randint(2, size=(n // 5 + 1, 2)).repeat(5, axis=0)[:n]
+                calls[name] = (data, label)
+
+                f.create_dataset('audios/' + name, data=data, chunks=(CHUNK_LEN, 4))
+                f.create_dataset('labels/' + name, data=label, chunks=(CHUNK_LEN, 2))
+
+    yield filepath, calls
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def make_provider(filepath, **kwargs):
+    kwargs = dict(
+        dict(
+            data_context=2,
+            steps_per_chunk=2,
+            npasses=2,
+            shuffle_seed=32,
+            persist_chunk_index=False,
+        ),
+        **kwargs
+    )
+    return fisher.UnnormedFrameWithContextInputsProvider(filepath, **kwargs)
+
+
+def baseline_chunkings(filepath):
+    """ chunkings and totlen as read directly from the datasets' chunks, without an index.
+    """
+    chunkings = []
+    totlen = 0
+    with h.File(filepath, 'r') as f:
+        for groupid in sorted(f['audios']):
+            for callid in sorted(f['audios'][groupid]):
+                audiod = f['audios'][groupid][callid]
+                n = audiod.shape[0]
+
+                starts = np.arange(0, n, audiod.chunks[0])
+                ends = np.append(starts[1:], n)
+
+                totlen += n
+                chunkings.extend(
+                    hu.Chunking(
+                        datapath=audiod.name,
+                        dataslice=np.s_[s:e, ...],
+                        labelpath='/labels/{}/{}'.format(groupid, callid),
+                        labelslice=np.s_[s:e, ...],
+                    ) for s, e in zip(starts, ends)
+                )
+
+    return chunkings, totlen
+
+
+class BaselineChunkingsProvider(  # pylint: disable=too-many-ancestors
+        fisher.UnnormedFrameWithContextInputsProvider):
+    def _read_chunkings(self):
+        self._chunkings, self._totlen = baseline_chunkings(self.filepath)
+
+
+@pytest.mark.parametrize('persist_chunk_index', [False, True])
+def test_chunkings_from_index(fisher_file, persist_chunk_index):
+    filepath, _ = fisher_file
+    kwargs = dict(persist_chunk_index=persist_chunk_index, seeding='legacy')
+    provider = make_provider(filepath, **kwargs)
+    chunkings, totlen = baseline_chunkings(filepath)
+    assert list(provider.chunkings) == chunkings
+    assert provider.totlen == totlen
+
+    sidecar = hu.H5ChunkIndex.sidecar_path(filepath, 'audios')
+    assert os.path.exists(sidecar) == persist_chunk_index
+    if persist_chunk_index:  # read from the sidecar
+        assert list(make_provider(filepath, **kwargs).chunkings) == chunkings
+        os.remove(sidecar)
+
+    # the same flows as with the chunkings read without an index
+    baseline = BaselineChunkingsProvider(
+        filepath, data_context=2, steps_per_chunk=2, npasses=2, shuffle_seed=32, **kwargs
+    )
+    expected = list(baseline.flow())
+    flows = list(provider.flow())
+    assert len(flows) == len(expected)
+    for inputs, einputs in zip(flows, expected):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
+
+
+@pytest.mark.parametrize('read_chunk_len, unit_len', [
+    (None, CHUNK_LEN),
+    (20, CHUNK_LEN),  # split storage chunks overlap by the context
+    (1000, None),  # the whole call at once
+])  # yapf: disable
+def test_read_chunk_len_windows(fisher_file, read_chunk_len, unit_len):
+    filepath, calls = fisher_file
+    data_context = 2
+    provider = make_provider(
+        filepath,
+        data_context=data_context,
+        read_chunk_len=read_chunk_len,
+        steps_per_chunk=1,
+        npasses=1,
+        shuffle_seed=None,
+    )
+
+    # the windows within each unit of `unit_len` rows, exactly once, in order
+    win = 1 + 2 * data_context
+    windows, nactive = [], []
+    for name in sorted(calls):
+        data, label = calls[name]
+        for s in range(0, len(data), unit_len or len(data)):
+            e = s + (unit_len or len(data))
+            windows.append(nu.strided_view(data[s:e], win_shape=win, step_shape=1))
+            nactive.append(label[s:e].sum(axis=1)[data_context:-data_context])
+
+    flowed = list(provider.flow())
+    np.testing.assert_equal(
+        np.concatenate([i[0] for i in flowed]), np.concatenate(windows)[..., None]
+    )
+    np.testing.assert_equal(
+        np.concatenate([i[1] for i in flowed]).argmax(axis=-1), np.concatenate(nactive)
+    )
+
+
+@pytest.mark.parametrize('label_subcontext', [0, 1])
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+def test_label_indices(fisher_file, label_subcontext, shuffle_seed):
+    filepath, _ = fisher_file
+    kwargs = dict(
+        label_subcontext=label_subcontext,
+        shuffle_seed=shuffle_seed,
+        class_subsample_to_ratios=(1., 0.5, 0.8),
+    )
+    expected = list(make_provider(filepath, **kwargs).flow())
+    provider = make_provider(filepath, label_indices=True, **kwargs)
+    flows = list(provider.flow())
+
+    assert len(flows) == len(expected)
+    for (data, label), (edata, elabel) in zip(flows, expected):
+        assert label.dtype == np.uint8 and label.shape == (len(data), )
+        np.testing.assert_equal(data, edata)
+        np.testing.assert_equal(label, elabel.argmax(axis=-1))
+
+    for inputs, einputs in zip(hu.onehot_labels(provider.flow(), 3), expected):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
@@ -0,0 +1,308 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the ka3 chunkings readers and inputs providers
+
+@motjuste
+"""
+from __future__ import division
+import os
+import pytest
+import numpy as np
+import h5py as h
+
+from rennet.datasets import ka3
+from rennet.utils import h5_utils as hu
+from rennet.utils import np_utils as nu
+
+# pylint: disable=redefined-outer-name, missing-docstring
+
+CHUNK_LEN = 64
+CHUNK_OVERLAP = 6
+
+
+def overlapped(x, chunk_len, overlap):
+    """ `x` as stored for ka3, with the first `overlap` rows of each storage chunk, but
+    the first, the same as the last ones of the previous chunk.
+    """
+    step = chunk_len - overlap
+    return np.concatenate(
+        [x[s:s + chunk_len] for s in range(0, max(len(x) - overlap, 1), step)]
+    )
+
+
+@pytest.fixture(scope='module')
+def ka3_file(tmpdir_factory):
+    """ ka3 like file with stereo audios, with different channels, and the contiguous
+    data and labels of each conversation, as before storing them overlapped.
+    """
+    filepath = str(tmpdir_factory.mktemp('ka3').join('ka3.h5'))
+    rng = np.random.RandomState(32)
+    conversations = dict()
+    with h.File(filepath, 'w') as f:
+        for root in ('audios', 'labels'):
+            f.create_group(root).attrs['chunk_overlap'] = CHUNK_OVERLAP
+
+        for group in ('g0', 'g1'):
+            for conv in ('c0', 'c1'):
+                name = '{}/{}'.format(group, conv)
+                n = rng.randint(200, 300)
+                data = rng.randn(n, 4, 2).astype(np.float32)
+                label = np.eye(3)[rng.randint(3, size=n // 5 + 1).repeat(5)[:n]]
+                conversations[name] = (data, label)
+
+                f['audios'].create_dataset(
+                    name,
+                    data=overlapped(data, CHUNK_LEN, CHUNK_OVERLAP),
+                    chunks=(CHUNK_LEN, 4, 2),
+                )
+                f['labels'].create_dataset(
+                    name,
+                    data=overlapped(label, CHUNK_LEN, CHUNK_OVERLAP),
+                    chunks=(CHUNK_LEN, 3),
+                )
+
+    yield filepath, conversations
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def make_provider(filepath, **kwargs):
+    kwargs = dict(
+        dict(
+            data_context=2,
+            duplicate_swap_channels=False,
+            steps_per_chunk=2,
+            npasses=2,
+            shuffle_seed=32,
+            persist_chunk_index=False,
+        ),
+        **kwargs
+    )
+    return ka3.ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider(
+        filepath, **kwargs
+    )
+
+
+def baseline_chunkings(filepath, data_context=0, duplicate_swap_channels=True):
+    """ chunkings and totlen as read directly from the datasets' chunks, without an index.
+    """
+    chunkings = []
+    totlen = 0
+    with h.File(filepath, 'r') as f:
+        audior = f['audios']
+        skipoverlap = max(audior.attrs['chunk_overlap'] - 2 * data_context, 0)
+        conversations = ('{}/{}'.format(g, c) for g in audior for c in audior[g])
+        for conversation in sorted(conversations):
+            audiod = audior[conversation]
+            n = audiod.shape[0]
+
+            starts = np.arange(0, n, audiod.chunks[0])
+            ends = np.append(starts[1:], n)
+            starts[1:] += skipoverlap
+
+            for swapchannels in (False, True)[:1 + duplicate_swap_channels]:
+                totlen += n
+                chunkings.extend(
+                    ka3.Chunking(
+                        datapath=audiod.name,
+                        dataslice=np.s_[s:e, ...],
+                        swapchannels=swapchannels,
+                        labelpath='/labels/' + conversation,
+                        labelslice=np.s_[s:e, ...],
+                    ) for s, e in zip(starts, ends)
+                )
+
+    return chunkings, totlen
+
+
+class BaselineChunkingsProvider(  # pylint: disable=too-many-ancestors
+        ka3.ChMVNChannelSwappingFrameWithContextSubsamplingInputsProvider):
+    def _read_all_chunkings(self):
+        self._chunkings, self._totlen = baseline_chunkings(
+            self.filepath, self.dctx, self._dupswap_channels
+        )
+
+
+def flowed(provider):
+    return [[np.array(i) for i in inputs] for inputs in provider.flow()]
+
+
+@pytest.mark.parametrize('add_channel_at_end', [False, True])
+def test_random_swap_channels(ka3_file, add_channel_at_end):
+    filepath, _ = ka3_file
+    asis = flowed(make_provider(filepath, add_channel_at_end=add_channel_at_end))
+    provider = make_provider(
+        filepath, random_swap_channels=True, add_channel_at_end=add_channel_at_end
+    )
+    swapped = flowed(provider)
+
+    # each chunk is read only once
+    assert len(provider.chunkings) == len(make_provider(filepath).chunkings)
+    assert not any(c.swapchannels for c in provider.chunkings)
+
+    assert len(swapped) == len(asis)
+    nswapped = nsamples = 0
+    axis = -2 if add_channel_at_end else -1
+    for (data, label), (edata, elabel) in zip(swapped, asis):
+        np.testing.assert_equal(label, elabel)
+
+        swaps = (data != edata).reshape(len(data), -1).any(axis=1)
+        np.testing.assert_equal(data[~swaps], edata[~swaps])
+        np.testing.assert_equal(data[swaps], np.flip(edata[swaps], axis=axis))
+        nswapped += swaps.sum()
+        nsamples += len(data)
+
+    assert 0.4 < nswapped / nsamples < 0.6
+
+    # the same swaps for the same seed
+    again = flowed(
+        make_provider(
+            filepath, random_swap_channels=True, add_channel_at_end=add_channel_at_end
+        )
+    )
+    assert len(again) == len(swapped)
+    for inputs, einputs in zip(again, swapped):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
+
+
+def test_random_swap_channels_not_shuffling(ka3_file):
+    filepath, _ = ka3_file
+    asis = flowed(make_provider(filepath, shuffle_seed=None))
+    swapped = flowed(
+        make_provider(filepath, shuffle_seed=None, random_swap_channels=True)
+    )
+
+    assert len(swapped) == len(asis)
+    for inputs, einputs in zip(swapped, asis):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
+
+
+def test_duplicate_swap_channels_order(ka3_file):
+    filepath, _ = ka3_file
+    chunkings = list(make_provider(filepath).chunkings)
+    dupswapped = list(make_provider(filepath, duplicate_swap_channels=True).chunkings)
+
+    # the chunks of each conversation, followed by the same with swapped channels
+    expected = []
+    for datapath in sorted(set(c.datapath for c in chunkings)):
+        chunks = [c for c in chunkings if c.datapath == datapath]
+        expected.extend(chunks)
+        expected.extend(c._replace(swapchannels=True) for c in chunks)
+
+    assert dupswapped == expected
+
+    # the swapped chunks are provided with the channels of the same chunk swapped
+    steps = 2  # steps_per_chunk
+    asis = flowed(make_provider(filepath, shuffle_seed=None))
+    swapped = flowed(
+        make_provider(filepath, duplicate_swap_channels=True, shuffle_seed=None)
+    )
+    assert len(swapped) == 2 * len(asis)
+    for i, chunking in enumerate(dupswapped):
+        j = chunkings.index(chunking._replace(swapchannels=False))
+        for (data, label), (edata, elabel) in zip(swapped[i * steps:(i + 1) * steps],
+                                                  asis[j * steps:(j + 1) * steps]):
+            np.testing.assert_equal(label, elabel)
+            if chunking.swapchannels:
+                edata = edata[..., ::-1]
+            np.testing.assert_equal(data, edata)
+
+
+@pytest.mark.parametrize('read_chunk_len', [None, 30, 128, 200])
+def test_read_chunk_len_windows(ka3_file, read_chunk_len):
+    filepath, conversations = ka3_file
+    data_context = 2
+    provider = make_provider(
+        filepath,
+        data_context=data_context,
+        read_chunk_len=read_chunk_len,
+        steps_per_chunk=1,
+        npasses=1,
+        shuffle_seed=None,
+    )
+
+    # every window of each conversation, exactly once, in order, despite the overlaps
+    data = np.concatenate([np.array(i[0]) for i in provider.flow()])
+    win = 1 + 2 * data_context
+    windows = np.concatenate([
+        nu.strided_view(conversations[name][0], win_shape=win, step_shape=1)
+        for name in sorted(conversations)
+    ])  # yapf: disable
+    np.testing.assert_equal(data, windows)
+
+    label = np.concatenate([np.array(i[1]) for i in provider.flow()])
+    np.testing.assert_equal(
+        label,
+        np.concatenate([
+            conversations[name][1][data_context:-data_context]
+            for name in sorted(conversations)
+        ]),
+    )  # yapf: disable
+
+
+@pytest.mark.parametrize('duplicate_swap_channels', [False, True])
+@pytest.mark.parametrize('persist_chunk_index', [False, True])
+def test_chunkings_from_index(ka3_file, duplicate_swap_channels, persist_chunk_index):
+    filepath, _ = ka3_file
+    kwargs = dict(
+        duplicate_swap_channels=duplicate_swap_channels,
+        persist_chunk_index=persist_chunk_index,
+        seeding='legacy',
+    )
+    provider = make_provider(filepath, **kwargs)
+    chunkings, totlen = baseline_chunkings(filepath, 2, duplicate_swap_channels)
+    assert list(provider.chunkings) == chunkings
+    assert provider.totlen == totlen
+
+    sidecar = hu.H5ChunkIndex.sidecar_path(filepath, 'audios')
+    assert os.path.exists(sidecar) == persist_chunk_index
+    if persist_chunk_index:  # read from the sidecar
+        assert list(make_provider(filepath, **kwargs).chunkings) == chunkings
+        os.remove(sidecar)
+
+    # the same flows as with the chunkings read without an index
+    baseline = BaselineChunkingsProvider(
+        filepath, data_context=2, steps_per_chunk=2, npasses=2, shuffle_seed=32, **kwargs
+    )
+    expected = flowed(baseline)
+    flows = flowed(provider)
+    assert len(flows) == len(expected)
+    for inputs, einputs in zip(flows, expected):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
+
+
+@pytest.mark.parametrize('label_subcontext', [0, 1])
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+def test_label_indices(ka3_file, label_subcontext, shuffle_seed):
+    filepath, _ = ka3_file
+    kwargs = dict(
+        label_subcontext=label_subcontext,
+        shuffle_seed=shuffle_seed,
+        class_subsample_to_ratios=(1., 0.5, 0.8),
+    )
+    expected = flowed(make_provider(filepath, **kwargs))
+    provider = make_provider(filepath, label_indices=True, **kwargs)
+    flows = flowed(provider)
+
+    assert len(flows) == len(expected)
+    for (data, label), (edata, elabel) in zip(flows, expected):
+        assert label.dtype == np.uint8 and label.shape == (len(data), )
+        np.testing.assert_equal(data, edata)
+        np.testing.assert_equal(label, elabel.argmax(axis=-1))
+
+    for inputs, einputs in zip(hu.onehot_labels(provider.flow(), 3), expected):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
@@ -0,0 +1,227 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Smoke test the h5 benchmarks
+
+@motjuste
+"""
+from __future__ import division
+import json
+import os
+import tracemalloc
+import pytest
+import numpy as np
+import h5py as h
+
+from rennet.utils import h5_utils as hu
+from rennet.utils import h5_benchmarks as hb
+
+# pylint: disable=redefined-outer-name, missing-docstring
+
+
+class AudiosChunkingsReader(hu.BaseH5ChunkingsReader):
+    """ Reads each dataset at 'audios/*' (and 'labels/*') in chunks of its storage """
+
+    @property
+    def chunkings(self):
+        with h.File(self.filepath, 'r') as f:
+            chunkings = []
+            for name in sorted(f['audios'].keys()):
+                d = f['audios'][name]
+                chunkings.extend(
+                    hu.Chunking(
+                        datapath=d.name,
+                        dataslice=np.s_[s:s + d.chunks[0], ...],
+                        labelpath='/labels/' + name,
+                        labelslice=np.s_[s:s + d.chunks[0], ...],
+                    ) for s in range(0, d.shape[0], d.chunks[0])
+                )
+
+        return chunkings
+
+    @property
+    def totlen(self):
+        return sum(c.dataslice[0].stop - c.dataslice[0].start for c in self.chunkings)
+
+
+class ContextInputsProvider(  # pylint: disable=too-many-ancestors
+        AudiosChunkingsReader,
+        hu.AsIsChunkPrepper,
+        hu.BaseWithContextClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+def make_provider(filepath, **kwargs):
+    kwargs = dict(
+        dict(data_context=2, label_subcontext=1, steps_per_chunk=2, shuffle_seed=32),
+        **kwargs
+    )
+    return ContextInputsProvider(filepath, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def h5_audios_file(tmpdir_factory):
+    filepath = str(tmpdir_factory.mktemp('h5_benchmarks').join('audios.h5'))
+    rng = np.random.RandomState(32)
+    with h.File(filepath, 'w') as f:
+        for i in range(2):
+            n = rng.randint(200, 300)
+            f.create_dataset(
+                'audios/{}'.format(i),
+                data=rng.randn(n, 3).astype(np.float32),
+                chunks=(64, 3),
+            )
+            f.create_dataset(
+                'labels/{}'.format(i),
+                data=np.eye(3)[rng.randint(3, size=n).repeat(5)[:n]],
+                chunks=(64, 3),
+            )
+
+    yield filepath
+    hu.H5_FILES_POOL.close(filepath)
+
+
+@pytest.mark.parametrize('reset_peak', [True, False])
+def test_compare_read_buffers(h5_audios_file, monkeypatch, reset_peak):
+    if not reset_peak:  # as before python 3.9
+        monkeypatch.delattr(tracemalloc, 'reset_peak', raising=False)
+
+    results = hb.compare_read_buffers(
+        lambda **kwargs: make_provider(h5_audios_file, **kwargs), nflows=2, trace=True
+    )
+
+    assert [k for k, _ in results] == [(False, 0), (False, 1), (True, 0), (True, 1)]
+    ninputs = make_provider(h5_audios_file).steps_per_pass
+    for (reuse, _), r in results:
+        assert r['ninputs'] == ninputs
+        assert r['transient_nbytes'] > 0
+        assert (r['arena_nallocs'] > 0) == reuse
+
+    assert not tracemalloc.is_tracing()
+
+
+@pytest.mark.parametrize('dtype, max_relative_rmse', [('int8', 2e-2), ('float16', 1e-3)])
+def test_quantization_error(h5_audios_file, tmpdir, dtype, max_relative_rmse):
+    filepath = str(tmpdir.join('quantized.h5'))
+    hu.quantize_h5_file(h5_audios_file, filepath, dtype=dtype)
+
+    results = hb.quantization_error(
+        make_provider(h5_audios_file),
+        make_provider(filepath),
+        predict=lambda data: data.reshape(len(data), -1),
+    )
+    hu.H5_FILES_POOL.close(filepath)
+
+    assert 0 < results['relative_rmse'] < max_relative_rmse
+    assert results['max_abs_error'] >= results['rmse']
+    assert results['quantized_stored_nbytes'] < results['stored_nbytes']
+    assert results['prediction_agreement'] > 0.9
+    assert results['max_abs_prediction_error'] == results['max_abs_error']
+
+
+@pytest.mark.parametrize('chunk_len', [None, 50])
+def test_rechunk_h5_file(h5_audios_file, tmpdir, chunk_len):
+    filepath = str(tmpdir.join('rechunked.h5'))
+    hb.rechunk_h5_file(h5_audios_file, filepath, chunk_len, **hb.CODECS['gzip1'])
+
+    with h.File(filepath, 'r') as f, h.File(h5_audios_file, 'r') as src:
+        for name in ('audios/0', 'audios/1'):
+            d = f[name]
+            assert d.chunks == (chunk_len or 64, 3)  # pylint: disable=no-member
+            assert d.compression == 'gzip'  # pylint: disable=no-member
+            np.testing.assert_equal(d[()], src[name][()])
+
+        # only the datasets under the root are rewritten
+        assert f['labels/0'].chunks == src['labels/0'].chunks  # pylint: disable=no-member
+        np.testing.assert_equal(f['labels/0'][()], src['labels/0'][()])
+
+
+def test_compare_storage(h5_audios_file, tmpdir):
+    results = hb.compare_storage(
+        h5_audios_file,
+        make_provider,
+        chunk_lens=(None, 50),
+        codecs=['none', 'lzf'],
+        workdir=str(tmpdir),
+    )
+
+    assert [(r['chunk_len'], r['codec']) for r in results] == [
+        (None, 'none'), (None, 'lzf'), (50, 'none'), (50, 'lzf')
+    ]  # yapf: disable
+
+    with h.File(h5_audios_file, 'r') as f:
+        lengths = [len(f['audios/0']), len(f['audios/1'])]
+
+    for r in results:
+        chunk_len = r['chunk_len'] or 64
+        filepath = str(tmpdir.join('{}-{}.h5'.format(r['chunk_len'] or 'asis', r['codec'])))
+        assert os.path.getsize(filepath) == r['file_nbytes']
+        assert r['data_nbytes'] == sum(lengths) * 3 * 4  # float32
+        assert r['nchunks'] == sum(-(-n // chunk_len) for n in lengths)
+        assert r['ninputs'] == r['nchunks'] * 2  # steps_per_chunk
+        assert r['npasses'] == 1 and r['seconds'] > 0
+        if r['codec'] == 'none':  # the last chunks are stored whole
+            assert r['stored_nbytes'] >= r['data_nbytes']
+
+
+@pytest.mark.parametrize('cached', [False, True])
+def test_profile_provider(h5_audios_file, tmpdir, cached):
+    provider = make_provider(h5_audios_file, npasses=2, reuse_read_buffers=True)
+    if cached:
+        provider.cache_in_memory()
+
+    lctxfn = provider.lctxfn
+    expected = [[np.array(i) for i in inputs] for inputs in provider.flow()]
+
+    json_path = str(tmpdir.join('profile.json'))
+    results = hb.profile_provider(provider, npasses=3, json_path=json_path)
+
+    # the timed methods are restored
+    assert not any(name in provider.__dict__ for _, names in hb.STAGES for name in names
+                   if name != 'lctxfn')  # yapf: disable
+    assert provider.lctxfn is lctxfn
+    if cached:
+        assert not any(name in provider.prepped_cache.__dict__ for name in ('get', 'put'))
+
+    flowed = list(provider.flow())
+    assert len(flowed) == len(expected)
+    for inputs, einputs in zip(flowed, expected):
+        for i, ei in zip(inputs, einputs):
+            np.testing.assert_equal(i, ei)
+
+    nchunks = len(provider.chunkings)
+    assert results['npasses'] == 3 and results['nchunks'] == 3 * nchunks
+    assert results['rows'] == 3 * sum(len(i[0]) for i in expected) // 2
+    assert list(results['stage_seconds']) == [stage for stage, _ in hb.STAGES]
+    assert results['seconds'] >= sum(results['stage_seconds'].values())
+    if cached:  # the first pass filled the cache, when flowing the expected
+        assert results['read_nbytes'] == 0
+    else:
+        assert results['read_nbytes'] > 0
+        assert results['stage_seconds']['read'] > 0
+
+    with open(json_path, 'r') as f:
+        exported = json.load(f)
+
+    assert set(exported) == {
+        'totals', 'chunks', 'seconds', 'npasses', 'nchunks', 'rows', 'read_nbytes',
+        'flow_seconds'
+    }  # yapf: disable
+    assert list(exported['totals']) == list(results['stage_seconds'])
+    assert len(exported['chunks']) == results['nchunks']
+    assert sum(c['rows'] for c in exported['chunks']) == results['rows']
+    assert sum(c['read_nbytes'] for c in exported['chunks']) == results['read_nbytes']
+    for c in exported['chunks']:
+        assert set(c) >= {'pass', 'chunk', 'rows', 'read_nbytes', 'steps'}
+        assert 0 <= c['chunk'] < nchunks and 0 <= c['pass'] < 2
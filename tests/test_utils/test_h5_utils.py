@@ -0,0 +1,938 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the h5 utilities
+
+@motjuste
+"""
+from __future__ import division
+from collections import namedtuple
+import os
+import pickle
+import subprocess
+import sys
+import pytest
+import numpy as np
+import numpy.testing as npt
+import h5py as h
+
+from rennet.utils import h5_utils as hu
+from rennet.utils import np_utils as nu
+
+# pylint: disable=redefined-outer-name, missing-docstring
+
+
+@pytest.mark.parametrize('nchunks', [1, 7, 1000])
+def test_chunk_seed_schedule(nchunks):
+    npasses = 5
+    schedule = hu.ChunkSeedSchedule(32, npasses, nchunks)
+
+    orders = [schedule.chunk_order(p) for p in range(npasses)]
+    seeds = [[schedule.seed_for_chunk(p, c) for c in range(nchunks)]
+             for p in range(npasses)]
+
+    for order, pseeds in zip(orders, seeds):
+        npt.assert_equal(np.sort(order), np.arange(nchunks))
+        assert all(0 <= s < hu.ChunkSeedSchedule.MAX_SEED for s in pseeds)
+
+    # any pass can be computed directly, and the same values come back
+    again = hu.ChunkSeedSchedule(32, npasses, nchunks)
+    for p in reversed(range(npasses)):
+        npt.assert_equal(again.chunk_order(p), orders[p])
+        assert [again.seed_for_chunk(p, c) for c in range(nchunks)] == seeds[p]
+
+    if nchunks > 1:
+        other = hu.ChunkSeedSchedule(33, npasses, nchunks)
+        assert any(
+            other.seed_for_chunk(p, c) != seeds[p][c]
+            for p in range(npasses) for c in range(nchunks)
+        )  # yapf: disable
+
+    with pytest.raises(IndexError):
+        schedule.chunk_order(npasses)
+
+
+@pytest.mark.parametrize('seeding', ['philox', 'legacy'])
+def test_rng_for_seed_leaves_global_rng_alone(seeding):
+    np.random.seed(11)
+    expected = np.random.randint(100, size=5)
+
+    np.random.seed(11)
+    rng = hu.rng_for_seed(32, seeding)
+    seeds = hu.randseeds_from(rng, 4)
+    arr = np.arange(10)
+    rng.shuffle(arr)
+    npt.assert_equal(np.random.randint(100, size=5), expected)
+
+    # same seed, same numbers
+    rng = hu.rng_for_seed(32, seeding)
+    npt.assert_equal(hu.randseeds_from(rng, 4), seeds)
+    arr2 = np.arange(10)
+    rng.shuffle(arr2)
+    npt.assert_equal(arr2, arr)
+
+    if seeding == 'legacy':
+        # same as seeding the global rng, like it was done before
+        np.random.seed(32)
+        npt.assert_equal(np.random.randint(hu.ChunkSeedSchedule.MAX_SEED, size=4), seeds)
+        arr3 = np.arange(10)
+        np.random.shuffle(arr3)
+        npt.assert_equal(arr3, arr)
+
+
+def test_h5_files_pool(tmpdir):
+    filepath = str(tmpdir.join('pool.h5'))
+    with h.File(filepath, 'w') as f:
+        for i in range(4):
+            f.create_dataset('d{}'.format(i), data=np.arange(10) * i)
+
+    pool = hu.H5FilesPool(rdcc_nbytes=1024**2, max_open_datasets=2)
+    assert filepath not in pool
+
+    f = pool.get(filepath)
+    assert pool.get(filepath) is f
+    assert filepath in pool
+
+    d = pool.dataset(filepath, 'd1')
+    assert pool.dataset(filepath, 'd1') is d
+    npt.assert_equal(d[2:5], np.arange(2, 5))
+
+    # least recently used ones are let go of
+    pool.dataset(filepath, 'd2')
+    pool.dataset(filepath, 'd3')
+    assert pool.dataset(filepath, 'd1') is not d
+
+    pool.close(filepath)
+    assert filepath not in pool
+    assert not f.id.valid
+
+    # reopened on demand
+    npt.assert_equal(pool.dataset(filepath, 'd3')[:], np.arange(10) * 3)
+
+    # as if forked
+    f = pool.get(filepath)
+    pool._pid = -1  # pylint: disable=protected-access
+    assert filepath not in pool
+    assert pool.get(filepath) is not f
+
+    pool.close()
+    assert filepath not in pool
+
+
+class ChunkingsReader(hu.BaseH5ChunkingsReader):
+    """ Reads each dataset at 'data/*' (and 'labels/*') in chunks of its storage """
+
+    @property
+    def chunkings(self):
+        with h.File(self.filepath, 'r') as f:
+            chunkings = []
+            for name in sorted(f['data'].keys()):
+                d = f['data'][name]
+                chunkings.extend(
+                    hu.Chunking(
+                        datapath=d.name,
+                        dataslice=np.s_[s:s + d.chunks[0], ...],
+                        labelpath='/labels/' + name,
+                        labelslice=np.s_[s:s + d.chunks[0], ...],
+                    ) for s in range(0, d.shape[0], d.chunks[0])
+                )
+
+        return chunkings
+
+    @property
+    def totlen(self):
+        return sum(c.dataslice[0].stop - c.dataslice[0].start for c in self.chunkings)
+
+
+class SteppedSubsamplingInputsProvider(  # pylint: disable=too-many-ancestors
+        ChunkingsReader,
+        hu.AsIsChunkPrepper,
+        hu.BaseClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+@pytest.fixture(scope='module')
+def h5_inputs_file(tmpdir_factory):
+    filepath = str(tmpdir_factory.mktemp('h5_utils').join('inputs.h5'))
+    rng = np.random.RandomState(32)
+    with h.File(filepath, 'w') as f:
+        for i in range(3):
+            n = rng.randint(250, 500)
+            f.create_dataset(
+                'data/{}'.format(i), data=rng.randn(n, 4), chunks=(100, 4)
+            )
+            f.create_dataset(
+                'labels/{}'.format(i),
+                data=np.eye(3)[rng.randint(3, size=n).repeat(5)[:n]],
+                chunks=(100, 3),
+            )
+
+    yield filepath
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def test_legacy_seeding_by_default(h5_inputs_file):
+    kwargs = dict(class_subsample_to_ratios=(1., 0.5, 0.2), shuffle_seed=32, npasses=2)
+    provider = SteppedSubsamplingInputsProvider(h5_inputs_file, **kwargs)
+    assert provider.seeding == 'legacy'
+
+    # the chunk orders, as when seeding the global rng, like it was done before
+    np.random.seed(32)
+    nseeds = 2 * (1 + provider.nchunks)
+    seeds = np.random.randint(hu.ChunkSeedSchedule.MAX_SEED, size=nseeds)
+    for p in range(2):
+        np.random.seed(seeds[p])
+        npt.assert_equal(
+            provider._chunk_order_for_pass(p),  # pylint: disable=protected-access
+            np.random.permutation(provider.nchunks),
+        )
+
+    legacy = SteppedSubsamplingInputsProvider(h5_inputs_file, seeding='legacy', **kwargs)
+    expected = list(legacy.flow())
+    flowed = list(provider.flow())
+    assert len(flowed) == len(expected)
+    for (d, l), (ed, el) in zip(flowed, expected):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+@pytest.mark.parametrize('prefetch_processes', [False, True])
+def test_flow_prefetched_same_as_flow(h5_inputs_file, shuffle_seed, prefetch_processes):
+    provider = SteppedSubsamplingInputsProvider(
+        h5_inputs_file,
+        class_subsample_to_ratios=(1., 0.5, 0.2),
+        steps_per_chunk=2,
+        shuffle_seed=shuffle_seed,
+        npasses=2,
+    )
+
+    expected = list(provider.flow(starting_pass_at=1, starting_chunk_at=2))
+    flowed = list(
+        provider.flow(
+            starting_pass_at=1,
+            starting_chunk_at=2,
+            prefetch=3,
+            prefetch_workers=2,
+            prefetch_processes=prefetch_processes,
+        )
+    )
+
+    assert len(flowed) == len(expected)
+    for (d, l), (ed, el) in zip(flowed, expected):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+    assert provider.prefetch_stats.nchunks == provider.nchunks - 2
+
+
+@pytest.mark.parametrize('slot_nbytes', [1024, 1024**2])
+def test_prefetcher_shared_memory(h5_inputs_file, slot_nbytes):
+    provider = SteppedSubsamplingInputsProvider(
+        h5_inputs_file,
+        class_subsample_to_ratios=(1., 0.5, 0.2),
+        steps_per_chunk=2,
+        shuffle_seed=32,
+        npasses=2,
+    )
+    expected = [provider.prepped_inputs_for_chunk(c[-2], c[-1])
+                for c in provider.chunks_to_flow()]  # yapf: disable
+
+    prefetcher = hu.ChunkPrefetcher(
+        provider,
+        nahead=2,
+        nworkers=2,
+        use_processes=True,
+        use_shared_memory=True,
+        slot_nbytes=slot_nbytes,
+    )
+    try:
+        n = 0
+        prefetched = prefetcher.imap(provider.chunks_to_flow())
+        for (_, inputs), einputs in zip(prefetched, expected):
+            assert len(inputs) == len(einputs) == 2
+            for step, estep in zip(inputs, einputs):
+                for i, ei in zip(step, estep):
+                    npt.assert_equal(i, ei)
+                    assert i.dtype == ei.dtype
+            n += 1
+    finally:
+        prefetcher.close()
+
+    assert n == len(expected)
+    if slot_nbytes == 1024:
+        # the first ones are too large, and the slots then grow
+        assert 0 < prefetcher.stats.nspilled < n
+    else:
+        assert prefetcher.stats.nspilled == 0
+
+
+@pytest.mark.parametrize('shared_memory', [False, True])
+def test_process_prefetched_flow_exits(h5_inputs_file, shared_memory):
+    # the workers were not stopped on python 3.8, and the exit hung waiting for them
+    script = "\n".join([
+        "import sys",
+        "sys.path.insert(0, {!r})".format(os.path.dirname(os.path.abspath(__file__))),
+        "from test_h5_utils import SteppedSubsamplingInputsProvider",
+        "provider = SteppedSubsamplingInputsProvider({!r}, shuffle_seed=32)".format(
+            h5_inputs_file),
+        "kwargs = dict(prefetch=3, prefetch_workers=2, prefetch_processes=True,",
+        "              prefetch_shared_memory={!r})".format(shared_memory),
+        "flow = provider.flow(**kwargs)",
+        "next(flow)",
+        "flow.close()  # while chunks are still being prepped",
+        "print(sum(1 for _ in provider.flow(**kwargs)) == provider.steps_per_pass)",
+    ])  # yapf: disable
+
+    out = subprocess.check_output([sys.executable, '-c', script], timeout=60)
+    assert out.split()[-1] == b'True'
+
+
+@pytest.mark.parametrize('shuffle_buffer', [0, 150])
+@pytest.mark.parametrize('drop_remainder', [False, True])
+def test_fixed_size_batch_repacker(h5_inputs_file, shuffle_buffer, drop_remainder):
+    batch_size = 32
+    provider = SteppedSubsamplingInputsProvider(
+        h5_inputs_file,
+        class_subsample_to_ratios=(1., 0.5, 0.2),
+        steps_per_chunk=3,
+        shuffle_seed=32,
+        npasses=2,
+    )
+    expected = [inputs for inputs in provider.flow()]
+    edata = np.concatenate([d for d, _ in expected])
+    nrows_per_pass = len(edata) // 2
+
+    repacker = hu.FixedSizeBatchRepacker(
+        provider,
+        batch_size,
+        shuffle_buffer=shuffle_buffer,
+        drop_remainder=drop_remainder,
+    )
+    assert repacker.nrows_per_pass == nrows_per_pass
+
+    batches = list(repacker.flow())
+    assert len(batches) == 2 * repacker.steps_per_pass
+
+    sizes = [len(d) for d, _ in batches]
+    nfull, rem = divmod(nrows_per_pass, batch_size)
+    if drop_remainder:
+        assert sizes == [batch_size] * (2 * nfull)
+    else:
+        assert sizes == ([batch_size] * nfull + [rem]) * 2
+
+        data = np.concatenate([d for d, _ in batches])
+        if shuffle_buffer == 0:
+            npt.assert_equal(data, edata)
+        else:
+            # same rows in each pass, but shuffled across chunks
+            for p in range(2):
+                pdata = data[p * nrows_per_pass:(p + 1) * nrows_per_pass]
+                pedata = edata[p * nrows_per_pass:(p + 1) * nrows_per_pass]
+                assert not np.array_equal(pdata, pedata)
+                npt.assert_equal(np.sort(pdata, axis=0), np.sort(pedata, axis=0))
+
+    # deterministic, even when prefetched
+    for (d, l), (ed, el) in zip(repacker.flow(prefetch=2, prefetch_workers=2), batches):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+
+class SteppedBalancingInputsProvider(  # pylint: disable=too-many-ancestors
+        ChunkingsReader,
+        hu.AsIsChunkPrepper,
+        hu.BaseClassBalancingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+def test_class_balancing_provider(h5_inputs_file, shuffle_seed):
+    ratios = (1., 0.5, 0.2)
+    npasses = 3
+    provider = SteppedBalancingInputsProvider(
+        h5_inputs_file,
+        class_subsample_to_ratios=ratios,
+        steps_per_chunk=3,
+        shuffle_seed=shuffle_seed,
+        npasses=npasses,
+    )
+
+    with h.File(h5_inputs_file, 'r') as f:
+        totals = sum(f['labels'][k][()].sum(axis=0) for k in f['labels'])
+        first_labels = f['labels/0'][:100].argmax(axis=1)
+
+    index = provider.class_index
+    npt.assert_equal(index.counts.sum(axis=0), totals)
+    for c in range(3):
+        npt.assert_equal(index.positions(0, c), np.flatnonzero(first_labels == c))
+
+    keep_counts = np.rint(np.array(ratios) * totals)
+    npt.assert_equal(provider.class_keep_counts, keep_counts)
+    assert provider.nrows_per_pass == keep_counts.sum()
+
+    steps = list(provider.flow())
+    spp = provider.steps_per_pass
+    assert len(steps) == npasses * spp
+
+    # exactly to the ratios in each pass
+    passes = [np.concatenate([l for _, l in steps[p * spp:(p + 1) * spp]])
+              for p in range(npasses)]
+    for labels in passes:
+        npt.assert_equal(labels.sum(axis=0), keep_counts)
+
+    if shuffle_seed is None:
+        npt.assert_equal(passes[1], passes[0])
+    else:
+        assert not np.array_equal(passes[1], passes[0])
+
+    # deterministic, even when prefetched
+    for (d, l), (ed, el) in zip(provider.flow(prefetch=2, prefetch_workers=2), steps):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+
+class WithContextSubsamplingInputsProvider(  # pylint: disable=too-many-ancestors
+        ChunkingsReader,
+        hu.AsIsChunkPrepper,
+        hu.BaseWithContextClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+@pytest.mark.parametrize('provider_cls, kwargs', [
+    (SteppedSubsamplingInputsProvider, dict(steps_per_chunk=3)),
+    (SteppedSubsamplingInputsProvider, dict(class_subsample_to_ratios=(1., 0.5, 0.2))),
+    (SteppedBalancingInputsProvider, dict(class_subsample_to_ratios=(1., 0.5, 0.2))),
+    (WithContextSubsamplingInputsProvider, dict(data_context=3, steps_per_chunk=150)),
+    (WithContextSubsamplingInputsProvider, dict(
+        data_context=3, label_subcontext=2, class_subsample_to_ratios=(0.3, 1., 0.7))),
+])  # yapf: disable
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+def test_prepped_labels_for_pass(h5_inputs_file, provider_cls, kwargs, shuffle_seed):
+    provider = provider_cls(h5_inputs_file, shuffle_seed=shuffle_seed, npasses=2, **kwargs)
+
+    for only_labels in [False, True]:
+        steps = list(provider.flow_for_pass(1, only_labels=only_labels))
+        steps = [s for inputs in steps for s in hu.steps_in(inputs)]
+
+        labels, nperstep = provider.prepped_labels_for_pass(1)
+        npt.assert_equal(labels, np.concatenate([l for _, l in steps]))
+        npt.assert_equal(nperstep, [len(l) for _, l in steps])
+
+
+class ClassIndexLabelsPrepper(hu.AsIsChunkPrepper):
+    def prep_label(self, label, **kwargs):  # pylint: disable=unused-argument
+        return label.argmax(axis=-1).astype(np.uint8) if self.label_indices else label
+
+
+@pytest.mark.parametrize('provider_cls, kwargs', [
+    (SteppedSubsamplingInputsProvider, dict(class_subsample_to_ratios=(1., 0.5, 0.2))),
+    (SteppedBalancingInputsProvider, dict(class_subsample_to_ratios=(1., 0.5, 0.2))),
+    (WithContextSubsamplingInputsProvider, dict(
+        data_context=3, label_subcontext=2, class_subsample_to_ratios=(0.3, 1., 0.7))),
+    (WithContextSubsamplingInputsProvider, dict(
+        data_context=3, label_subcontext=3,
+        label_from_subcontext_fn=hu.max_label_for_subcontext)),
+])  # yapf: disable
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+def test_flow_label_indices(h5_inputs_file, provider_cls, kwargs, shuffle_seed):
+    provider_cls = type('Indexed' + provider_cls.__name__,
+                        (ClassIndexLabelsPrepper, provider_cls), {})
+    kwargs = dict(kwargs, shuffle_seed=shuffle_seed, npasses=2, reuse_read_buffers=True)
+
+    expected = list(provider_cls(h5_inputs_file, **kwargs).flow())
+    provider = provider_cls(h5_inputs_file, label_indices=True, **kwargs)
+    flowed = list(provider.flow())
+    assert len(flowed) == len(expected)
+    for (d, l), (ed, el) in zip(flowed, expected):
+        assert l.dtype == np.uint8 and l.shape == el.shape[:1]
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el.argmax(axis=-1))
+
+    onehot = hu.onehot_labels(flowed, 3, dtype=expected[0][1].dtype)
+    for (d, l), (ed, el) in zip(onehot, expected):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+    labels, _ = provider.prepped_labels_for_pass(1)
+    assert labels.dtype == np.uint8 and labels.ndim == 1
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_flow_resumes_from_cursor(h5_inputs_file, tmpdir, prefetch):
+    kwargs = dict(class_subsample_to_ratios=(1., 0.5, 0.2), steps_per_chunk=3, npasses=2)
+    provider = SteppedSubsamplingInputsProvider(h5_inputs_file, shuffle_seed=32, **kwargs)
+    expected = list(provider.flow(prefetch=prefetch))
+    assert provider.cursor.nflowed == len(expected)
+
+    filepath = str(tmpdir.join('cursor.json'))
+    for nflowed in [0, 1, 4, len(expected) // 2, len(expected) - 1]:
+        provider = SteppedSubsamplingInputsProvider(h5_inputs_file, shuffle_seed=32, **kwargs)
+        flow = provider.flow(prefetch=prefetch)
+        for _ in range(min(nflowed + 3, len(expected))):  # flowing ahead, like Keras
+            next(flow)
+
+        provider.cursor_after(nflowed).save(filepath)
+        flow.close()
+
+        # a fresh provider, which doesn't flow the earlier inputs
+        provider = SteppedSubsamplingInputsProvider(h5_inputs_file, shuffle_seed=32, **kwargs)
+        resumed = list(provider.flow(starting_cursor=hu.FlowCursor.load(filepath)))
+        assert len(resumed) == len(expected) - nflowed
+        for (d, l), (ed, el) in zip(resumed, expected[nflowed:]):
+            npt.assert_equal(d, ed)
+            npt.assert_equal(l, el)
+
+    provider = SteppedSubsamplingInputsProvider(h5_inputs_file, shuffle_seed=33, **kwargs)
+    with pytest.raises(ValueError):
+        next(provider.flow(starting_cursor=hu.FlowCursor.load(filepath)))
+
+
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+def test_sharded_providers(h5_inputs_file, shuffle_seed):
+    kwargs = dict(class_subsample_to_ratios=(1., 0.5, 0.2), steps_per_chunk=3, npasses=2)
+    provider = SteppedBalancingInputsProvider(h5_inputs_file, shuffle_seed=shuffle_seed, **kwargs)
+    lengths = provider.chunk_lengths
+
+    num_shards = 3
+    shards_chunks = []
+    nrows = 0
+    for index in range(num_shards):
+        provider = SteppedBalancingInputsProvider(
+            h5_inputs_file, shuffle_seed=shuffle_seed, **kwargs
+        ).shard(num_shards, index)
+
+        flowed = list(provider.flow(with_chunking=True))
+        spp = provider.steps_per_pass
+        assert len(flowed) == 2 * spp
+
+        # the same chunks, and number of rows, in every pass
+        chunks = [sorted(set(c[0][0] for _, c in flowed[p * spp:(p + 1) * spp]))
+                  for p in range(2)]
+        assert chunks[0] == chunks[1]
+        for p in range(2):
+            assert sum(len(l) for (_, l), _ in flowed[p * spp:(p + 1) * spp]) == (
+                provider.nrows_per_pass
+            )
+
+        shards_chunks.append(chunks[0])
+        nrows += provider.nrows_per_pass
+
+    # disjoint, complete, and balanced by length
+    assert sorted(sum(shards_chunks, [])) == list(range(len(lengths)))
+    shards_lengths = [lengths[c].sum() for c in shards_chunks]
+    assert max(shards_lengths) - min(shards_lengths) <= 2 * lengths.max()
+    assert nrows == provider.class_keep_counts.sum()
+
+
+@pytest.mark.parametrize('shuffle_seed', [None, 32])
+@pytest.mark.parametrize('max_nbytes', [2**30, 2000, 0])
+def test_providers_cached_in_memory(h5_inputs_file, shuffle_seed, max_nbytes):
+    kwargs = dict(class_subsample_to_ratios=(1., 0.5, 0.2), steps_per_chunk=3, npasses=2)
+    expected = list(
+        SteppedSubsamplingInputsProvider(
+            h5_inputs_file, shuffle_seed=shuffle_seed, **kwargs
+        ).flow()
+    )
+
+    provider = SteppedSubsamplingInputsProvider(
+        h5_inputs_file, shuffle_seed=shuffle_seed, **kwargs
+    ).cache_in_memory(max_nbytes)
+    for _ in range(2):  # the second time is served (completely or partly) from memory
+        flowed = list(provider.flow())
+        assert len(flowed) == len(expected)
+        for (d, l), (ed, el) in zip(flowed, expected):
+            npt.assert_equal(d, ed)
+            npt.assert_equal(l, el)
+
+    cache = provider.prepped_cache
+    assert cache.nbytes <= max_nbytes
+    assert cache.complete == (max_nbytes == 2**30)
+    if max_nbytes == 0:
+        assert cache.nhits == 0
+    else:
+        assert cache.nhits >= cache.cached.sum() * (2 * 2 - 1)
+
+
+class NormalizingInputsProvider(  # pylint: disable=too-many-ancestors
+        ChunkingsReader,
+        hu.BaseChunkMeanVarianceNormalizer,
+        hu.AsIsChunkPrepper,
+        hu.BaseClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+def test_precomputed_chunk_stats(h5_inputs_file, tmpdir):
+    sidecar = str(tmpdir.join('stats.npz'))
+    kwargs = dict(std_it=True, steps_per_chunk=2, shuffle_seed=32, npasses=2)
+
+    expected = list(NormalizingInputsProvider(h5_inputs_file, **kwargs).flow())
+    provider = NormalizingInputsProvider(
+        h5_inputs_file, precomputed_stats=sidecar, **kwargs
+    )
+    flowed = list(provider.flow())
+
+    assert len(flowed) == len(expected)
+    for (d, l), (ed, el) in zip(flowed, expected):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+    stats = provider.chunk_stats
+    assert len(stats) == provider.nchunks
+    chunking = provider.chunkings[0]
+    data = hu.H5_FILES_POOL.dataset(h5_inputs_file, chunking.datapath)[chunking.dataslice]
+    mean, std = stats.stats_for(chunking)
+    npt.assert_almost_equal(mean, data.mean(axis=0))
+    npt.assert_almost_equal(std, data.std(axis=0))
+
+    # persisted, and computed again only for the missing chunks
+    fingerprint = hu.ChunkStats._fingerprint(h5_inputs_file)  # pylint: disable=protected-access
+    loaded = hu.ChunkStats.load(sidecar, fingerprint)
+    assert loaded.keys == stats.keys
+    assert hu.ChunkStats.load(sidecar, fingerprint + 'changed') is None
+
+    chunkings = provider.chunkings[:1] + [
+        chunking._replace(dataslice=np.s_[0:10, ...]),
+    ]
+    more = hu.ChunkStats.for_chunkings(h5_inputs_file, chunkings, sidecar=sidecar)
+    assert len(more) == len(stats) + 1
+    npt.assert_almost_equal(more.stats_for(chunkings[-1])[0], data[:10].mean(axis=0))
+
+    # computed again, and saved, when the sidecar is corrupt, e.g. truncated
+    with open(sidecar, 'rb') as f:
+        saved = f.read()
+
+    for corrupt in (saved[:len(saved) // 2], saved[:2], b''):
+        with open(sidecar, 'wb') as f:
+            f.write(corrupt)
+        assert hu.ChunkStats.load(sidecar, fingerprint) is None
+
+        provider = NormalizingInputsProvider(
+            h5_inputs_file, precomputed_stats=sidecar, **kwargs
+        )
+        assert provider.chunk_stats.keys == stats.keys
+        assert hu.ChunkStats.load(sidecar, fingerprint).keys == stats.keys
+        for (d, _), (ed, _) in zip(provider.flow(), expected):
+            npt.assert_equal(d, ed)
+
+    # without a reader, there are no chunkings to compute the stats for
+    class Normalizer(hu.BaseChunkMeanVarianceNormalizer, hu.AsIsChunkPrepper):  # pylint: disable=abstract-method
+        pass
+
+    with pytest.raises(TypeError):
+        _ = Normalizer(h5_inputs_file, precomputed_stats=True).chunk_stats
+
+
+@pytest.mark.parametrize('provider_cls, kwargs, reused', [
+    (SteppedSubsamplingInputsProvider, dict(shuffle_seed=32), True),
+    (SteppedSubsamplingInputsProvider, dict(shuffle_seed=None), True),
+    (WithContextSubsamplingInputsProvider, dict(data_context=2, shuffle_seed=32), True),
+    # the unshuffled steps are views of the chunk, which hence can't be reused
+    (WithContextSubsamplingInputsProvider, dict(data_context=2), False),
+])  # yapf: disable
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_flow_reusing_read_buffers(  # pylint: disable=too-many-arguments
+        h5_inputs_file, provider_cls, kwargs, reused, prefetch):
+    kwargs = dict(kwargs, steps_per_chunk=3, npasses=2)
+    expected = [[np.array(i) for i in inputs]
+                for inputs in provider_cls(h5_inputs_file, **kwargs).flow()]
+
+    provider = provider_cls(h5_inputs_file, reuse_read_buffers=True, **kwargs)
+    flowed = [[np.array(i) for i in inputs]
+              for inputs in provider.flow(prefetch=prefetch)]
+
+    assert len(flowed) == len(expected)
+    for (d, l), (ed, el) in zip(flowed, expected):
+        npt.assert_equal(d, ed)
+        npt.assert_equal(l, el)
+
+    # a buffer each for data and labels (of the one prefetching thread, if any)
+    assert provider.read_arena.nallocs == (2 if reused else 0)
+
+
+def test_read_arena():
+    arena = hu.ReadArena()
+    small = arena.buffer('data', 3, (2, ), np.float32)
+    assert small.shape == (3, 2) and small.flags.c_contiguous
+    assert arena.buffer('data', 2, (2, ), np.float32).base is small.base
+    assert arena.buffer('label', 2, (2, ), np.float32).base is not small.base
+    assert arena.buffer('data', 5, (2, ), np.float32).base is not small.base
+    assert arena.nallocs == 3
+
+    # shared by the same arena in the same process, when pickled
+    assert pickle.loads(pickle.dumps(arena)) is pickle.loads(pickle.dumps(arena))
+
+
+@pytest.mark.parametrize('dtype, atol', [('int8', 0.05), ('float16', 0.005)])
+def test_quantized_storage(h5_inputs_file, tmpdir, dtype, atol):
+    data = np.random.RandomState(32).randn(100, 3, 2) * [[10, 1]] + [[5, -1]]
+    stored, scale, offset = hu.quantize(data, dtype)
+    assert stored.dtype == dtype
+    if dtype == 'int8':
+        assert scale.shape == offset.shape == (3, 1)
+        npt.assert_allclose(hu.dequantize(stored, scale, offset), data, atol=scale.max())
+
+    filepath = str(tmpdir.join('quantized.h5'))
+    hu.quantize_h5_file(h5_inputs_file, filepath, root='data', dtype=dtype)
+    with h.File(filepath, 'r') as f, h.File(h5_inputs_file, 'r') as src:
+        assert f['data/0'].dtype == dtype and f['data/0'].chunks == (100, 4)  # pylint: disable=no-member
+        npt.assert_equal(f['labels/0'][()], src['labels/0'][()])
+        assert hu.quantization_of(f['data/0']) is not None
+        assert hu.quantization_of(src['data/0']) is None
+
+    # dequantized on read, fused with normalization, and with none
+    for provider_cls, kwargs in [
+        (NormalizingInputsProvider, dict(std_it=True, steps_per_chunk=2)),
+        (NormalizingInputsProvider, dict(mean_it=False, precomputed_stats=True)),
+        (SteppedSubsamplingInputsProvider, dict(reuse_read_buffers=True)),
+    ]:  # yapf: disable
+        expected = list(provider_cls(h5_inputs_file, shuffle_seed=32, **kwargs).flow())
+        flowed = list(provider_cls(filepath, shuffle_seed=32, **kwargs).flow())
+        assert len(flowed) == len(expected)
+        for (d, l), (ed, el) in zip(flowed, expected):
+            assert d.dtype == np.float32
+            npt.assert_allclose(d, ed, atol=atol * np.abs(ed).max())
+            npt.assert_equal(l, el)
+
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def test_h5_chunk_index_sidecar(tmpdir):
+    filepath = str(tmpdir.join('index.h5'))
+    with h.File(filepath, 'w') as f:
+        f.create_dataset('data/b/1', data=np.zeros((250, 2, 2)), chunks=(100, 2, 2))
+        f.create_dataset('data/a/1', data=np.zeros((100, 3)), chunks=(30, 3))
+        f['data'].attrs['chunk_overlap'] = 4
+
+    index = hu.H5ChunkIndex.for_file(filepath, 'data')
+    sidecar = hu.H5ChunkIndex.sidecar_path(filepath, 'data')
+    assert tmpdir.join(sidecar.split('/')[-1]).check()
+
+    assert index.root == '/data'
+    assert index.names == ['a/1', 'b/1']
+    npt.assert_equal(index.nchannels, [0, 2])
+    assert index.attrs == {'chunk_overlap': 4}
+    npt.assert_equal(index.chunks_for('a/1')['start'], [0, 30, 60, 90])
+    npt.assert_equal(index.chunks_for('a/1')['end'], [30, 60, 90, 100])
+    npt.assert_equal(index.chunks_for('b/1')['start'], [0, 100, 200])
+    assert index.totlen_for('b/1') == 250
+
+    loaded = hu.H5ChunkIndex.for_file(filepath, 'data')
+    assert loaded.names == index.names
+    npt.assert_equal(loaded.table, index.table)
+    assert loaded.table.dtype == hu.CHUNK_INDEX_DTYPE
+
+    # invalidated when the file changes
+    hu.H5_FILES_POOL.close(filepath)
+    with h.File(filepath, 'a') as f:
+        f.create_dataset('data/c', data=np.zeros((10, 3)), chunks=(10, 3))
+
+    changed = hu.H5ChunkIndex.for_file(filepath, 'data')
+    assert changed.names == ['a/1', 'b/1', 'c']
+    assert changed.totlen_for('c') == 10
+    hu.H5_FILES_POOL.close(filepath)
+
+    # rebuilt, and saved again, when the sidecar is corrupt, e.g. truncated
+    fingerprint = hu.H5ChunkIndex._fingerprint(filepath, 'data')  # pylint: disable=protected-access
+    with open(sidecar, 'rb') as f:
+        saved = f.read()
+
+    for corrupt in (saved[:len(saved) // 2], saved[:2], b''):
+        with open(sidecar, 'wb') as f:
+            f.write(corrupt)
+        assert hu.H5ChunkIndex.load(sidecar, fingerprint) is None
+
+        rebuilt = hu.H5ChunkIndex.for_file(filepath, 'data')
+        assert rebuilt.names == changed.names
+        npt.assert_equal(rebuilt.table, changed.table)
+        assert hu.H5ChunkIndex.load(sidecar, fingerprint).names == changed.names
+
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def reference_dominant_label_for_subcontext(labels_in_subcontext):
+    return nu.to_categorical(
+        labels_in_subcontext.sum(axis=-2).argmax(axis=-1),
+        nclasses=labels_in_subcontext.shape[-1]
+    )
+
+
+def reference_max_label_for_subcontext(labels_in_subcontext):
+    return nu.to_categorical(
+        labels_in_subcontext.argmax(axis=-1).max(axis=-1),
+        nclasses=labels_in_subcontext.shape[-1]
+    )
+
+
+@pytest.mark.parametrize('fn, reference_fn', [
+    (hu.dominant_label_for_subcontext, reference_dominant_label_for_subcontext),
+    (hu.max_label_for_subcontext, reference_max_label_for_subcontext),
+])
+@pytest.mark.parametrize('dctx, lctx', [(0, 0), (3, 0), (3, 1), (5, 5), (20, 12)])
+@pytest.mark.parametrize('dtype', [np.float64, np.uint8])
+def test_label_from_subcontext_fns(fn, reference_fn, dctx, lctx, dtype):
+    rng = np.random.RandomState(32)
+    nclasses = 4
+    label = nu.to_categorical(
+        rng.randint(nclasses, size=500).repeat(rng.randint(1, 6, size=500))[:1000],
+        nclasses=nclasses,
+        dtype=dtype,
+    )
+
+    # like in BaseWithContextPrepper
+    if dctx > 0:
+        label = nu.strided_view(label, win_shape=1 + 2 * dctx, step_shape=1)
+        label = label[:, dctx - lctx:dctx + lctx + 1, ...]
+    else:
+        label = label[:, np.newaxis, ...]
+
+    expected = reference_fn(label)
+    npt.assert_equal(fn(label), expected)
+    npt.assert_equal(fn(label[::3]), expected[::3])  # not consecutive windows
+    npt.assert_equal(fn(label.copy()), expected)
+
+
+class IndexedChunkingsReader(hu.BaseH5ChunkingsReader):
+    """ Reads the datasets at 'data/*' (and 'labels/*') in read units of the index """
+
+    def __init__(self, filepath, read_chunk_len=None, data_context=0, **kwargs):
+        self.read_chunk_len = read_chunk_len
+        self.overlap = 0
+        self._data_context = 2 * data_context
+        super(IndexedChunkingsReader, self).__init__(
+            filepath, data_context=data_context, **kwargs
+        )
+
+    @property
+    def chunkings(self):
+        index = hu.H5ChunkIndex.for_file(self.filepath, 'data', persist=False)
+        self.overlap = int(index.attrs.get('chunk_overlap', 0))
+        return hu.ChunkingTable.from_index_table(
+            datapaths=['/data/' + n for n in index.names],
+            labelpaths=['/labels/' + n for n in index.names],
+            table=index.read_units_for_all(
+                index.names, self.read_chunk_len, self.overlap, self._data_context
+            ),
+            overlap=self.overlap,
+            storage_lens=index.chunk_lens,
+        )
+
+    @property
+    def totlen(self):
+        return self.chunkings.lengths.sum()
+
+
+class IndexedWithContextInputsProvider(  # pylint: disable=too-many-ancestors
+        IndexedChunkingsReader,
+        hu.AsIsChunkPrepper,
+        hu.BaseWithContextSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+@pytest.mark.parametrize('read_chunk_len', [None, 60, 150, 500])
+@pytest.mark.parametrize('reuse_read_buffers', [False, True])
+def test_read_units_with_chunk_overlap(tmpdir, read_chunk_len, reuse_read_buffers):
+    # stored like 'chunk_overlap' for ka3, i.e. as windows of the frames, of the length
+    # of the storage chunks, and overlapping by `overlap`
+    filepath = str(tmpdir.join('overlapped.h5'))
+    chunk_len, overlap, data_context = 100, 6, 2
+    nframes = [chunk_len, 250, 400]
+    with h.File(filepath, 'w') as f:
+        for i, n in enumerate(nframes):
+            frames = np.arange(n)
+            windows = nu.strided_view(frames, chunk_len, chunk_len - overlap)
+            f.create_dataset(
+                'data/{}'.format(i), data=windows.reshape(-1, 1), chunks=(chunk_len, 1)
+            )
+            f.create_dataset(
+                'labels/{}'.format(i),
+                data=np.eye(2)[windows.ravel() % 2],
+                chunks=(chunk_len, 2),
+            )
+
+        f['data'].attrs['chunk_overlap'] = overlap
+
+    provider = IndexedWithContextInputsProvider(
+        filepath,
+        read_chunk_len=read_chunk_len,
+        data_context=data_context,
+        steps_per_chunk=1,
+        add_channel_at_end=False,
+        reuse_read_buffers=reuse_read_buffers,
+    )
+    chunkings = provider.chunkings
+    if read_chunk_len is not None:
+        assert (chunkings.end - chunkings.start).max() <= read_chunk_len
+        assert (chunkings.nseams > 0).any() == (read_chunk_len >= 2 * chunk_len)
+
+    # each frame with enough context in the stored windows, exactly once, with its label
+    nstored = [overlap + (n - overlap) // (chunk_len - overlap) * (chunk_len - overlap)
+               for n in nframes]  # yapf: disable
+    flowed = list(provider.flow())
+    assert len(flowed) == len(chunkings)
+    npt.assert_equal(provider.chunk_lengths, [len(data) + 2 * data_context for data, _ in flowed])
+
+    centers = [[] for _ in nframes]
+    for (data, label), chunking in zip(flowed, chunkings):
+        c = data[:, data_context, 0]
+        npt.assert_equal(data[:, :, 0], c[:, None] + np.arange(-2, 3))
+        npt.assert_equal(label.argmax(axis=-1), c % 2)
+        centers[chunkings.datapaths.index(chunking.datapath)].extend(c)
+
+    for c, n in zip(centers, nstored):
+        npt.assert_equal(sorted(c), np.arange(data_context, n - data_context))
+
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def test_chunking_table():
+    SwapChunking = namedtuple(
+        'SwapChunking',
+        ['datapath', 'dataslice', 'swapchannels', 'labelpath', 'labelslice'],
+    )
+    table = hu.ChunkingTable(
+        datapaths=['/data/g0/a', '/data/g0/b', '/data/g1/a'],
+        labelpaths=['/labels/g0/a', '/labels/g0/b', '/labels/g1/a'],
+        dataset=[0, 0, 2, 1, 1],
+        start=[0, 10, 0, 0, 5],
+        end=[10, 12, 7, 5, 9],
+        swap=[False, False, True, False, True],
+        chunking_cls=SwapChunking,
+    )
+    assert len(table) == 5
+    assert table[2] == SwapChunking(
+        '/data/g1/a', np.s_[0:7, ...], True, '/labels/g1/a', np.s_[0:7, ...]
+    )
+    assert list(table)[-1] == table[-1]
+    assert table[np.int64(1)].dataslice == np.s_[10:12, ...]
+
+    sub = table[[4, 0]]
+    assert isinstance(sub, hu.ChunkingTable)
+    assert [c.datapath for c in sub] == ['/data/g0/b', '/data/g0/a']
+
+    g0 = table.for_datapaths('*/g0/*')
+    assert [c.datapath for c in g0] == ['/data/g0/a'] * 2 + ['/data/g0/b'] * 2
+    assert [c.dataslice[0].stop for c in table.for_datapaths('*/a')] == [10, 12, 7]
+    assert len(table.for_datapaths(['/data/g0/b'])) == 2
+    assert len(table.for_datapaths(lambda p: p.startswith('/data/g1'))) == 1
+    assert len(table.where(table.swap)) == 2
+
+    # plain Chunking, without the swap
+    plain = hu.ChunkingTable(table.datapaths, table.labelpaths, [1], [3], [4])
+    assert plain[0] == hu.Chunking(
+        '/data/g0/b', np.s_[3:4, ...], '/labels/g0/b', np.s_[3:4, ...]
+    )
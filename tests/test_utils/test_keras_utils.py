@@ -0,0 +1,197 @@
+#  Copyright 2018 Fraunhofer IAIS. All rights reserved.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Test the keras utilities
+
+@motjuste
+"""
+from __future__ import division
+import pytest
+import numpy as np
+import numpy.testing as npt
+import h5py as h
+
+from rennet.utils import h5_utils as hu
+from rennet.utils import keras_utils as ku
+from rennet.utils import np_utils as nu
+
+# pylint: disable=redefined-outer-name, missing-docstring
+
+
+class ChunkingsReader(hu.BaseH5ChunkingsReader):
+    """ Reads each dataset at 'data/*' (and 'labels/*') in chunks of its storage """
+
+    @property
+    def chunkings(self):
+        with h.File(self.filepath, 'r') as f:
+            chunkings = []
+            for name in sorted(f['data'].keys()):
+                d = f['data'][name]
+                chunkings.extend(
+                    hu.Chunking(
+                        datapath=d.name,
+                        dataslice=np.s_[s:s + d.chunks[0], ...],
+                        labelpath='/labels/' + name,
+                        labelslice=np.s_[s:s + d.chunks[0], ...],
+                    ) for s in range(0, d.shape[0], d.chunks[0])
+                )
+
+        return chunkings
+
+    @property
+    def totlen(self):
+        return sum(c.dataslice[0].stop - c.dataslice[0].start for c in self.chunkings)
+
+
+class ClassIndexLabelsPrepper(hu.AsIsChunkPrepper):
+    def prep_label(self, label, **kwargs):  # pylint: disable=unused-argument
+        return label.argmax(axis=-1).astype(np.uint8) if self.label_indices else label
+
+
+class SteppedInputsProvider(  # pylint: disable=too-many-ancestors
+        ChunkingsReader,
+        ClassIndexLabelsPrepper,
+        hu.BaseClassSubsamplingSteppedInputsProvider,
+):  # yapf: disable
+    pass
+
+
+class ThresholdModel(object):  # pylint: disable=too-few-public-methods
+    """ "Predicts" the class of each row by thresholding its first value """
+
+    @staticmethod
+    def predict_on_batch(data):
+        return nu.to_categorical(np.digitize(data[:, 0], [-0.5, 0.5]), nclasses=3)
+
+
+def datasets_in(f):
+    paths = []
+
+    def visit(path, obj):
+        if isinstance(obj, h.Dataset):
+            paths.append(path)
+
+    f.visititems(visit)
+    return paths
+
+
+@pytest.fixture
+def h5_inputs_file(tmpdir):
+    filepath = str(tmpdir.join('inputs.h5'))
+    rng = np.random.RandomState(32)
+    with h.File(filepath, 'w') as f:
+        for i in range(3):
+            n = rng.randint(250, 500)
+            f.create_dataset('data/{}'.format(i), data=rng.randn(n, 4), chunks=(50, 4))
+            f.create_dataset(
+                'labels/{}'.format(i),
+                data=np.eye(3)[rng.randint(3, size=n)],
+                chunks=(50, 3),
+            )
+
+    yield filepath
+    hu.H5_FILES_POOL.close(filepath)
+
+
+def test_predict_on_shuffled_inputs_provider(h5_inputs_file, tmpdir):
+    filepath = h5_inputs_file
+    provider = SteppedInputsProvider(filepath, steps_per_chunk=2, shuffle_seed=32)
+
+    # the labelpaths come again after others
+    labelpaths = [c.labelpath for _, (_, c) in provider.flow(with_chunking=True)]
+    changes = [p for i, p in enumerate(labelpaths) if i == 0 or p != labelpaths[i - 1]]
+    assert len(changes) > len(set(labelpaths))
+
+    exportdir = str(tmpdir.mkdir('predictions'))
+    confs = ku.predict_on_inputs_provider(ThresholdModel(), provider, exportdir)
+
+    with h.File(filepath, 'r') as f:
+        expected = {
+            '/labels/' + name: (
+                f['labels'][name][()],
+                ThresholdModel.predict_on_batch(f['data'][name][()]),
+            ) for name in f['data']
+        }  # yapf: disable
+
+    exportpath = str(tmpdir.join('predictions', 'predictions.h5'))
+
+    def check_exported(confs):
+        with h.File(exportpath, 'r') as f:
+            for labelpath, (trues, preds) in expected.items():
+                conf = nu.confusion_matrix_forcategorical(trues, preds)
+                npt.assert_equal(confs[labelpath].confusion, conf)
+                npt.assert_equal(f['confs' + labelpath][()], conf)
+
+                # all the rows, in the order they were provided in
+                assert len(f['trues' + labelpath]) == len(trues)
+                npt.assert_equal(
+                    nu.confusion_matrix_forcategorical(
+                        f['trues' + labelpath][()], f['preds' + labelpath][()]
+                    ),
+                    conf,
+                )
+
+            return {path: f[path][()] for path in datasets_in(f)}
+
+    exported = check_exported(confs)
+    assert len(exported) == 3 * len(expected)  # trues, preds and confs
+
+    # results from earlier are not appended to, or overwritten
+    confs = ku.predict_on_inputs_provider(ThresholdModel(), provider, exportdir)
+    reexported = check_exported(confs)
+    assert sorted(reexported) == sorted(exported)
+    for path, data in exported.items():
+        assert reexported[path].shape == data.shape
+        npt.assert_equal(reexported[path], data)
+
+
+@pytest.mark.parametrize('label_indices', [False, True])
+@pytest.mark.parametrize('steps_per_epoch', [None, 7])
+def test_chatty_confusion_history(h5_inputs_file, tmpdir, label_indices, steps_per_epoch):
+    provider = SteppedInputsProvider(
+        h5_inputs_file,
+        steps_per_chunk=2,
+        npasses=2,
+        shuffle_seed=None,
+        label_indices=label_indices,
+        nclasses=3,
+    )
+    callback = ku.ChattyConfusionHistory(
+        provider, export_dir=str(tmpdir), steps_per_epoch=steps_per_epoch
+    )
+    callback.model = ThresholdModel()
+
+    # the steps evaluated, each pass being the same, as not shuffling
+    steps = list(provider.flow())[:steps_per_epoch]
+    if steps_per_epoch is None:
+        assert len(steps) == provider.steps_per_pass * 2
+
+    trues = np.concatenate([
+        nu.to_categorical(y, nclasses=3) if label_indices else y for _, y in steps
+    ])  # yapf: disable
+    preds = np.concatenate([ThresholdModel.predict_on_batch(x) for x, _ in steps])
+    conf = nu.confusion_matrix_forcategorical(trues, preds)
+
+    callback.on_train_begin()
+    callback.on_epoch_end(0)
+    callback.on_train_end()
+
+    with h.File(str(tmpdir.join('confusions.h5')), 'r') as f:
+        npt.assert_equal(f['trues'][()], trues)
+        for predspath, confspath in [
+                ('initial/preds', 'initial/confs'),
+                ('preds/0/0', 'confs/0/0'),
+                ('final/preds', 'final/confs'),
+        ]:  # yapf: disable
+            npt.assert_equal(f[predspath][()], preds)
+            npt.assert_equal(f[confspath][()], conf)
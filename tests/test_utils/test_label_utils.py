@@ -1068,6 +1068,60 @@ def test_from_dense_ContiSeqLabels(from_dense_labels_start_and_sr_small_seqdata)
         s = lu.ContiguousSequenceLabels.from_dense_labels(labels, keep=9)
 
 
+@pytest.fixture(
+    scope='module',
+    params=[None, np.argmax],
+    ids=lambda k: "key={}".format(getattr(k, '__name__', k)),  #pylint: disable=unnecessary-lambda
+)
+def dense_labels_keyfn(request):
+    keyfn = request.param
+    tokens = np.repeat([0, 1, 1, 2, 0, 2, 1], [3, 1, 4, 2, 5, 1, 2])
+    if keyfn is None:
+        labels = tokens
+    else:
+        labels = np.eye(3)[tokens] * 0.8 + 0.1  # categorical-like
+
+    return labels, keyfn
+
+
+@pytest.mark.dense
+@pytest.mark.parametrize('keep', ['keys', 'labels', 'both'])
+def test_from_dense_vectorized_same_as_groupby(dense_labels_keyfn, keep):
+    labels, keyfn = dense_labels_keyfn
+
+    # lists of labels go through itertools.groupby
+    s_ref = lu.SequenceLabels.from_dense_labels(
+        list(labels), keyfn, keep=keep, min_start=3, samplerate=100
+    )
+    s = lu.SequenceLabels.from_dense_labels(
+        labels, keyfn, keep=keep, min_start=3, samplerate=100
+    )
+
+    npt.assert_array_equal(s.starts_ends, s_ref.starts_ends)
+    if keep == 'keys':
+        npt.assert_array_equal(s.labels, s_ref.labels)
+    else:
+        assert len(s.labels) == len(s_ref.labels)
+
+    c = lu.ContiguousSequenceLabels.from_dense_labels(
+        labels, keyfn, keep='keys', min_start=3, samplerate=100
+    )
+    npt.assert_array_equal(c.starts_ends, s_ref.starts_ends)
+
+    # an explicitly vectorized key function
+    if keyfn is not None:
+        c = lu.ContiguousSequenceLabels.from_dense_labels(
+            labels,
+            lambda l: l.argmax(axis=-1),
+            keep='keys',
+            min_start=3,
+            samplerate=100,
+            keyfn_vectorized=True,
+        )
+        npt.assert_array_equal(c.starts_ends, s_ref.starts_ends)
+        npt.assert_array_equal(c.labels, labels.argmax(axis=-1)[c.starts_ends[:, 0] - 3])
+
+
 @pytest.fixture
 def viterbi_wiki_data():
     # obs = ('normal', 'cold', 'dizzy')
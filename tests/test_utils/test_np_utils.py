@@ -439,6 +439,15 @@ def test_tocategorical_predP_batB_seqLQ_generic(predP_batB_seqlQ_cls3_generic_ca
     assert True
 
 
+@pytest.mark.parametrize('dtype', [np.float, np.float32, np.uint8])
+def test_tocategorical_dtype(base_labels_cls3, dtype):
+    y = base_labels_cls3[:-1]  # exclude extra classes
+    Y = nu.to_categorical(y, nclasses=3, dtype=dtype)
+
+    assert Y.dtype == dtype
+    assert_almost_equal(Y, ext_tocategorical(y.ravel(), num_classes=3).reshape(Y.shape))
+
+
 ## FIXTURES AND TESTS FOR CONFUSION MATRIX CALCULATIONS #######################
 
 
@@ -1008,6 +1017,76 @@ def test_pred1_batB_seql1_confmat_printing(pred1_batB_seql1_cls3_preds_confmat):
     assert True
 
 
+@pytest.mark.confmat
+@pytest.mark.parametrize('axis', [None, 0, 1, 2])
+def test_confmat_bincount_batched_as_categorical(axis):
+    rng = np.random.RandomState(32)
+    nclasses = 4
+    yt = rng.randint(nclasses, size=(5, 7))
+    yp = rng.randint(nclasses, size=(3, 5, 7))
+
+    Yt = nu.to_categorical(yt, nclasses)
+    Yp = nu.to_categorical(yp, nclasses)
+
+    for keepdims in (True, False):
+        conf = nu.confusion_matrix(yt, yp, nclasses, axis=axis, keepdims=keepdims)
+        confcat = nu.confusion_matrix_forcategorical(Yt, Yp, axis=axis, keepdims=keepdims)
+
+        assert conf.shape == confcat.shape
+        assert_almost_equal(conf, confcat)
+
+    with pytest.raises(ValueError):
+        nu.confusion_matrix(yt, yp, nclasses, axis=3)
+
+    with pytest.raises(RuntimeError):
+        nu.confusion_matrix(yt, yp, nclasses - 1)
+
+
+@pytest.mark.confmat
+def test_confusion_accumulator_streaming_and_merging():
+    rng = np.random.RandomState(32)
+    nclasses = 3
+    yt = rng.randint(nclasses, size=(10, 50))
+    yp = rng.randint(nclasses, size=(10, 50))
+
+    acc = nu.ConfusionAccumulator(nclasses)
+    acc_even, acc_odd = nu.ConfusionAccumulator(nclasses), nu.ConfusionAccumulator(nclasses)
+    for i, (t, p) in enumerate(zip(yt, yp)):
+        acc.update(t, p, key=i % 3)
+        (acc_even if i % 2 == 0 else acc_odd).update(t, p, key=i % 3)
+
+    confmat = ext_confusionmatrix(yt.ravel(), yp.ravel(), labels=np.arange(nclasses))
+    assert_almost_equal(acc.confusion, confmat)
+    assert acc.total == yt.size
+
+    for k in range(3):
+        confk = ext_confusionmatrix(
+            yt[k::3].ravel(), yp[k::3].ravel(), labels=np.arange(nclasses)
+        )
+        assert_almost_equal(acc[k].confusion, confk)
+
+    acc_even += acc_odd
+    assert_almost_equal(acc_even.confusion, confmat)
+    assert sorted(acc_even.keys()) == sorted(acc.keys())
+    for k in acc.keys():
+        assert_almost_equal(acc_even[k].confusion, acc[k].confusion)
+
+    for got, exp in zip(acc.precision_recall(), nu.normalize_confusion_matrix(confmat)):
+        assert_almost_equal(got, exp)
+
+    acc_cat = nu.ConfusionAccumulator(nclasses)
+    acc_cat.update_categorical(
+        nu.to_categorical(yt, nclasses), nu.to_categorical(yp, nclasses)
+    )
+    assert_almost_equal(acc_cat.confusion, confmat)
+
+    with pytest.raises(RuntimeError):
+        acc.update([nclasses], [0])
+
+    with pytest.raises(ValueError):
+        acc.merge(nu.ConfusionAccumulator(nclasses + 1))
+
+
 ## TESTS FOR SHARE DATA #######################################################
 
 